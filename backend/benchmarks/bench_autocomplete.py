@@ -0,0 +1,88 @@
+# ブランド名の入力補完(トライ木)と、これまでの部分一致検索(DBのILIKE / マスタのスナップショットの走査)を比較するベンチマーク
+# 入力中の文字列として、各ブランド名の先頭1~4文字(英数字を全角にしたものも含む)を使う
+# ブランド数が少ないと差が見えにくいので、--scaleで名前に番号を付けたブランドを増やしたトライ木でも計測する
+# backendディレクトリで以下のように実行する
+#   python -m benchmarks.bench_autocomplete --db-url sqlite:///bench.db --scale 100
+import argparse
+import time
+import unicodedata
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_control import crud
+from db_control.autocomplete import BrandTrie, load_brand_popularity
+from db_control.catalog import BrandRecord, get_catalog
+
+
+# 1回あたりの時間のp50とp99(ミリ秒)
+def measure(func, queries, repeat: int):
+    times = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            func(query)
+            times.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(times, 50)), float(np.percentile(times, 99))
+
+
+# 入力の例(名前の先頭1~4文字と、英数字を全角にしたもの)
+def make_queries(brands):
+    queries = []
+    for brand in brands:
+        for length in range(1, 5):
+            prefix = brand.brand_name[:length]
+            queries.append(prefix)
+            queries.append("".join(chr(ord(c) + 0xFEE0) if "!" <= c <= "~" else c for c in prefix))
+    return queries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare trie autocomplete with substring brand search")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--scale", type=int, default=100, help="copies of each brand in the scaled-up trie")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+    db = sessionmaker(bind=engine)()
+
+    # 1.マスタのブランドで比較する
+    catalog = get_catalog(db)
+    popularity = load_brand_popularity(db)
+    start = time.perf_counter()
+    trie = BrandTrie(catalog.brands, popularity, catalog)
+    print(f"{len(catalog.brands)} brands: trie built in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    queries = make_queries(catalog.brands)
+    # 全角で入力しても半角と同じ結果になることを確認する
+    for query in queries:
+        assert trie.search(query, args.limit) == trie.search(unicodedata.normalize("NFKC", query), args.limit)
+
+    results = [
+        ("DB ILIKE (crud.search_brands)", measure(lambda q: crud.search_brands(db, q), queries, max(args.repeat // 10, 1))),
+        ("catalog substring scan", measure(catalog.search_brands, queries, args.repeat)),
+        ("trie prefix lookup", measure(lambda q: trie.search(q, args.limit), queries, args.repeat)),
+    ]
+
+    # 2.ブランド数を増やした場合
+    scaled_brands = [BrandRecord(brand.brand_id * args.scale + i, f"{brand.brand_name} {i}", brand.category, brand.manufacturer_id) for brand in catalog.brands for i in range(args.scale)]
+    scaled_popularity = {brand.brand_id: popularity.get(brand.brand_id // args.scale, 0) for brand in scaled_brands}
+    start = time.perf_counter()
+    scaled_trie = BrandTrie(scaled_brands, scaled_popularity)
+    scaled_build_ms = (time.perf_counter() - start) * 1000
+    results.append((f"trie prefix lookup ({len(scaled_brands)} brands)", measure(lambda q: scaled_trie.search(q, args.limit), queries, args.repeat)))
+    results.append(
+        (f"substring scan ({len(scaled_brands)} brands)", measure(lambda q: [b for b in scaled_brands if q.casefold() in b.brand_name.casefold()], queries, max(args.repeat // 10, 1)))
+    )
+    print(f"{len(scaled_brands)} brands: trie built in {scaled_build_ms:.1f} ms")
+
+    print(f"{len(queries)} queries, limit={args.limit}")
+    for name, (p50, p99) in results:
+        print(f"{name:44} p50 {p50:8.4f} ms  p99 {p99:8.4f} ms")
+    db.close()
@@ -0,0 +1,119 @@
+# リコメンドのランキング計算・絞り込みを、以前のpandasの実装とNumPyの配列の実装で比較するベンチマーク
+#   以前: ブランドごと・ユーザーの1行のDataFrameを作り、iterrowsでscipyのcos類似度を計算してsort_values、ng_idはDataFrame.queryで除外
+#   現在: (brand_id, 8次元ベクトル)の配列のまま行列演算でcos類似度を計算してargsort、ng_idはboolのマスクで除外
+# 同じ入力で並び順・絞り込み結果が一致することを確認してから、1回あたりの時間とメモリ確保(tracemalloc)を比べる
+# DBへの問い合わせ時間を含めないよう、ベクトルは最初にまとめて読んでおく
+# backendディレクトリで以下のように実行する
+#   python -m benchmarks.bench_ranking --db-url sqlite:///bench.db
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cosine
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from db_control.mymodels import User
+from db_control.recommend import ITEM_COLUMNS, get_survey_vectors, get_user_age_and_gender, get_user_preference_vector, rank_by_cosine_similarity
+
+
+# 以前の実装(recommend.pyのadd_recommendation_scoresとrecommend_preferred_productsの絞り込み)
+def legacy_rank(brand_ids: np.ndarray, vectors: np.ndarray, user_vector: np.ndarray, age: int, gender: int):
+    combined_df = pd.DataFrame()
+    for brand_id, vector in zip(brand_ids.tolist(), vectors.tolist()):
+        data = {'brand_id': [brand_id], 'age': [age], 'gender': [gender]}
+        data.update({column: [value] for column, value in zip(ITEM_COLUMNS, vector)})
+        combined_df = pd.concat([combined_df, pd.DataFrame(data)], ignore_index=True)
+    user_df = pd.DataFrame({'user_id': [0], **{column: [value] for column, value in zip(ITEM_COLUMNS, user_vector.tolist())}})
+
+    combined_df['rec_score'] = 0.0
+    user_values = user_df.iloc[0, 1:].values.tolist()
+    for idx, row in combined_df.iterrows():
+        combined_df.at[idx, 'rec_score'] = 1 - cosine(row[ITEM_COLUMNS].values.tolist(), user_values)
+    return combined_df.sort_values(by='rec_score', ascending=False).reset_index(drop=True)
+
+
+def legacy_top(recommendation_df: pd.DataFrame, kinds: int, ng_id: list[int]):
+    if ng_id:
+        recommendation_df = recommendation_df.query(' & '.join([f'brand_id != {i}' for i in ng_id]))
+    return recommendation_df.head(kinds)[["brand_id"]]["brand_id"].tolist()
+
+
+def current_top(brand_ids: np.ndarray, vectors: np.ndarray, user_vector: np.ndarray, kinds: int, ng_id: list[int]):
+    return rank_by_cosine_similarity(brand_ids, vectors, user_vector).top(kinds, ng_id)
+
+
+def legacy_top_from_vectors(brand_ids, vectors, user_vector, age, gender, kinds, ng_id):
+    return legacy_top(legacy_rank(brand_ids, vectors, user_vector, age, gender), kinds, ng_id)
+
+
+# 1回あたりの時間(p50)と、1回の呼び出し中に確保されたメモリのピーク(tracemalloc)の平均
+def measure(func, cases, repeat: int):
+    times = []
+    for _ in range(repeat):
+        for case in cases:
+            start = time.perf_counter()
+            func(*case)
+            times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    peaks = []
+    for case in cases:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        func(*case)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return float(np.median(times)), float(np.mean(peaks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the pandas and NumPy implementations of recommendation ranking")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--users", type=int, default=50, help="number of users to compare")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--kinds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+    db = sessionmaker(bind=engine)()
+
+    # 1.比較に使う入力(ユーザーごとの8次元ベクトルと、年齢・性別・カテゴリごとの製品ベクトル)を読んでおく
+    cases = []
+    vectors_cache = {}
+    user_ids = db.execute(select(User.user_id).order_by(User.user_id).limit(args.users)).scalars().all()
+    for user_id in user_ids:
+        age, gender = get_user_age_and_gender(user_id, db)
+        user_vector = get_user_preference_vector(user_id, db)
+        for category in ("national", "craft"):
+            key = (age, gender, category)
+            if key not in vectors_cache:
+                vectors_cache[key] = get_survey_vectors(age, gender, category, db)
+            brand_ids, vectors = vectors_cache[key]
+            if len(brand_ids) == 0:
+                continue
+            ng_id = brand_ids[: user_id % 3].tolist()
+            cases.append((brand_ids, vectors, user_vector, age, gender, args.kinds, ng_id))
+    db.close()
+
+    # 2.並び順と絞り込み結果が一致することを確認する
+    for brand_ids, vectors, user_vector, age, gender, kinds, ng_id in cases:
+        legacy = legacy_rank(brand_ids, vectors, user_vector, age, gender)
+        ranking = rank_by_cosine_similarity(brand_ids, vectors, user_vector)
+        assert legacy['brand_id'].tolist() == ranking.brand_ids.tolist()
+        assert np.allclose(legacy['rec_score'].to_numpy(dtype=float), ranking.rec_scores, equal_nan=True)
+        assert legacy_top(legacy, kinds, ng_id) == ranking.top(kinds, ng_id)
+    print(f"{len(cases)} (user, category) cases: rankings and ng_id filtering match")
+
+    # 3.時間とメモリ確保を比べる
+    legacy_time, legacy_peak = measure(legacy_top_from_vectors, cases, args.repeat)
+    current_cases = [(brand_ids, vectors, user_vector, kinds, ng_id) for brand_ids, vectors, user_vector, _, _, kinds, ng_id in cases]
+    current_time, current_peak = measure(current_top, current_cases, args.repeat)
+    print(f"pandas: p50 {legacy_time * 1000:.3f} ms, peak allocation {legacy_peak / 1024:.1f} KiB/call")
+    print(f"numpy:  p50 {current_time * 1000:.3f} ms, peak allocation {current_peak / 1024:.1f} KiB/call")
+    print(f"speedup (p50): {legacy_time / current_time:.1f}x, peak allocation: {legacy_peak / current_peak:.1f}x smaller")
@@ -0,0 +1,103 @@
+# /purchaselog のレスポンス生成にかかる時間を比較するベンチマーク
+#   old: Pydanticモデルを組み立て → FastAPIがresponse_modelで再検証 → 標準のjsonでシリアライズ
+#   new: dictを組み立て → 再検証なしでorjsonでシリアライズ(現在の実装)
+# backendディレクトリで以下のように実行する
+#   python -m benchmarks.bench_serialization --purchases 5 --details 6 --logo-bytes 20000
+import argparse
+import asyncio
+import base64
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import orjson
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from db_control.schemas import PurchaselogPage, Purchaselog, PurchaseItem
+
+
+# 1.実データに近いpurchaselogのページを作る(ロゴはBase64文字列として各明細に入る)
+def make_rows(purchases: int, details: int, logo_bytes: int, seed: int):
+    rng = random.Random(seed)
+    logos = [base64.b64encode(os.urandom(logo_bytes)).decode('utf-8') for _ in range(8)]
+    now = datetime(2024, 8, 1, 12, 0, 0)
+
+    rows = []
+    for i in range(purchases):
+        rows.append(
+            {
+                "purchase_id": i + 1,
+                "date_time": now - timedelta(days=i, microseconds=rng.randint(0, 999999)),
+                "total_amount": rng.randint(3000, 9000),
+                "total_cans": 24,
+                "survey_completion": rng.random() < 0.5,
+                "details": [
+                    {
+                        "ec_brand_id": rng.randint(1, 30),
+                        "category": rng.choice(["national", "craft"]),
+                        "name": f"ブランド{j}",
+                        "price": rng.randint(180, 600),
+                        "count": rng.randint(1, 6),
+                        "ec_set_id": rng.randint(1, 10),
+                        "picture": rng.choice(logos),
+                    }
+                    for j in range(details)
+                ],
+            }
+        )
+    return rows
+
+
+# 2-1.変更前: Pydanticモデル → response_modelで再検証 → json
+def render_old(rows, field, loop):
+    page = PurchaselogPage(
+        page=1,
+        total_page=10,
+        purchaselog=[Purchaselog(**{**row, "details": [PurchaseItem(**d) for d in row["details"]]}) for row in rows],
+    )
+    content = loop.run_until_complete(serialize_response(field=field, response_content=page))
+    return JSONResponse(content).body
+
+
+# 2-2.変更後: dict → orjson
+def render_new(rows):
+    return ORJSONResponse({"page": 1, "total_page": 10, "purchaselog": rows}).body
+
+
+def bench(func, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.95) - 1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare purchaselog serialization paths")
+    parser.add_argument("--purchases", type=int, default=5, help="purchases per page")
+    parser.add_argument("--details", type=int, default=6, help="detail rows per purchase")
+    parser.add_argument("--logo-bytes", type=int, default=20000, help="raw size of each logo before base64")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = make_rows(args.purchases, args.details, args.logo_bytes, args.seed)
+    field = create_response_field(name="response", type_=PurchaselogPage)
+    loop = asyncio.new_event_loop()
+
+    # 出力されるJSONが同じ内容になっていることを確認しておく
+    assert orjson.loads(render_old(rows, field, loop)) == orjson.loads(render_new(rows))
+
+    old_p50, old_p95 = bench(lambda: render_old(rows, field, loop), args.repeat)
+    new_p50, new_p95 = bench(lambda: render_new(rows), args.repeat)
+    size = len(render_new(rows))
+
+    print(f"payload: {args.purchases} purchases x {args.details} details, {size / 1024:.0f} KiB")
+    print(f"old (pydantic + json):  p50 {old_p50 * 1000:.3f} ms  p95 {old_p95 * 1000:.3f} ms")
+    print(f"new (dict + orjson):    p50 {new_p50 * 1000:.3f} ms  p95 {new_p95 * 1000:.3f} ms")
+    print(f"speedup (p50): {old_p50 / new_p50:.1f}x")
@@ -0,0 +1,110 @@
+# surveysのベクトルをDBから読む場合と、共有メモリ(mmap)の配列から読む場合を比較するベンチマーク
+#   cold start: 新しいワーカーが使えるようになるまで(DBから配列を作る / 既存の世代をmmapする / ディスク上のスナップショットをmmapする)
+#   combined data: get_combined_data 1回分(以前のsurveysを8行ずつ読んで並べ替えるクエリ / survey_vectorsを1行ずつ読むクエリ / mmap済みの配列)
+# backendディレクトリで以下のように実行する
+#   python -m benchmarks.bench_survey_matrix --db-url sqlite:///local.db
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from db_control import snapshot, survey_matrix
+from db_control.mymodels import Brand, Survey, SurveyVector
+from db_control.recommend import get_combined_data
+
+
+# 以前の実装(surveysからブランドごとに8行を読み、Pythonでid1~id8の列に並べ替える)。読んだ行数も返す
+def legacy_combined_data(age: int, gender: int, category: str, db):
+    results = db.execute(
+        select(Survey).join(Brand).where(and_(Survey.age_lower_limit < age, Survey.age_upper_limit > age, Survey.gender == gender, Brand.category == category))
+    ).mappings().all()
+    rows_read = len(results)
+
+    combined_data = pd.DataFrame()
+    for brand_id in {row['Survey'].brand_id for row in results}:
+        query = select(Survey).where(and_(Survey.brand_id == brand_id, Survey.age_lower_limit < age, Survey.age_upper_limit > age, Survey.item_id.in_([1, 2, 3, 4, 5, 6, 7, 8]), Survey.gender == gender))
+        brand_rows = db.execute(query).mappings().fetchall()
+        rows_read += len(brand_rows)
+        data = {'brand_id': [brand_id], 'age': [age], 'gender': [gender], **{f'id{i}': [None] for i in range(1, 9)}}
+        for row in brand_rows:
+            if 1 <= row['Survey'].item_id <= 8:
+                data[f"id{row['Survey'].item_id}"][0] = row['Survey'].score
+        combined_data = pd.concat([combined_data, pd.DataFrame(data)], ignore_index=True)
+    return combined_data, rows_read
+
+
+def bench(func, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.95) - 1]
+
+
+# 結果の比較用にbrand_id順に並べ、型をそろえる
+def normalize(df: pd.DataFrame):
+    if df.empty:
+        return df
+    return df.sort_values("brand_id").reset_index(drop=True).astype(float)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare DB-backed and shared-memory survey vectors")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+    db = sessionmaker(bind=engine)()
+
+    # 1.cold start
+    start = time.perf_counter()
+    arrays = survey_matrix.build_arrays(db)
+    build_seconds = time.perf_counter() - start
+    generation = survey_matrix.publish(arrays)
+    matrix = survey_matrix.map_generation(generation)
+    print(f"cold start: build from DB {build_seconds * 1000:.1f} ms, mmap existing generation {matrix.loaded_seconds * 1000:.2f} ms")
+    print(f"shared arrays: {len(matrix.survey_ids)} rows, {matrix.nbytes() / 1024:.0f} KiB mapped once for all workers")
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        snapshot.build_snapshot(db, directory)
+        snapshot_build_seconds = time.perf_counter() - start
+        recommender_snapshot = snapshot.load_snapshot(directory)
+        print(f"snapshot: build {snapshot_build_seconds * 1000:.1f} ms, mmap on startup {recommender_snapshot.loaded_seconds * 1000:.2f} ms ({recommender_snapshot.nbytes() / 1024:.0f} KiB)")
+
+        # 2.結果が同じであることを確認してから、1回分の時間を比較する
+        cases = [(age, gender, category) for age in (25, 35, 45, 55, 65, 75) for gender in (0, 1) for category in ("national", "craft")]
+        for age, gender, category in cases:
+            old = normalize(legacy_combined_data(age, gender, category, db)[0])
+            wide = normalize(get_combined_data(age, gender, category, db, from_db=True))
+            new = normalize(get_combined_data(age, gender, category, db))
+            pd.testing.assert_frame_equal(old, wide, check_dtype=False)
+            pd.testing.assert_frame_equal(old, new, check_dtype=False)
+
+            brand_ids, vectors = recommender_snapshot.survey_vectors_for(age, gender, category)
+            if not old.empty:
+                assert np.array_equal(brand_ids, old["brand_id"].to_numpy()) and np.allclose(vectors, old[[f"id{i}" for i in range(1, 9)]].to_numpy(), equal_nan=True)
+
+    age, gender, category = 35, 0, "national"
+    legacy_rows = legacy_combined_data(age, gender, category, db)[1]
+    wide_rows = db.execute(
+        select(func.count()).select_from(SurveyVector).join(Brand).where(SurveyVector.age_lower_limit < age, SurveyVector.age_upper_limit > age, SurveyVector.gender == gender, Brand.category == category)
+    ).scalar()
+    old_p50, old_p95 = bench(lambda: legacy_combined_data(age, gender, category, db), args.repeat)
+    wide_p50, wide_p95 = bench(lambda: get_combined_data(age, gender, category, db, from_db=True), args.repeat)
+    new_p50, new_p95 = bench(lambda: get_combined_data(age, gender, category, db), args.repeat)
+    print(f"combined data (DB, surveys):        p50 {old_p50 * 1000:.2f} ms  p95 {old_p95 * 1000:.2f} ms  ({legacy_rows} rows read)")
+    print(f"combined data (DB, survey_vectors): p50 {wide_p50 * 1000:.2f} ms  p95 {wide_p95 * 1000:.2f} ms  ({wide_rows} rows read)")
+    print(f"combined data (shared memory):      p50 {new_p50 * 1000:.3f} ms  p95 {new_p95 * 1000:.3f} ms")
+    print(f"speedup (p50): survey_vectors {old_p50 / wide_p50:.1f}x, shared memory {old_p50 / new_p50:.1f}x")
+    db.close()
@@ -0,0 +1,148 @@
+# アンケート画面の表示に掛かる時間を、これまでの呼び方(複数のエンドポイントを順に呼ぶ)と /purchase/{id}/survey_page の1回で比較するベンチマーク
+#   これまで: /purchase/{id}/brands → /purchase/{id}/date → /items → /user/{id} → ブランドごとに /brands/{id}/logo と /brand/{id}/average_scores
+#   現在:     /purchase/{id}/survey_page
+# 両方の内容が一致することを確認してから、1画面あたりの時間(p50/p95)とリクエスト数を比べる
+# 起動中のサーバーに対して実行すると、ブラウザとの往復の回数の差がそのまま時間に出る
+# プロセス内で実行する場合は往復の時間が無いので、--rtt-msでリクエストごとの往復の時間を足して見積もる
+# backendディレクトリで以下のように実行する
+#   起動中のサーバーに対して:  python -m benchmarks.bench_survey_page --base-url http://localhost:8000
+#   プロセス内で(サーバー不要): python -m benchmarks.bench_survey_page --db-url sqlite:///bench.db --rtt-ms 30
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+
+# 1.これまでの呼び方で1画面分を取得する。(画面の内容, リクエスト数)を返す
+async def fan_out(client: httpx.AsyncClient, purchase_id: int, user_id: int):
+    brands = (await client.get(f"/purchase/{purchase_id}/brands")).json()
+    purchase_date = (await client.get(f"/purchase/{purchase_id}/date")).json()["purchase_date"]
+    items = (await client.get("/items")).json()
+    user = (await client.get(f"/user/{user_id}")).json()
+    page = {"purchase_date": purchase_date, "user": user, "items": items, "brands": []}
+    for brand in brands:
+        # ロゴは元画像、survey_pageは縮小版を返すので、中身は比べずにロゴの有無だけを比べる
+        has_logo = (await client.get(f"/brands/{brand['brand_id']}/logo")).status_code == 200
+        average_scores = (await client.get(f"/brand/{brand['brand_id']}/average_scores")).json()
+        page["brands"].append({"brand_id": brand["brand_id"], "brand_name": brand["brand_name"], "has_logo": has_logo, "average_scores": average_scores})
+    return page, 4 + 2 * len(brands)
+
+
+# 2.まとめたエンドポイントで1画面分を取得する
+async def survey_page(client: httpx.AsyncClient, purchase_id: int):
+    response = await client.get(f"/purchase/{purchase_id}/survey_page")
+    response.raise_for_status()
+    page = response.json()
+    brands = [
+        {"brand_id": brand["brand_id"], "brand_name": brand["brand_name"], "has_logo": brand["brand_logo"] is not None, "average_scores": brand["average_scores"]}
+        for brand in page["brands"]
+    ]
+    return {"purchase_date": page["purchase_date"], "user": page["user"], "items": page["items"], "brands": brands}, 1
+
+
+async def measure(func, cases, repeat: int):
+    times = []
+    requests = []
+    for _ in range(repeat):
+        for case in cases:
+            start = time.perf_counter()
+            _, count = await func(*case)
+            times.append((time.perf_counter() - start) * 1000)
+            requests.append(count)
+    return float(np.percentile(times, 50)), float(np.percentile(times, 95)), float(np.mean(requests))
+
+
+async def run(client: httpx.AsyncClient, args):
+    cases = []
+    for purchase_id, user_id in sorted(args.user_ids.items()):
+        # 明細の無い購入は /purchase/{id}/brands が404になるので使わない
+        new, _ = await survey_page(client, purchase_id)
+        if not new["brands"]:
+            continue
+        # 内容が一致することを確認する
+        old, _ = await fan_out(client, purchase_id, user_id)
+        assert old == new, (purchase_id, old, new)
+        cases.append((purchase_id, user_id))
+    print(f"{len(cases)} purchases: fan-out and survey_page return the same content")
+
+    old = await measure(lambda purchase_id, user_id: fan_out(client, purchase_id, user_id), cases, args.repeat)
+    new = await measure(lambda purchase_id, _: survey_page(client, purchase_id), cases, args.repeat)
+    return old, new
+
+
+def load_user_ids(db_url: str, purchases: int):
+    from sqlalchemy import create_engine, select
+    from db_control.mymodels import Purchase
+
+    engine = create_engine(db_url)
+    with engine.connect() as connection:
+        rows = connection.execute(select(Purchase.purchase_id, Purchase.user_id).where(Purchase.purchase_id <= purchases)).all()
+    engine.dispose()
+    return dict(rows)
+
+
+async def main(args):
+    if not args.db_url:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+            return await run(client, args)
+
+    # プロセス内で実行する場合は、アプリのget_dbを--db-urlのDBに差し替える(共有メモリの配列・スナップショットは一時ディレクトリを使う)
+    workdir = tempfile.mkdtemp(prefix="bench_survey_page_")
+    os.environ["SURVEY_MATRIX_DIR"] = os.path.join(workdir, "survey_matrix")
+    os.environ["RECOMMENDER_SNAPSHOT_DIR"] = os.path.join(workdir, "snapshot")
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import main as app_main
+    from db_control import connect
+
+    connect_args = {"check_same_thread": False} if args.db_url.startswith("sqlite") else {}
+    engine = create_engine(args.db_url, connect_args=connect_args)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app_main.app.dependency_overrides[connect.get_db] = get_db
+    try:
+        async with app_main.app.router.lifespan_context(app_main.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://bench", timeout=args.timeout) as client:
+                return await run(client, args)
+    finally:
+        engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the survey page fan-out with the aggregated survey_page endpoint")
+    parser.add_argument("--base-url", default="http://localhost:8000", help="server to test")
+    parser.add_argument("--db-url", help="run the app in-process against this database instead of --base-url")
+    parser.add_argument("--user-db-url", help="database used to look up each purchase's user_id (defaults to --db-url)")
+    parser.add_argument("--purchases", type=int, default=50, help="purchase_id 1..N are used")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rtt-ms", type=float, default=0.0, help="round-trip time added per request when estimating browser latency")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    user_db_url = args.user_db_url or args.db_url
+    if user_db_url is None:
+        parser.error("--user-db-url is required with --base-url")
+    args.user_ids = load_user_ids(user_db_url, args.purchases)
+
+    (old_p50, old_p95, old_requests), (new_p50, new_p95, new_requests) = asyncio.run(main(args))
+    print(f"fan-out:     p50 {old_p50:7.2f} ms  p95 {old_p95:7.2f} ms  {old_requests:.1f} requests/page")
+    print(f"survey_page: p50 {new_p50:7.2f} ms  p95 {new_p95:7.2f} ms  {new_requests:.1f} requests/page")
+    print(f"speedup (p50): {old_p50 / new_p50:.1f}x")
+    if args.rtt_ms:
+        old_estimate = old_p50 + old_requests * args.rtt_ms
+        new_estimate = new_p50 + new_requests * args.rtt_ms
+        print(f"with {args.rtt_ms:.0f} ms round trips: fan-out {old_estimate:.0f} ms, survey_page {new_estimate:.0f} ms ({old_estimate / new_estimate:.1f}x)")
@@ -0,0 +1,173 @@
+# リコメンドの各アルゴリズムを、過去の購入履歴を使ってオフラインで比較する評価・ベンチマーク
+# 本番にアクセスせず、SQLiteのDBファイルのコピー上で実行する(元のファイルは変更しない)
+#
+# 評価方法(leave-last-out): ユーザーごとに最後の購入を評価用に取り分け、コピーからはその購入を削除してから
+# 各アルゴリズムにそのユーザー・カテゴリのリコメンドをさせ、実際に購入されたec_brand_idと比較する
+#   hit rate: 推薦の中に実際に購入されたec_brand_idが1つ以上含まれていた割合
+#   recall:   実際に購入されたec_brand_idのうち、推薦に含まれていた割合の平均
+#   coverage: 推薦に1回以上登場したec_brand_idの数 / カテゴリ内のec_brand_idの数
+# あわせて1回あたりの処理時間(p50/p95/p99)とSQLの発行回数を測る。乱数はseedで固定するので、同じDBなら同じ結果になる
+# backendディレクトリで以下のように実行する
+#   python -m benchmarks.eval_recommenders --db-path local.db --json eval_result.json
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+STRATEGIES = (
+    "recommend_preferred_products",
+    "recommend_popular_products",
+    "recommend_diverse_preferred_products",
+    "recommend_adventurous_products",
+    "recommend_luxury_products",
+    "recommend_budget_products",
+)
+
+
+def percentile(values, q: float):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def mean(values):
+    return float(np.mean(values)) if values else 0.0
+
+
+# 1.ユーザーごとの最後の購入を評価用のケース[(user_id, category, {購入されたec_brand_id})]にして、コピーから削除する
+def hold_out_last_purchases(db):
+    from sqlalchemy import select, delete, func
+    from db_control.mymodels import Purchase, PurchaseDetail
+
+    last_dates = select(Purchase.user_id, func.max(Purchase.date_time).label("last_date_time")).group_by(Purchase.user_id).subquery()
+    purchase_ids = db.execute(
+        select(Purchase.purchase_id)
+        .join(last_dates, (Purchase.user_id == last_dates.c.user_id) & (Purchase.date_time == last_dates.c.last_date_time))
+        .order_by(Purchase.purchase_id)
+    ).scalars().all()
+
+    truth = {}
+    rows = db.execute(
+        select(Purchase.user_id, PurchaseDetail.category, PurchaseDetail.ec_brand_id)
+        .join(PurchaseDetail, PurchaseDetail.purchase_id == Purchase.purchase_id)
+        .where(Purchase.purchase_id.in_(purchase_ids))
+    ).all()
+    for user_id, category, ec_brand_id in rows:
+        truth.setdefault((user_id, category), set()).add(ec_brand_id)
+
+    db.execute(delete(PurchaseDetail).where(PurchaseDetail.purchase_id.in_(purchase_ids)))
+    db.execute(delete(Purchase).where(Purchase.purchase_id.in_(purchase_ids)))
+    db.commit()
+    return [(user_id, category, ec_brand_ids) for (user_id, category), ec_brand_ids in sorted(truth.items())]
+
+
+# 2.1つのアルゴリズムで全ケースをリコメンドして、指標を計算する
+def evaluate(strategy, cases, db, counter, cans: int, kinds: int, seed: int, catalog_sizes: dict):
+    from db_control.recommend import seed_recommend_random
+
+    seed_recommend_random(seed)
+    np.random.seed(seed)
+
+    # キャッシュの作成などを計測に含めないよう、1回空打ちしておく
+    for user_id, category, _ in cases[:1]:
+        try:
+            strategy(user_id, category, cans, kinds, [], db)
+        except Exception:
+            db.rollback()
+
+    latencies = []
+    queries = []
+    errors = 0
+    hits = 0
+    recalls = []
+    recommended = {}
+    for user_id, category, purchased in cases:
+        counter.count = 0
+        start = time.perf_counter()
+        try:
+            response = strategy(user_id, category, cans, kinds, [], db)
+        except Exception:
+            # APIなら500になるケース。外れとして数える
+            db.rollback()
+            response = []
+            errors += 1
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count)
+
+        ec_brand_ids = {item["ec_brand_id"] for item in response}
+        recommended.setdefault(category, set()).update(ec_brand_ids)
+        matched = len(ec_brand_ids & purchased)
+        hits += matched > 0
+        recalls.append(matched / len(purchased) if purchased else 0.0)
+
+    coverage = sum(len(ids) for ids in recommended.values()) / max(1, sum(catalog_sizes.get(category, 0) for category in recommended))
+    return {
+        "cases": len(cases),
+        "errors": errors,
+        "hit_rate": hits / len(cases) if cases else 0.0,  # ケースが無い場合は0件として0を返す
+        "recall": mean(recalls),
+        "coverage": coverage,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "queries_per_call": mean(queries),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline evaluation and latency benchmark of the recommendation strategies")
+    parser.add_argument("--db-path", required=True, help="SQLite database file to evaluate against (a copy is used)")
+    parser.add_argument("--strategy", action="append", choices=STRATEGIES, help="strategy to evaluate (repeatable, default: all)")
+    parser.add_argument("--cans", type=int, default=6)
+    parser.add_argument("--kinds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file for comparison between runs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="eval_recommenders_")
+    db_path = os.path.join(workdir, "eval.db")
+    shutil.copyfile(args.db_path, db_path)
+
+    # 共有メモリの配列やスナップショットが他のDBのものを指さないよう、作業ディレクトリの中を使う(db_controlのimport前に設定する)
+    os.environ["SURVEY_MATRIX_DIR"] = os.path.join(workdir, "survey_matrix")
+    os.environ["RECOMMENDER_SNAPSHOT_DIR"] = os.path.join(workdir, "snapshot")
+
+    from sqlalchemy import create_engine, event, select, func
+    from sqlalchemy.orm import sessionmaker
+    from db_control import recommend
+    from db_control.mymodels import EC_Brand
+
+    class QueryCounter:
+        count = 0
+
+    counter = QueryCounter()
+    engine = create_engine(f"sqlite:///{db_path}")
+    event.listen(engine, "before_cursor_execute", lambda *_: setattr(counter, "count", counter.count + 1))
+    db = sessionmaker(bind=engine)()
+
+    try:
+        cases = hold_out_last_purchases(db)
+        catalog_sizes = dict(db.execute(select(EC_Brand.category, func.count()).group_by(EC_Brand.category)).all())
+        print(f"{len(cases)} held-out (user, category) cases, cans={args.cans} kinds={args.kinds} seed={args.seed}")
+        if not cases:
+            print("No purchases to hold out; the metrics below are all 0")
+        print(f"{'strategy':40} {'hit':>6} {'recall':>7} {'cover':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'errors':>7}")
+
+        results = {}
+        for name in args.strategy or STRATEGIES:
+            result = evaluate(getattr(recommend, name), cases, db, counter, args.cans, args.kinds, args.seed, catalog_sizes)
+            results[name] = result
+            print(
+                f"{name:40} {result['hit_rate']:6.3f} {result['recall']:7.3f} {result['coverage']:6.3f} "
+                f"{result['p50_ms']:8.2f} {result['p95_ms']:8.2f} {result['p99_ms']:8.2f} {result['queries_per_call']:8.1f} {result['errors']:7d}"
+            )
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": vars(args), "results": results}, f, indent=2)
+    finally:
+        db.close()
+        engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
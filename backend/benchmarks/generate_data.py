@@ -0,0 +1,202 @@
+# 負荷試験用のデータを作るジェネレータ
+# マスタ(items, manufacturers, brands, ec_brands, ec_sets, stores, surveys)はダミーデータのExcelをそのまま使い(survey_vectorsはsurveysから作る)、
+# users, preferences, favorites, posts, photos, purchases, purchase_details, survey_raw_datasを指定した規模まで増やす
+# 乱数はseedで固定するので、同じ引数なら同じデータになる(ベンチマーク結果を実行間で比べられる)
+# ユーザーは user{n}@example.com / --password でログインできる
+# backendディレクトリで以下のように実行する(--db-urlにはSQLiteのほか、ローカルのMySQLも指定できる)
+#   python -m benchmarks.generate_data --db-url sqlite:///bench.db --users 1000 --purchases-per-user 10
+import argparse
+import io
+import random
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+from PIL import Image
+from sqlalchemy import create_engine, delete
+
+from db_control.average_scores import refresh_average_scores
+from db_control.load_dummy_data import EXCEL_PATH, insert_rows, read_sheet_rows
+from db_control.mymodels import Base
+from db_control.purchase_counts import refresh_purchase_counts
+from db_control.survey_vectors import refresh_survey_vectors
+
+# Excelのまま使うマスタ
+MASTER_SHEETS = ("items", "manufacturers", "brands", "ec_brands", "ec_sets", "stores", "surveys")
+
+
+# 1.マスタのシートを、テーブルの列にそろえたdictのリストにする
+def read_master_rows(excel_path: str):
+    sheets = pd.read_excel(excel_path, sheet_name=list(MASTER_SHEETS))
+    return {name: read_sheet_rows(sheets[name], name) for name in MASTER_SHEETS}
+
+
+# ブランドのロゴを入れる(元のExcelには画像が無い)
+def add_brand_logos(master: dict, seed: int):
+    rng = random.Random(seed)
+    for row in master["brands"]:
+        row["brand_picture"] = make_image(rng, (400, 400), "PNG")
+
+
+# 単色の画像を作る(ロゴや投稿写真の代わり。縮小版の作成やサイズの計測がそのままできるように本物の画像にする)
+def make_image(rng: random.Random, size, image_format: str):
+    image = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+# 2.増やすテーブルの行を作る(テーブル名, 行のイテレータ)の順に返す(外部キーの順に並べてある)
+def generate_rows(master: dict, args, password_hash: str):
+    rng = random.Random(args.seed)
+    brands = master["brands"]
+    ec_brands_by_category = {}
+    for row in master["ec_brands"]:
+        ec_brands_by_category.setdefault(row["category"], []).append(row)
+    ec_set_ids = sorted({row["ec_set_id"] for row in master["ec_sets"] if row["ec_set_id"] < 900})
+    store_ids = [row["store_id"] for row in master["stores"]]
+    item_ids = [row["item_id"] for row in master["items"]]
+    now = datetime.now().replace(microsecond=0)
+
+    users = []
+    for user_id in range(1, args.users + 1):
+        users.append(
+            {
+                "user_id": user_id,
+                "user_name": f"ユーザー{user_id}",
+                "user_mail": f"user{user_id}@example.com",
+                "user_password": password_hash,
+                "user_picture": None,
+                "user_profile": "ビールが好きです。",
+                "birthdate": date(rng.randint(1950, 2003), rng.randint(1, 12), rng.randint(1, 28)),
+                "gender": rng.randint(0, 1),
+            }
+        )
+    yield "users", users
+
+    yield "preferences", ({"user_id": user["user_id"], "item_id": item_id, "score": rng.randint(1, 5)} for user in users for item_id in item_ids)
+
+    def favorites():
+        favorite_id = 0
+        for user in users:
+            for brand in rng.sample(brands, min(args.favorites_per_user, len(brands))):
+                favorite_id += 1
+                yield {"favorite_id": favorite_id, "user_id": user["user_id"], "brand_id": brand["brand_id"]}
+
+    yield "favorites", favorites()
+
+    posts = []
+    for user in users:
+        for _ in range(args.photos_per_user):
+            posts.append({"post_id": len(posts) + 1, "user_id": user["user_id"], "store_id": rng.choice(store_ids), "review": "おいしかった！", "rating": rng.randint(1, 5)})
+    yield "posts", posts
+    # 投稿写真は数種類を使い回す(毎回エンコードすると生成に時間がかかるため)
+    photo_templates = [make_image(rng, (args.photo_width, args.photo_width * 3 // 4), "JPEG") for _ in range(8)]
+    yield "photos", ({"photo_id": post["post_id"], "post_id": post["post_id"], "photo_data": rng.choice(photo_templates)} for post in posts)
+
+    purchases = []
+    details = []
+    raw_datas = []
+    purchase_id = 0
+    raw_data_id = 0
+    for user in users:
+        age = now.year - user["birthdate"].year
+        for _ in range(args.purchases_per_user):
+            purchase_id += 1
+            date_time = now - timedelta(days=rng.randint(0, 365), seconds=rng.randint(0, 86399))
+            survey_completion = rng.random() < 0.5
+            ec_set_id = rng.choice(ec_set_ids)
+            detail_id = 0
+            total_amount = 0
+            total_cans = 0
+            bought_brand_ids = set()
+            # 1セット12缶(ナショナル6缶・クラフト6缶、それぞれ3種類×2缶)
+            for category in ("national", "craft"):
+                for ec_brand in rng.sample(ec_brands_by_category.get(category, []), min(3, len(ec_brands_by_category.get(category, [])))):
+                    bought_brand_ids.add(ec_brand["brand_id"])
+                    detail_id += 1
+                    total_amount += ec_brand["price"] * 2
+                    total_cans += 2
+                    details.append(
+                        {
+                            "purchase_id": purchase_id,
+                            "detail_id": detail_id,
+                            "ec_set_id": ec_set_id,
+                            "ec_brand_id": ec_brand["ec_brand_id"],
+                            "category": category,
+                            "name": ec_brand["name"],
+                            "price": ec_brand["price"],
+                            "quantity": 2,
+                        }
+                    )
+            purchases.append(
+                {
+                    "purchase_id": purchase_id,
+                    "user_id": user["user_id"],
+                    "date_time": date_time,
+                    "total_amount": total_amount,
+                    "total_cans": total_cans,
+                    "survey_completion": survey_completion,
+                }
+            )
+            if survey_completion:
+                for brand_id in sorted(bought_brand_ids):
+                    raw_data_id += 1
+                    for item_id in item_ids:
+                        raw_datas.append(
+                            {
+                                "raw_data_id": raw_data_id,
+                                "item_id": item_id,
+                                "brand_id": brand_id,
+                                "score": rng.randint(1, 5),
+                                "age": age,
+                                "gender": user["gender"],
+                                "purchase_date": date_time.date(),
+                            }
+                        )
+    yield "purchases", purchases
+    yield "purchase_details", details
+    yield "survey_raw_datas", raw_datas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a scaled-up synthetic dataset for load testing")
+    parser.add_argument("--db-url", default="sqlite:///bench.db", help="target database (all tables are emptied first)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--purchases-per-user", type=int, default=10)
+    parser.add_argument("--favorites-per-user", type=int, default=5)
+    parser.add_argument("--photos-per-user", type=int, default=3)
+    parser.add_argument("--photo-width", type=int, default=1024, help="width of the generated JPEG photos")
+    parser.add_argument("--password", default="password", help="password for every generated user")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # db_control.tokenをimportするとusersのメタデータに列が追加されるので、ハッシュ化はここで直接行う(token.pyと同じbcrypt)
+    from passlib.context import CryptContext
+
+    engine = create_engine(args.db_url)
+    Base.metadata.create_all(engine)
+    start = time.perf_counter()
+
+    master = read_master_rows(EXCEL_PATH)
+    add_brand_logos(master, args.seed)
+    with engine.begin() as connection:
+        # 子テーブルから順に空にしておく
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(delete(table))
+
+        generated = generate_rows(master, args, CryptContext(schemes=["bcrypt"]).hash(args.password))
+        for name in MASTER_SHEETS[:-2]:
+            print(f"{name}: {insert_rows(connection, name, master[name])} rows")
+        # storesはbrandsに、surveysはbrands・itemsに依存するので後から入れる
+        print(f"stores: {insert_rows(connection, 'stores', master['stores'])} rows")
+        print(f"surveys: {insert_rows(connection, 'surveys', master['surveys'])} rows")
+        print(f"survey_vectors: {refresh_survey_vectors(connection)} rows")
+        for name, rows in generated:
+            table_start = time.perf_counter()
+            count = insert_rows(connection, name, rows)
+            print(f"{name}: {count} rows ({count / (time.perf_counter() - table_start):.0f} rows/s)")
+        print(f"brand_average_scores: {refresh_average_scores(connection)} rows")
+        print(f"brand_purchase_counts: {refresh_purchase_counts(connection)} rows")
+
+    print(f"Done in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,195 @@
+# APIの負荷試験(購入からアンケート回答までの一連の操作を、複数の仮想ユーザーで同時に実行する)
+# 1シナリオ = ログイン → リコメンド(national・craft) → 購入 → 購入履歴 → アンケート画面の取得 → アンケート回答 → 回答完了
+# エンドポイントごとにリクエスト数・エラー数・スループット・レイテンシ(p50/p95/p99)を集計する
+# どのユーザーがどのセットを買うかは--seedで固定するので、同じデータ・同じ引数なら実行間で結果を比べられる
+# (購入・アンケートはDBに書き込まれるので、比べるときはbenchmarks.generate_dataでデータを作り直してから実行する)
+# backendディレクトリで以下のように実行する
+#   起動中のサーバーに対して:  python -m benchmarks.load_test --base-url http://localhost:8000 --users 1000
+#   プロセス内で(サーバー不要): python -m benchmarks.load_test --db-url sqlite:///bench.db --users 1000 --json load_result.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+CATEGORIES = ("national", "craft")
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name: str, seconds: float, ok: bool):
+        self.latencies.setdefault(name, []).append(seconds * 1000)
+        self.errors[name] = self.errors.get(name, 0) + (not ok)
+
+    # エンドポイントごとの集計結果
+    def summary(self, elapsed: float):
+        results = {}
+        for name, latencies in self.latencies.items():
+            results[name] = {
+                "count": len(latencies),
+                "errors": self.errors[name],
+                "rps": len(latencies) / elapsed,
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+            }
+        return results
+
+
+# 1.リクエストを1つ送って時間を記録する(エラーの場合はNone)
+async def call(client: httpx.AsyncClient, stats: Stats, name: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        response = None
+        ok = False
+    stats.record(name, time.perf_counter() - start, ok)
+    return response if ok else None
+
+
+# 2.1人分のシナリオ(途中でエラーになったら、そのシナリオはそこで打ち切る)
+async def scenario(client: httpx.AsyncClient, stats: Stats, user_id: int, ec_set_id: int, rng: random.Random, args):
+    response = await call(client, stats, "POST /token", "POST", "/token", json={"user_mail": f"user{user_id}@example.com", "user_password": args.password})
+    if response is None:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    # 2-1.リコメンドされた内容をそのまま購入する
+    sets = {}
+    for category in CATEGORIES:
+        params = {"ec_set_id": ec_set_id, "category": category, "cans": args.cans, "kinds": args.kinds}
+        response = await call(client, stats, "GET /recommend", "GET", "/recommend", params=params, headers=headers)
+        if response is None:
+            return
+        details = [dict(item, category=category, ec_set_id=ec_set_id) for item in response.json()]
+        sets[category] = {"cans": sum(item["count"] for item in details), "set_name": f"{category}_set", "details": details}
+    purchase = [{"setDetails": {"cans": sum(s["cans"] for s in sets.values()), "set_num": 1}, "national_set": sets["national"], "craft_set": sets["craft"]}]
+    if await call(client, stats, "POST /purchase", "POST", "/purchase", json=purchase, headers=headers) is None:
+        return
+
+    response = await call(client, stats, "GET /purchaselog", "GET", "/purchaselog", params={"page": 1}, headers=headers)
+    if response is None:
+        return
+    purchase_id = max(log["purchase_id"] for log in response.json()["purchaselog"])
+
+    # 2-2.アンケート画面(購入したブランド・購入日・項目・平均スコア・ユーザーの年齢と性別)
+    brands = await call(client, stats, "GET /purchase/{id}/brands", "GET", f"/purchase/{purchase_id}/brands")
+    purchase_date = await call(client, stats, "GET /purchase/{id}/date", "GET", f"/purchase/{purchase_id}/date")
+    items = await call(client, stats, "GET /items", "GET", "/items")
+    user = await call(client, stats, "GET /user/{id}", "GET", f"/user/{user_id}")
+    if None in (brands, purchase_date, items, user):
+        return
+    user = user.json()
+    for brand in brands.json():
+        await call(client, stats, "GET /brand/{id}/average_scores", "GET", f"/brand/{brand['brand_id']}/average_scores")
+        survey = {
+            "purchase_id": purchase_id,
+            "brand_id": brand["brand_id"],
+            "age": user["age"],
+            "gender": user["gender"],
+            "purchase_date": purchase_date.json()["purchase_date"],
+            "responses": [{"item_id": item["item_id"], "score": rng.randint(1, 5)} for item in items.json()],
+        }
+        await call(client, stats, "POST /survey/{id}", "POST", f"/survey/{purchase_id}", json=survey)
+    await call(client, stats, "POST /purchase/{id}/complete", "POST", f"/purchase/{purchase_id}/complete")
+
+
+# 3.シナリオの一覧を--concurrency人の仮想ユーザーで順に消化する
+async def run(client: httpx.AsyncClient, args):
+    rng = random.Random(args.seed)
+    plans = [(rng.randint(1, args.users), rng.randint(1, args.ec_sets), random.Random(rng.random())) for _ in range(args.warmup + args.iterations)]
+
+    # ウォームアップ(キャッシュの作成などを計測に含めない)
+    warmup_stats = Stats()
+    for user_id, ec_set_id, scenario_rng in plans[: args.warmup]:
+        await scenario(client, warmup_stats, user_id, ec_set_id, scenario_rng, args)
+
+    stats = Stats()
+    queue = asyncio.Queue()
+    for plan in plans[args.warmup :]:
+        queue.put_nowait(plan)
+
+    async def virtual_user():
+        while not queue.empty():
+            user_id, ec_set_id, scenario_rng = queue.get_nowait()
+            await scenario(client, stats, user_id, ec_set_id, scenario_rng, args)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(virtual_user() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    return stats.summary(elapsed), elapsed
+
+
+async def main(args):
+    if not args.db_url:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+            return await run(client, args)
+
+    # プロセス内で実行する場合は、アプリのget_dbを--db-urlのDBに差し替える(共有メモリの配列・スナップショットは一時ディレクトリを使う)
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    os.environ["SURVEY_MATRIX_DIR"] = os.path.join(workdir, "survey_matrix")
+    os.environ["RECOMMENDER_SNAPSHOT_DIR"] = os.path.join(workdir, "snapshot")
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import main as app_main
+    from db_control import connect
+
+    connect_args = {"check_same_thread": False, "timeout": 30} if args.db_url.startswith("sqlite") else {}
+    engine = create_engine(args.db_url, connect_args=connect_args)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app_main.app.dependency_overrides[connect.get_db] = get_db
+    try:
+        async with app_main.app.router.lifespan_context(app_main.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app, raise_app_exceptions=False), base_url="http://loadtest", timeout=args.timeout) as client:
+                return await run(client, args)
+    finally:
+        engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scripted async load test of the purchase and survey flow")
+    parser.add_argument("--base-url", default="http://localhost:8000", help="server to test")
+    parser.add_argument("--db-url", help="run the app in-process against this database instead of --base-url")
+    parser.add_argument("--users", type=int, default=1000, help="number of generated users (user1..userN@example.com)")
+    parser.add_argument("--password", default="password", help="password of the generated users")
+    parser.add_argument("--ec-sets", type=int, default=7, help="ec_set_id is chosen from 1..N")
+    parser.add_argument("--cans", type=int, default=6)
+    parser.add_argument("--kinds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=10, help="number of virtual users")
+    parser.add_argument("--iterations", type=int, default=100, help="number of scenarios to run")
+    parser.add_argument("--warmup", type=int, default=2, help="scenarios run before measuring")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file for comparison between runs")
+    args = parser.parse_args()
+
+    results, elapsed = asyncio.run(main(args))
+    print(f"{args.iterations} scenarios, concurrency={args.concurrency} seed={args.seed}: {elapsed:.1f}s ({args.iterations / elapsed:.1f} scenarios/s)")
+    print(f"{'endpoint':34} {'count':>6} {'errors':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, result in results.items():
+        print(f"{name:34} {result['count']:6d} {result['errors']:6d} {result['rps']:7.1f} {result['p50_ms']:8.2f} {result['p95_ms']:8.2f} {result['p99_ms']:8.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "elapsed": elapsed, "results": results}, f, indent=2)
@@ -0,0 +1,166 @@
+# ブランド名の入力補完(入力中の文字列で始まるブランドを人気順に返す)
+# ブランド名を正規化(全角・半角、カタカナ・ひらがな、大文字・小文字を区別しない)してトライ木に入れておき、
+# 各ノードにはそこから先のブランドを人気順(お気に入り登録数 + 購入本数)に並べた上位AUTOCOMPLETE_MAX_LIMIT件を持たせておく
+# 検索は入力の文字数分ノードをたどるだけなので、ブランド数によらず一定の時間で終わる
+# 「岸和田ビール 鐵工」のように空白や「・」で区切られた名前は、2語目以降の先頭からでも引ける
+# マスタのスナップショット(db_control/catalog.py)が差し替わったとき、またはAUTOCOMPLETE_MAX_AGE_SECONDSを過ぎたときに作り直す
+# 作り直しはジョブ(db_control/jobs.py)で行い、作り終えて差し替えるまでのリクエストには今のトライ木を返す
+# (リクエストの中で作るのは、プロセスでまだ一度も作っていない場合だけ)
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import List
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from db_control.catalog import get_catalog
+from db_control.connect import get_db
+from db_control.jobs import job_queue, session_factory
+from db_control.mymodels import Favorite
+from db_control.purchase_counts import load_purchase_counts
+from db_control.schemas import AutocompleteBrand
+
+# 環境変数のロード
+load_dotenv()
+# 人気(お気に入り登録数・購入本数)を集計し直す間隔(秒)
+AUTOCOMPLETE_MAX_AGE_SECONDS = float(os.getenv("AUTOCOMPLETE_MAX_AGE_SECONDS", "300"))
+# 1回に返せる件数の上限(各ノードにはこの件数だけ持たせる)
+AUTOCOMPLETE_MAX_LIMIT = 20
+
+router = APIRouter()
+
+# 語の区切りとみなす文字(NFKCの後の文字で指定する)
+SEPARATORS = re.compile(r"[\s・/&＆()（）「」『』\-]+")
+# 旧仮名(ヱビスなど)は今の仮名で入力されるので読み替える
+OLD_KANA = str.maketrans({"ゑ": "え", "ゐ": "い"})
+
+
+# 1.名前・入力を正規化する(NFKCで全角英数字と半角カナをそろえ、小文字にし、カタカナをひらがなにする)
+def normalize_name(text: str):
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+    return text.translate(OLD_KANA)
+
+
+# 名前を語に分け、各語の先頭から最後までの文字列(検索のキー)を返す。区切り文字は取り除く
+def index_keys(name: str):
+    words = [word for word in SEPARATORS.split(normalize_name(name)) if word]
+    return {"".join(words[i:]) for i in range(len(words))}
+
+
+class TrieNode:
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children = {}
+        self.top = []  # このノードから先のブランドのbrand_id(人気順、最大AUTOCOMPLETE_MAX_LIMIT件)
+
+
+class BrandTrie:
+    __slots__ = ("root", "brands_by_id", "popularity", "catalog", "built_at")
+
+    # brandsはBrandRecordのリスト、popularityはbrand_id -> 人気のdict
+    def __init__(self, brands, popularity: dict, catalog=None):
+        self.root = TrieNode()
+        self.brands_by_id = {brand.brand_id: brand for brand in brands}
+        self.popularity = popularity
+        self.catalog = catalog
+        self.built_at = time.monotonic()
+
+        # 2.人気の高い順に入れていき、各ノードの上位が埋まったらそれ以上は足さない(同じ人気なら名前の短い順、brand_id順)
+        ranked = sorted(brands, key=lambda brand: (-popularity.get(brand.brand_id, 0), len(brand.brand_name), brand.brand_id))
+        for brand in ranked:
+            visited = set()
+            for key in index_keys(brand.brand_name):
+                node = self.root
+                self._add(node, brand.brand_id, visited)
+                for c in key:
+                    node = node.children.setdefault(c, TrieNode())
+                    self._add(node, brand.brand_id, visited)
+
+    @staticmethod
+    def _add(node: TrieNode, brand_id: int, visited: set):
+        # 同じブランドの別の語が同じノードを通る場合に、二重に入れない
+        if id(node) in visited:
+            return
+        visited.add(id(node))
+        if len(node.top) < AUTOCOMPLETE_MAX_LIMIT:
+            node.top.append(brand_id)
+
+    # 3.入力で始まる(語の先頭が一致する)ブランドを人気順に最大limit件返す
+    def search(self, prefix: str, limit: int = 10):
+        node = self.root
+        for c in "".join(SEPARATORS.split(normalize_name(prefix))):
+            node = node.children.get(c)
+            if node is None:
+                return []
+        return [self.brands_by_id[brand_id] for brand_id in node.top[:limit]]
+
+
+# ブランドごとの人気(お気に入り登録数 + 購入本数)
+# 購入本数はpurchase_detailsを集計せずに、購入後のジョブで集計し直しているbrand_purchase_countsを読む(db_control/purchase_counts.py)
+def load_brand_popularity(db: Session):
+    popularity = {}
+    for brand_id, count in db.execute(select(Favorite.brand_id, func.count()).group_by(Favorite.brand_id)).all():
+        popularity[brand_id] = popularity.get(brand_id, 0) + count
+    for brand_id, quantity in load_purchase_counts(db).items():
+        popularity[brand_id] = popularity.get(brand_id, 0) + quantity
+    return popularity
+
+
+_trie = None
+_lock = threading.Lock()
+# 作り直しのジョブが実行中の間は持っておく(実行待ちの間はジョブのkeyで重ねて投入しない)
+_rebuild_lock = threading.Lock()
+
+
+def is_fresh(trie: BrandTrie, catalog):
+    return trie.catalog is catalog and time.monotonic() - trie.built_at < AUTOCOMPLETE_MAX_AGE_SECONDS
+
+
+# 4-1.トライ木を作り直して差し替えるジョブ(ほかのジョブが作り直し中、または作り直し済みなら何もしない)
+def rebuild_brand_trie_job(new_session):
+    global _trie
+    if not _rebuild_lock.acquire(blocking=False):
+        return
+    db = new_session()
+    try:
+        catalog = get_catalog(db)
+        trie = _trie
+        if trie is None or not is_fresh(trie, catalog):
+            _trie = BrandTrie(catalog.brands, load_brand_popularity(db), catalog)  # 参照の代入なので、読み手から見て差し替えは一瞬で終わる
+    finally:
+        db.close()
+        _rebuild_lock.release()
+
+
+# 4.現在のトライ木を返す
+# マスタが差し替わったか古くなった場合は、作り直すジョブを投入して今のトライ木をそのまま返す(まだ無い場合だけその場で作る)
+def get_brand_trie(db: Session):
+    global _trie
+    catalog = get_catalog(db)
+    trie = _trie
+    if trie is None:
+        with _lock:
+            if _trie is None:
+                _trie = BrandTrie(catalog.brands, load_brand_popularity(db), catalog)
+            return _trie
+
+    if not is_fresh(trie, catalog) and not _rebuild_lock.locked():
+        job_queue.submit("rebuild_brand_trie", rebuild_brand_trie_job, session_factory(db), key="brand_trie")
+    return trie
+
+
+# 入力中の文字列で始まるブランドを人気順に返す(qが空の場合は全体の人気順)
+@router.get("/autocomplete/brands", response_model=List[AutocompleteBrand])
+def autocomplete_brands(q: str = "", limit: int = Query(10, ge=1, le=AUTOCOMPLETE_MAX_LIMIT), db: Session = Depends(get_db)):
+    trie = get_brand_trie(db)
+    return [
+        {"brand_id": brand.brand_id, "brand_name": brand.brand_name, "category": brand.category, "popularity": trie.popularity.get(brand.brand_id, 0)}
+        for brand in trie.search(q, limit)
+    ]
@@ -0,0 +1,116 @@
+# survey_raw_datasを集計したブランド・項目ごとの平均スコア(brand_average_scores)を作り直す・読む
+# survey_raw_datasが正で、brand_average_scoresはそこから作る(DBのテーブルなので、どのワーカーから読んでも同じ値になる)
+# アンケートの回答後・回答完了後はジョブ(refresh_brand_average_scores_job)で該当するブランドの行を作り直す(同じブランドのジョブは重ねて投入しない)
+# 集計した行が無いブランドや、BRAND_AVERAGE_SCORES_MAX_AGE_SECONDSより古いブランドはsurvey_raw_datasからその場で集計し、作り直すジョブを投入する
+# (ジョブが投入できなかった・失敗した場合や、ORMを通さずにsurvey_raw_datasを書き換えた場合も、この時間が経てば反映される)
+# backendディレクトリで以下のように実行する(テーブルが無ければ作成し、全ブランドの分を集計し直す)
+#   python -m db_control.average_scores
+#   python -m db_control.average_scores --db-url sqlite:///local.db
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, delete, func, select
+from sqlalchemy.orm import Session
+
+from db_control.jobs import job_queue, session_factory
+from db_control.mymodels import BrandAverageScore, SurveyRawData
+
+# 環境変数のロード
+load_dotenv()
+# 集計した行をそのまま使う最大の秒数。これより古いブランドはその場で集計し直す
+BRAND_AVERAGE_SCORES_MAX_AGE_SECONDS = float(os.getenv("BRAND_AVERAGE_SCORES_MAX_AGE_SECONDS", "3600"))
+
+
+# 1.survey_raw_datasから指定したブランド(Noneなら全ブランド)の平均スコアを1回のクエリで集計する
+#   brand_id -> {item_id: (平均スコア, 回答数)} を返す(回答の無いブランドは空のdict)
+def compute_average_scores(db: Session, brand_ids=None):
+    query = select(SurveyRawData.brand_id, SurveyRawData.item_id, func.avg(SurveyRawData.score), func.count()).group_by(SurveyRawData.brand_id, SurveyRawData.item_id)
+    if brand_ids is not None:
+        query = query.where(SurveyRawData.brand_id.in_(brand_ids))
+    computed = {brand_id: {} for brand_id in brand_ids or []}
+    for brand_id, item_id, avg_score, count in db.execute(query):
+        computed.setdefault(brand_id, {})[item_id] = (avg_score, count)
+    return computed
+
+
+# 2.指定したブランド(Noneなら全ブランド)のbrand_average_scoresの行を作り直す(コミットは呼び出し側で行う)。作った行数を返す
+def refresh_average_scores(db: Session, brand_ids=None):
+    computed = compute_average_scores(db, brand_ids)
+    now = datetime.now()
+    rows = [
+        {"brand_id": brand_id, "item_id": item_id, "average_score": avg_score, "response_count": count, "updated_at": now}
+        for brand_id, scores in computed.items()
+        for item_id, (avg_score, count) in scores.items()
+    ]
+    statement = delete(BrandAverageScore)
+    if brand_ids is not None:
+        statement = statement.where(BrandAverageScore.brand_id.in_(brand_ids))
+    db.execute(statement)
+    if rows:
+        db.execute(BrandAverageScore.__table__.insert(), rows)
+    return len(rows)
+
+
+# 2-1.アンケート回答後・回答完了後のジョブ: ブランドの行を作り直してコミットする(何度実行しても同じ結果になる)
+def refresh_brand_average_scores_job(brand_id: int, new_session):
+    db = new_session()
+    try:
+        refresh_average_scores(db, [brand_id])
+        db.commit()
+    finally:
+        db.close()
+
+
+# 2-2.ブランドごとに作り直すジョブを投入する(同じブランドのジョブが実行を待っていれば投入しない)
+def submit_average_scores_refresh(brand_ids, db: Session):
+    for brand_id in sorted(set(brand_ids)):
+        job_queue.submit("refresh_brand_average_scores", refresh_brand_average_scores_job, brand_id, session_factory(db), key=brand_id)
+
+
+# 3.指定したブランドの平均スコア(brand_id -> {item_id: 平均スコア})を返す
+#   集計した行を読み、無いブランド・古いブランドはまとめて1回のクエリでその場で集計し、作り直すジョブを投入する
+def get_average_scores(db: Session, brand_ids):
+    brand_ids = list(dict.fromkeys(brand_ids))
+    if not brand_ids:
+        return {}
+    oldest = datetime.now() - timedelta(seconds=BRAND_AVERAGE_SCORES_MAX_AGE_SECONDS)
+    stored = {}
+    stale = set()
+    rows = db.execute(
+        select(BrandAverageScore.brand_id, BrandAverageScore.item_id, BrandAverageScore.average_score, BrandAverageScore.updated_at)
+        .where(BrandAverageScore.brand_id.in_(brand_ids))
+    )
+    for brand_id, item_id, avg_score, updated_at in rows:
+        stored.setdefault(brand_id, {})[item_id] = avg_score
+        if updated_at < oldest:
+            stale.add(brand_id)
+
+    missing = [brand_id for brand_id in brand_ids if brand_id not in stored or brand_id in stale]
+    if missing:
+        answered = []
+        for brand_id, scores in compute_average_scores(db, missing).items():
+            stored[brand_id] = {item_id: avg_score for item_id, (avg_score, _) in scores.items()}
+            # 回答のあるブランドだけ作り直す(回答の無いブランドは行が無いので、次も集計する。インデックスで空と分かるだけなので軽い)
+            if scores:
+                answered.append(brand_id)
+        submit_average_scores_refresh(answered, db)
+    return {brand_id: stored[brand_id] for brand_id in brand_ids}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild brand_average_scores from survey_raw_datas")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    BrandAverageScore.__table__.create(engine, checkfirst=True)
+    with Session(engine) as db:
+        count = refresh_average_scores(db)
+        db.commit()
+    print(f"brand_average_scores: {count} rows")
@@ -0,0 +1,329 @@
+# items, brands(画像なし), ec_brands(画像なし), ec_setsの小さなマスタをプロセス内に丸ごと持っておくスナップショット
+# リクエストのたびにMySQLへ問い合わせずに済むように、idやcategoryで引けるインデックスも一緒に作っておく
+# スナップショットは読み取り専用で、再読み込み時は新しいものを作ってから差し替える(読み手は常に一貫した内容を見る)
+# luxury/budgetのリコメンド用に、カテゴリごとの価格順のbrand_idの配列(PriceTiers)もここで作っておく
+import math
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from types import MappingProxyType
+
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, Header, HTTPException
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from db_control.connect import get_db
+from db_control.mymodels import Item, Brand, EC_Brand, EC_Set
+
+# 環境変数のロード
+load_dotenv()
+# DB側のバージョン(件数・最大id・価格の合計)を確認する間隔(秒)
+CATALOG_VERSION_CHECK_SECONDS = float(os.getenv("CATALOG_VERSION_CHECK_SECONDS", "30"))
+# バージョンが変わっていなくても、この秒数を過ぎたら読み直す(名前や説明だけの変更を拾うため)
+CATALOG_MAX_AGE_SECONDS = float(os.getenv("CATALOG_MAX_AGE_SECONDS", "600"))
+# 再読み込みAPIの認証キー(X-Admin-Key ヘッダーに指定する。未設定ならAPIは使えない)
+CATALOG_ADMIN_KEY = os.getenv("CATALOG_ADMIN_KEY")
+
+router = APIRouter()
+
+
+class ItemRecord:
+    __slots__ = ("item_id", "item_name")
+
+    def __init__(self, item_id, item_name):
+        self.item_id = item_id
+        self.item_name = item_name
+
+
+class BrandRecord:
+    __slots__ = ("brand_id", "brand_name", "category", "manufacturer_id")
+
+    def __init__(self, brand_id, brand_name, category, manufacturer_id):
+        self.brand_id = brand_id
+        self.brand_name = brand_name
+        self.category = category
+        self.manufacturer_id = manufacturer_id
+
+
+class ECBrandRecord:
+    __slots__ = ("ec_brand_id", "brand_id", "category", "name", "description", "price")
+
+    def __init__(self, ec_brand_id, brand_id, category, name, description, price):
+        self.ec_brand_id = ec_brand_id
+        self.brand_id = brand_id
+        self.category = category
+        self.name = name
+        self.description = description
+        self.price = price
+
+
+class ECSetRecord:
+    __slots__ = ("ec_set_id", "category", "set_name", "set_description", "algorithm_func")
+
+    def __init__(self, ec_set_id, category, set_name, set_description, algorithm_func):
+        self.ec_set_id = ec_set_id
+        self.category = category
+        self.set_name = set_name
+        self.set_description = set_description
+        self.algorithm_func = algorithm_func
+
+
+# brand_idsの各要素がselected_brand_idsに含まれるかのboolの配列(要素ごとにPythonで調べずにnp.isinで求める)
+def brand_id_mask(brand_ids: np.ndarray, selected_brand_ids):
+    selected = set(selected_brand_ids)
+    if not selected:
+        return np.zeros(len(brand_ids), dtype=bool)
+    return np.isin(brand_ids, np.fromiter(selected, dtype=np.int64, count=len(selected)))
+
+
+# 1カテゴリのEC_Brandのbrand_idを価格順に並べた配列(価格が同じものはec_brand_id順)
+class PriceTiers:
+    __slots__ = ("brand_ids_by_price_desc", "brand_ids_by_price_asc")
+
+    def __init__(self, ec_brands):
+        ec_brands = [x for x in ec_brands if x.brand_id is not None]
+        self.brand_ids_by_price_desc = np.array([x.brand_id for x in sorted(ec_brands, key=lambda x: x.price, reverse=True)], dtype=np.int64)
+        self.brand_ids_by_price_asc = np.array([x.brand_id for x in sorted(ec_brands, key=lambda x: x.price)], dtype=np.int64)
+
+    # 価格の高い方の半分(小数点以下切り上げ)のbrand_id。除外するbrand_idは半分に分ける前に除く
+    def upper_half(self, excluded_brand_ids=()):
+        return half(self.brand_ids_by_price_desc, excluded_brand_ids)
+
+    # 価格の安い方の半分(小数点以下切り上げ)のbrand_id
+    def lower_half(self, excluded_brand_ids=()):
+        return half(self.brand_ids_by_price_asc, excluded_brand_ids)
+
+
+def half(brand_ids: np.ndarray, excluded_brand_ids):
+    if excluded_brand_ids:
+        brand_ids = brand_ids[~brand_id_mask(brand_ids, excluded_brand_ids)]
+    return brand_ids[: math.ceil(len(brand_ids) / 2)]
+
+
+EMPTY_PRICE_TIERS = PriceTiers(())
+EMPTY_IDS = (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+
+# 1カテゴリのEC_Brand(brand_idがあるもの)の(ec_brand_idの配列, brand_idの配列)。ec_brand_id順
+def category_ids(ec_brands):
+    ec_brands = [x for x in ec_brands if x.brand_id is not None]
+    return np.array([x.ec_brand_id for x in ec_brands], dtype=np.int64), np.array([x.brand_id for x in ec_brands], dtype=np.int64)
+
+
+def group_by(records, key: str):
+    groups = {}
+    for record in records:
+        groups.setdefault(getattr(record, key), []).append(record)
+    return MappingProxyType({k: tuple(v) for k, v in groups.items()})
+
+
+class CatalogSnapshot:
+    __slots__ = (
+        "version",
+        "loaded_at",
+        "items",
+        "items_by_id",
+        "brands",
+        "brands_by_id",
+        "brands_by_category",
+        "ec_brands",
+        "ec_brands_by_id",
+        "ec_brands_by_brand_id",
+        "ec_brands_by_category",
+        "price_tiers_by_category",
+        "ec_brand_ids_by_category",
+        "ec_sets",
+        "ec_sets_by_category",
+    )
+
+    def __init__(self, version, items, brands, ec_brands, ec_sets, loaded_at=None):
+        self.version = version
+        self.loaded_at = time.time() if loaded_at is None else loaded_at
+
+        # 一覧はid順のタプル、idやcategoryからの索引は読み取り専用のdictにしておく
+        self.items = tuple(sorted(items, key=lambda x: x.item_id))
+        self.items_by_id = MappingProxyType({x.item_id: x for x in self.items})
+
+        self.brands = tuple(sorted(brands, key=lambda x: x.brand_id))
+        self.brands_by_id = MappingProxyType({x.brand_id: x for x in self.brands})
+        self.brands_by_category = group_by(self.brands, "category")
+
+        self.ec_brands = tuple(sorted(ec_brands, key=lambda x: x.ec_brand_id))
+        self.ec_brands_by_id = MappingProxyType({x.ec_brand_id: x for x in self.ec_brands})
+        self.ec_brands_by_brand_id = group_by(self.ec_brands, "brand_id")
+        self.ec_brands_by_category = group_by(self.ec_brands, "category")
+        self.price_tiers_by_category = MappingProxyType({k: PriceTiers(v) for k, v in self.ec_brands_by_category.items()})
+        self.ec_brand_ids_by_category = MappingProxyType({k: category_ids(v) for k, v in self.ec_brands_by_category.items()})
+
+        self.ec_sets = tuple(sorted(ec_sets, key=lambda x: (x.ec_set_id, x.category)))
+        self.ec_sets_by_category = group_by(self.ec_sets, "category")
+
+    # brand_idのいずれかに一致するEC_Brandをec_brand_id順で返す
+    def ec_brands_for_brand_ids(self, brand_ids):
+        brand_ids = set(brand_ids)
+        return [x for x in self.ec_brands if x.brand_id in brand_ids]
+
+    # ec_brand_idのいずれかに一致するEC_Brandをec_brand_id順で返す
+    def ec_brands_for_ids(self, ec_brand_ids):
+        ec_brand_ids = set(ec_brand_ids)
+        return [x for x in self.ec_brands if x.ec_brand_id in ec_brand_ids]
+
+    # categoryが一致し、brand_idがexclude_brand_idsに含まれないEC_Brandからk個をランダムに選ぶ(全件がk個以下ならすべて)
+    # idの配列から候補を絞って選び、選ばれたものだけレコードに戻す
+    def sample_ec_brands_in_category(self, category: str, k: int, exclude_brand_ids=(), rng: random.Random = random):
+        ec_brand_ids, brand_ids = self.ec_brand_ids_by_category.get(category, EMPTY_IDS)
+        candidates = ec_brand_ids[~brand_id_mask(brand_ids, exclude_brand_ids)].tolist()
+        if len(candidates) > k:
+            candidates = [candidates[i] for i in rng.sample(range(len(candidates)), k)]
+        return [self.ec_brands_by_id[ec_brand_id] for ec_brand_id in candidates]
+
+    # categoryの価格順のbrand_id(マスタを読み直したときに作り直される)
+    def price_tiers(self, category: str):
+        return self.price_tiers_by_category.get(category, EMPTY_PRICE_TIERS)
+
+    # ブランド名の部分一致検索(大文字小文字を区別しない。DBのILIKE '%term%'に相当)
+    def search_brands(self, search_term: str):
+        term = search_term.casefold()
+        return [x for x in self.brands if term in x.brand_name.casefold()]
+
+    def age_seconds(self):
+        return time.time() - self.loaded_at
+
+    # スナップショットが使っているおおよそのメモリ量(バイト)
+    def memory_bytes(self):
+        seen = set()
+        total = 0
+        stack = [getattr(self, name) for name in self.__slots__]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+            if isinstance(obj, MappingProxyType):
+                obj = dict(obj)
+                total += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (tuple, list)):
+                stack.extend(obj)
+            elif hasattr(obj, "__slots__"):
+                stack.extend(getattr(obj, name) for name in obj.__slots__)
+        return total
+
+
+# 1.DB側のマスタのバージョン(件数・最大id・価格の合計)を1回のクエリで取得する
+def get_catalog_version(db: Session):
+    query = select(
+        select(func.count()).select_from(Item).scalar_subquery(),
+        select(func.max(Item.item_id)).scalar_subquery(),
+        select(func.count()).select_from(Brand).scalar_subquery(),
+        select(func.max(Brand.brand_id)).scalar_subquery(),
+        select(func.count()).select_from(EC_Brand).scalar_subquery(),
+        select(func.max(EC_Brand.ec_brand_id)).scalar_subquery(),
+        select(func.sum(EC_Brand.price)).scalar_subquery(),
+        select(func.count()).select_from(EC_Set).scalar_subquery(),
+        select(func.max(EC_Set.ec_set_id)).scalar_subquery(),
+    )
+    # MySQLではSUMがDecimalで返るのでintにそろえておく
+    return tuple(None if value is None else int(value) for value in db.execute(query).one())
+
+
+# 2.DBからマスタを読み込んでスナップショットを作る(画像の列は読まない)
+def load_catalog(db: Session):
+    version = get_catalog_version(db)
+    items = [ItemRecord(*row) for row in db.execute(select(Item.item_id, Item.item_name)).all()]
+    brands = [BrandRecord(*row) for row in db.execute(select(Brand.brand_id, Brand.brand_name, Brand.category, Brand.manufacturer_id)).all()]
+    ec_brands = [
+        ECBrandRecord(*row)
+        for row in db.execute(select(EC_Brand.ec_brand_id, EC_Brand.brand_id, EC_Brand.category, EC_Brand.name, EC_Brand.description, EC_Brand.price)).all()
+    ]
+    ec_sets = [ECSetRecord(*row) for row in db.execute(select(EC_Set.ec_set_id, EC_Set.category, EC_Set.set_name, EC_Set.set_description, EC_Set.algorithm_func)).all()]
+    return CatalogSnapshot(version, items, brands, ec_brands, ec_sets)
+
+
+_snapshot = None
+_last_checked = 0.0
+_reload_count = 0
+_lock = threading.Lock()
+
+
+# 3.現在のスナップショットを差し替える
+def reload_catalog(db: Session):
+    global _snapshot, _last_checked, _reload_count
+    with _lock:
+        snapshot = load_catalog(db)
+        _snapshot = snapshot  # 参照の代入なので、読み手から見て差し替えは一瞬で終わる
+        _last_checked = time.monotonic()
+        _reload_count += 1
+    return snapshot
+
+
+# 3-1.DBから読まずに作ったスナップショット(起動時にリコメンド用のスナップショットから作ったもの)を使い始める
+# まだスナップショットが無い場合だけ差し替える。最初のget_catalogでDB側のバージョンを確認し、違っていれば読み直す
+def install_catalog(snapshot: CatalogSnapshot):
+    global _snapshot, _last_checked
+    with _lock:
+        if _snapshot is not None:
+            return _snapshot
+        _snapshot = snapshot
+        _last_checked = 0.0
+    return snapshot
+
+
+# 4.現在のスナップショットを返す
+# 一定間隔でDB側のバージョンを確認し、変わっていた(または古くなりすぎた)場合は読み直す
+def get_catalog(db: Session):
+    global _last_checked
+    snapshot = _snapshot
+    if snapshot is None:
+        return reload_catalog(db)
+
+    if time.monotonic() - _last_checked < CATALOG_VERSION_CHECK_SECONDS:
+        return snapshot
+
+    with _lock:
+        # 他のスレッドが確認済みならそのまま使う
+        if time.monotonic() - _last_checked < CATALOG_VERSION_CHECK_SECONDS:
+            return _snapshot
+        _last_checked = time.monotonic()
+
+    if get_catalog_version(db) != snapshot.version or snapshot.age_seconds() > CATALOG_MAX_AGE_SECONDS:
+        return reload_catalog(db)
+    return snapshot
+
+
+def catalog_stats(snapshot: CatalogSnapshot):
+    return {
+        "version": list(snapshot.version),
+        "age_seconds": snapshot.age_seconds(),
+        "memory_bytes": snapshot.memory_bytes(),
+        "reload_count": _reload_count,
+        "items": len(snapshot.items),
+        "brands": len(snapshot.brands),
+        "ec_brands": len(snapshot.ec_brands),
+        "ec_sets": len(snapshot.ec_sets),
+    }
+
+
+# スナップショットの状態(バージョン・経過時間・メモリ量)を返す
+@router.get("/catalog/stats")
+def get_catalog_stats(db: Session = Depends(get_db)):
+    return catalog_stats(get_catalog(db))
+
+
+def verify_admin_key(x_admin_key: str | None = Header(None)):
+    if not CATALOG_ADMIN_KEY or x_admin_key is None or not secrets.compare_digest(x_admin_key, CATALOG_ADMIN_KEY):
+        raise HTTPException(status_code=403, detail="Reload is not allowed")
+
+
+# マスタを更新した直後などに、スナップショットをすぐに読み直す(X-Admin-Key ヘッダーにCATALOG_ADMIN_KEYを指定)
+@router.post("/catalog/reload", dependencies=[Depends(verify_admin_key)])
+def post_catalog_reload(db: Session = Depends(get_db)):
+    return catalog_stats(reload_catalog(db))
@@ -1,10 +1,88 @@
 import platform
+import sys
 
 print(platform.uname())
 
-from mymodels import Base  # , User, Comment
+from sqlalchemy import delete, func, inspect, select, text
+
+from mymodels import Base, Favorite  # , User, Comment
 from connect import engine
 
+
+# ユニークインデックス(uq_favorites_user_id_brand_id)を作る前に、同じ(user_id, brand_id)の重複したお気に入りを消す
+# 最初に登録したもの(favorite_idが最小のもの)を残す。消した行数を返す
+def dedupe_favorites(connection):
+    duplicated = (
+        select(Favorite.user_id, Favorite.brand_id)
+        .group_by(Favorite.user_id, Favorite.brand_id)
+        .having(func.count() > 1)
+    )
+    keys = set(connection.execute(duplicated).all())
+    if not keys:
+        return 0
+
+    rows = connection.execute(
+        select(Favorite.favorite_id, Favorite.user_id, Favorite.brand_id)
+        .where(Favorite.user_id.in_({user_id for user_id, _ in keys}))
+        .order_by(Favorite.favorite_id)
+    ).all()
+    seen = set()
+    removed = []
+    for favorite_id, user_id, brand_id in rows:
+        if (user_id, brand_id) not in keys:
+            continue
+        if (user_id, brand_id) in seen:
+            removed.append(favorite_id)
+        seen.add((user_id, brand_id))
+    connection.execute(delete(Favorite).where(Favorite.favorite_id.in_(removed)))
+    return len(removed)
+
+
 print("Creating tables >>> ")
 Base.metadata.create_all(bind=engine)
-print("Tables created successfully.")
\ No newline at end of file
+print("Tables created successfully.")
+
+# 既存のテーブルにはcreate_allで列が追加されないので、足りない列(NULLを許す列だけ)を個別に追加する
+# (画像の*_hash列など。追加した列は空のままなので、必要なら db_control/images.py のバックフィルで埋める)
+print("Adding columns >>> ")
+inspector = inspect(engine)
+failures = 0
+for table in Base.metadata.sorted_tables:
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        if not column.nullable:
+            failures += 1
+            print(f"  cannot add NOT NULL column {table.name}.{column.name}; migrate it manually")
+            continue
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)} NULL"))
+        print(f"  added {table.name}.{column.name}")
+
+# 既存のテーブルにはcreate_allでインデックスが追加されないので、足りないものを個別に作成する
+print("Creating indexes >>> ")
+inspector = inspect(engine)
+for table in Base.metadata.sorted_tables:
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        try:
+            if table.name == Favorite.__tablename__ and index.unique:
+                with engine.begin() as connection:
+                    removed = dedupe_favorites(connection)
+                if removed:
+                    print(f"  removed {removed} duplicate rows from {table.name}")
+            index.create(bind=engine)
+            print(f"  created {index.name} on {table.name}")
+        except Exception as e:
+            failures += 1
+            print(f"  failed to create {index.name} on {table.name}: {e}")
+
+# 列・インデックスが1つでも作れなければ、成功と表示せずに終了コード1で終わる
+# (お気に入りの重複はユニークインデックスで弾いているので、作れていないまま運用しない)
+if failures:
+    print(f"{failures} columns or indexes could not be created.")
+    sys.exit(1)
+print("Indexes created successfully.")
@@ -1,5 +1,8 @@
+from datetime import datetime
 from sqlalchemy.orm import Session
-from .mymodels import User, Photo, Post, EC_Set, Brand, Preference, Item, Favorite
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .mymodels import User, Photo, Post, EC_Set, Brand, Preference, Item, Favorite, PreferenceVersion
 
 
 def get_user(db: Session, user_id: int):
@@ -10,12 +13,26 @@ def get_user_photos(db: Session, user_id: int):
     return db.query(Photo).join(Post).filter(Post.user_id == user_id).all()
 
 
+def get_user_photo_ids(db: Session, user_id: int):
+    return [photo_id for (photo_id,) in db.query(Photo.photo_id).join(Post).filter(Post.user_id == user_id).order_by(Photo.photo_id).all()]
+
+
 def get_user_preferences(db: Session, user_id: int):
     return db.query(Preference).filter(Preference.user_id == user_id).join(Item, Preference.item_id == Item.item_id).all()
 
 
-def get_user_favorites(db: Session, user_id: int):
-    return db.query(Brand).join(Brand.favorites).filter(Brand.favorites.any(user_id=user_id)).all()
+# お気に入りのブランドを登録順(favorite_id順)に返す。favoritesとbrandsを1回のJOINで取得し、画像の列は読まない
+def get_user_favorites(db: Session, user_id: int, limit: int | None = None, offset: int = 0):
+    query = (
+        db.query(Brand.brand_id, Brand.brand_name)
+        .join(Favorite, Favorite.brand_id == Brand.brand_id)
+        .filter(Favorite.user_id == user_id)
+        .order_by(Favorite.favorite_id)
+        .offset(offset)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return [{"brand_id": brand_id, "brand_name": brand_name} for brand_id, brand_name in query.all()]
 
 
 def add_user_favorite(db: Session, user_id: int, brand_id: int):
@@ -41,3 +58,39 @@ def update_user_preference(db: Session, user_id: int, item_id: int, score: float
         db.add(preference)
     db.commit()
     return preference
+
+
+# 好みのスコアをまとめて保存する(1つのINSERT ... ON DUPLICATE KEY UPDATEと1回のcommit)
+# 同じトランザクションでユーザーの好みのバージョン(preference_versions)を1増やす
+def bulk_upsert_user_preferences(db: Session, user_id: int, preferences: dict[int, float]):
+    now = datetime.now()
+    rows = [{"user_id": user_id, "item_id": item_id, "score": score} for item_id, score in preferences.items()]
+    dialect = db.get_bind().dialect.name
+
+    try:
+        if dialect == "mysql":
+            if rows:
+                stmt = mysql_insert(Preference).values(rows)
+                db.execute(stmt.on_duplicate_key_update(score=stmt.inserted.score))
+            stmt = mysql_insert(PreferenceVersion).values(user_id=user_id, version=1, updated_at=now)
+            db.execute(stmt.on_duplicate_key_update(version=PreferenceVersion.version + 1, updated_at=now))
+        elif dialect == "sqlite":
+            # ローカル検証用のSQLite
+            if rows:
+                stmt = sqlite_insert(Preference).values(rows)
+                db.execute(stmt.on_conflict_do_update(index_elements=["user_id", "item_id"], set_={"score": stmt.excluded.score}))
+            stmt = sqlite_insert(PreferenceVersion).values(user_id=user_id, version=1, updated_at=now)
+            db.execute(stmt.on_conflict_do_update(index_elements=["user_id"], set_={"version": PreferenceVersion.version + 1, "updated_at": now}))
+        else:
+            for row in rows:
+                db.merge(Preference(**row))
+            version = db.get(PreferenceVersion, user_id)
+            if version is None:
+                db.add(PreferenceVersion(user_id=user_id, version=1, updated_at=now))
+            else:
+                version.version += 1
+                version.updated_at = now
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
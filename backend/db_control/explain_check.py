@@ -0,0 +1,132 @@
+# よく使うクエリにEXPLAINをかけて、インデックスが使われずにテーブル全体のスキャンになっていないかを確認するツール
+# backendディレクトリで以下のように実行する(全スキャンになったクエリがあれば終了コード1で終わる)
+#   python -m db_control.explain_check
+#   python -m db_control.explain_check --db-url sqlite:///local.db
+#   python -m db_control.explain_check --min-rows 5000
+# MySQLでは対象テーブルが type=ALL で、見積もりの行数(rows)がFULL_SCAN_MIN_ROWS(--min-rows)を超える場合を全スキャンとみなす
+# (行数の少ないテーブルでは、インデックスがあってもオプティマイザが全件を読む方を選ぶことがあるため、それは問題にしない)
+# SQLiteでは対象テーブルが "SCAN <table>" になる場合を全スキャンとみなす(EXPLAIN QUERY PLANに行数の見積もりは出ない)
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, func, text
+
+from db_control.mymodels import Brand, SurveyVector, Purchase, PurchaseDetail, Favorite, EC_Brand, SurveyRawData
+
+# MySQLで type=ALL を全スキャンとみなす見積もりの行数の下限
+FULL_SCAN_MIN_ROWS = 1000
+
+
+# 1.チェック対象のクエリ(対象テーブル名, クエリ)。値は代表的なものを入れておく
+def hot_queries():
+    return [
+        (
+            # recommend.get_survey_vectors_from_dbと同じクエリ(brandsと結合してcategoryで絞り込む)
+            "recommend: survey_vectors by gender/age/category",
+            SurveyVector.__tablename__,
+            select(SurveyVector.brand_id, *[getattr(SurveyVector, f"score{i}") for i in range(1, 9)])
+            .join(Brand)
+            .where(
+                SurveyVector.age_lower_limit < 35,
+                SurveyVector.age_upper_limit > 35,
+                SurveyVector.gender == 0,
+                Brand.category == "national",
+            )
+            .order_by(SurveyVector.survey_id),
+        ),
+        (
+            "purchaselog: purchases by user ordered by date",
+            Purchase.__tablename__,
+            select(Purchase).where(Purchase.user_id == 1).order_by(Purchase.date_time.desc()).limit(5),
+        ),
+        (
+            "popularity: recent purchases by user",
+            Purchase.__tablename__,
+            select(Purchase).where(Purchase.user_id == 1, Purchase.date_time >= datetime.now() - timedelta(days=30)),
+        ),
+        (
+            "purchaselog: purchase_details by purchase",
+            PurchaseDetail.__tablename__,
+            select(PurchaseDetail).where(PurchaseDetail.purchase_id == 1),
+        ),
+        (
+            "favorites: favorite by user and brand",
+            Favorite.__tablename__,
+            select(Favorite).where(Favorite.user_id == 1, Favorite.brand_id == 1),
+        ),
+        (
+            "recommend: ec_brands by category and brand",
+            EC_Brand.__tablename__,
+            select(EC_Brand).where(EC_Brand.category == "national", EC_Brand.brand_id.in_([1, 2, 3])),
+        ),
+        (
+            "average_scores: survey_raw_datas by brand",
+            SurveyRawData.__tablename__,
+            select(SurveyRawData.item_id, func.avg(SurveyRawData.score)).where(SurveyRawData.brand_id == 1).group_by(SurveyRawData.item_id),
+        ),
+    ]
+
+
+# 2-1.MySQL: EXPLAINの結果から対象テーブルの行を見て、全スキャンかどうかを判定する
+def is_full_scan_mysql(connection, sql: str, table: str, min_rows: int):
+    rows = connection.execute(text(f"EXPLAIN {sql}")).mappings().all()
+    plan = [dict(row) for row in rows]
+    for row in plan:
+        if row.get("table") == table and row.get("type") == "ALL" and (row.get("rows") or 0) > min_rows:
+            return True, plan
+    return False, plan
+
+
+# 2-2.SQLite: EXPLAIN QUERY PLANの結果から対象テーブルが "SCAN <table>" になっていないかを判定する(min_rowsは使わない)
+def is_full_scan_sqlite(connection, sql: str, table: str, min_rows: int):
+    rows = connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    plan = [row[-1] for row in rows]
+    for detail in plan:
+        if detail == f"SCAN {table}" or detail.startswith(f"SCAN {table} "):
+            if "INDEX" not in detail:
+                return True, plan
+    return False, plan
+
+
+# 3.全クエリをチェックして、全スキャンになったクエリの数を返す
+def run(engine, min_rows: int = FULL_SCAN_MIN_ROWS):
+    dialect = engine.dialect.name
+    if dialect == "mysql":
+        is_full_scan = is_full_scan_mysql
+    elif dialect == "sqlite":
+        is_full_scan = is_full_scan_sqlite
+    else:
+        raise ValueError(f"Unsupported dialect: {dialect}")
+
+    failures = 0
+    with engine.connect() as connection:
+        for name, table, query in hot_queries():
+            sql = str(query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            full_scan, plan = is_full_scan(connection, sql, table, min_rows)
+            status = "FULL SCAN" if full_scan else "ok"
+            print(f"[{status}] {name}")
+            if full_scan:
+                failures += 1
+                for row in plan:
+                    print(f"    {row}")
+
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if a hot query degrades to a full table scan")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--min-rows", type=int, default=FULL_SCAN_MIN_ROWS, help="MySQL: only flag type=ALL when the estimated rows exceed this")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    failures = run(engine, args.min_rows)
+    if failures:
+        print(f"{failures} hot queries degraded to a full scan")
+        sys.exit(1)
+    print("All hot queries use an index")
@@ -0,0 +1,258 @@
+# 分析用にsurvey_raw_datasとpurchase_detailsをCSVまたはParquetで書き出す
+# サーバー側カーソルでchunk_size行ずつ読みながら書き出すので、テーブルが大きくなってもメモリ使用量は一定
+# API: GET /export/{table}?format=csv&start=2024-07-01&end=2024-07-31 (X-Export-Key ヘッダーにEXPORT_API_KEYを指定)
+# CLI: backendディレクトリで以下のように実行する
+#   python -m db_control.export survey_raw_datas --format parquet --start 2024-07-01 -o survey_raw_datas.parquet
+import argparse
+import csv
+import io
+import os
+import secrets
+import sys
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from db_control.connect import get_db
+from db_control.mymodels import SurveyRawData, Purchase, PurchaseDetail
+
+# 環境変数のロード
+load_dotenv()
+# エクスポートAPIの認証キー(未設定ならAPIは使えず、CLIのみ)
+EXPORT_API_KEY = os.getenv("EXPORT_API_KEY")
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+router = APIRouter()
+
+
+# 1.テーブルごとの書き出すクエリと、期間で絞り込む列
+# purchase_detailsには日付が無いので、purchasesと結合してdate_timeとuser_idも一緒に出す
+def export_query(table: str):
+    if table == "survey_raw_datas":
+        query = select(
+            SurveyRawData.raw_data_id,
+            SurveyRawData.item_id,
+            SurveyRawData.brand_id,
+            SurveyRawData.score,
+            SurveyRawData.age,
+            SurveyRawData.gender,
+            SurveyRawData.purchase_date,
+        ).order_by(SurveyRawData.raw_data_id, SurveyRawData.item_id)
+        return query, SurveyRawData.purchase_date
+    if table == "purchase_details":
+        query = (
+            select(
+                PurchaseDetail.purchase_id,
+                PurchaseDetail.detail_id,
+                Purchase.user_id,
+                Purchase.date_time,
+                PurchaseDetail.ec_set_id,
+                PurchaseDetail.ec_brand_id,
+                PurchaseDetail.category,
+                PurchaseDetail.name,
+                PurchaseDetail.price,
+                PurchaseDetail.quantity,
+            )
+            .join(Purchase, Purchase.purchase_id == PurchaseDetail.purchase_id)
+            .order_by(PurchaseDetail.purchase_id, PurchaseDetail.detail_id)
+        )
+        return query, Purchase.date_time
+    raise ValueError(f"Unknown table: {table}")
+
+
+EXPORT_TABLES = ("survey_raw_datas", "purchase_details")
+
+
+# 2.期間(両端を含む日付)で絞り込んだクエリを作る
+def filtered_query(table: str, start: date | None, end: date | None):
+    query, date_column = export_query(table)
+    is_datetime = date_column is Purchase.date_time
+    if start is not None:
+        query = query.where(date_column >= (datetime.combine(start, dt_time.min) if is_datetime else start))
+    if end is not None:
+        if is_datetime:
+            # date_timeは終了日の翌日0時より前
+            query = query.where(date_column < datetime.combine(end + timedelta(days=1), dt_time.min))
+        else:
+            query = query.where(date_column <= end)
+    return query
+
+
+# 3.サーバー側カーソルでchunk_size行ずつ(列, 行のリスト)を返すジェネレータ
+# 該当する行が無い場合も、ヘッダーやスキーマを書けるように空のチャンクを1つ返す
+def iter_chunks(bind, table: str, start: date | None, end: date | None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    query = filtered_query(table, start, end)
+    columns = list(query.selected_columns)
+    with Session(bind=bind) as db:
+        result = db.execute(query, execution_options={"stream_results": True, "yield_per": chunk_size})
+        empty = True
+        for rows in result.partitions():
+            empty = False
+            yield columns, rows
+        if empty:
+            yield columns, []
+
+
+# 4-1.CSV: チャンクごとにバイト列にして返す(先頭にヘッダー行)
+def iter_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = False
+    for columns, rows in chunks:
+        if not header_written:
+            writer.writerow([column.name for column in columns])
+            header_written = True
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+
+# ParquetWriterが書き込んだバイト列を溜めておき、チャンクを書くたびに取り出すための出力先
+class ChunkSink:
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+# SQLAlchemyの列の型からArrowの型を決める(チャンクごとに推論すると、NULLだけのチャンクで型がずれるため)
+def arrow_type(column):
+    import pyarrow as pa
+
+    python_type = column.type.python_type
+    if python_type is bool:
+        return pa.bool_()
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type is datetime:
+        return pa.timestamp("us")
+    if python_type is date:
+        return pa.date32()
+    return pa.string()
+
+
+# 4-2.Parquet: チャンクごとに1つのrow groupとして書き出して返す
+def iter_parquet(chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = ChunkSink()
+    writer = None
+    for columns, rows in chunks:
+        if writer is None:
+            schema = pa.schema([(column.name, arrow_type(column)) for column in columns])
+            writer = pq.ParquetWriter(sink, schema, compression="snappy")
+        table = pa.Table.from_pydict({column.name: [row[i] for row in rows] for i, column in enumerate(columns)}, schema=schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def render(file_format: str, chunks):
+    if file_format == "parquet":
+        return iter_parquet(chunks)
+    return iter_csv(chunks)
+
+
+def check_parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow to be installed")
+
+
+def verify_export_key(x_export_key: str | None = Header(None)):
+    if not EXPORT_API_KEY or x_export_key is None or not secrets.compare_digest(x_export_key, EXPORT_API_KEY):
+        raise HTTPException(status_code=403, detail="Export is not allowed")
+
+
+# 分析用データの書き出し(ストリーミング)
+@router.get("/export/{table}", dependencies=[Depends(verify_export_key)])
+def export_table(
+    table: str,
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    start: date | None = Query(None, description="この日付以降(purchase_date / date_time)"),
+    end: date | None = Query(None, description="この日付まで(当日を含む)"),
+    db: Session = Depends(get_db),
+):
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Table not found")
+    if format == "parquet":
+        check_parquet_available()
+
+    media_type, extension = FORMATS[format]
+    # リクエストのセッションはレスポンスの送信前に閉じられることがあるので、iter_chunksは同じ接続先で専用のセッションを開く
+    chunks = iter_chunks(db.get_bind(), table, start, end)
+    return StreamingResponse(
+        render(format, chunks),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{extension}"'},
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export survey_raw_datas or purchase_details for offline analysis")
+    parser.add_argument("table", choices=EXPORT_TABLES)
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--start", type=date.fromisoformat, help="first date to include (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="last date to include (YYYY-MM-DD)")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="rows fetched per round trip")
+    # connect.pyのimport時に接続確認のメッセージが標準出力に出るので、標準出力には書き出さない
+    parser.add_argument("-o", "--output", required=True, help="output file")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    start_time = time.perf_counter()
+    rows = 0
+
+    def counted(chunks):
+        global rows
+        for columns, chunk in chunks:
+            rows += len(chunk)
+            yield columns, chunk
+
+    with open(args.output, "wb") as output:
+        for data in render(args.format, counted(iter_chunks(engine, args.table, args.start, args.end, args.chunk_size))):
+            output.write(data)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Exported {rows} rows from {args.table} in {elapsed:.2f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)", file=sys.stderr)
@@ -0,0 +1,304 @@
+# 画像の縮小版(サムネイル)の作成と取得
+# アップロードされた画像はそのままのサイズでDBに入っているので、一覧表示用に幅を揃えたWebPを作ってimage_variantsに保存する
+# 元画像の行には画像のSHA-256(*_hash列)を持たせ、縮小版は作ったときのハッシュが一致するものだけを使う(元画像のBLOBは読まない)
+# ORMで画像の列(brand_picture, picture, user_picture, photo_data)を書き換えると、flushの中ではハッシュを付け直して古い縮小版を消すだけにし、
+# WebPへの変換はコミットの後にジョブ(db_control/jobs.py)で行う(リクエストの応答を変換で待たせない)
+# ORMを通さずに入れた画像(generate_dataなど)はハッシュが空なので、バックフィルでハッシュを付けて縮小版を作る
+# (ORMを通さずに画像を書き換える場合は、ハッシュを空にするか、バックフィルを--forceで実行する)
+# 既存データへの一括作成(バックフィル)はbackendディレクトリで以下のように実行する(ハッシュの列が無ければ追加する)
+#   python -m db_control.images --kind brand --kind ec_brand --batch-size 50
+import argparse
+import base64
+import hashlib
+import io
+import time
+from datetime import datetime
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sqlalchemy import select, delete, event, inspect, text, update
+from sqlalchemy.orm import Session
+
+from db_control.jobs import job_queue
+from db_control.mymodels import Brand, EC_Brand, User, Photo, ImageVariant
+
+# 作成する幅(px)。元画像より大きくはしない
+THUMBNAIL_WIDTHS = (128, 256, 512)
+# 一覧で使う幅(ロゴは最大でも w-28 = 112px で表示される)
+LIST_THUMBNAIL_WIDTH = 128
+# 投稿写真の一覧で使う幅(h-64 のカードで表示される)
+PHOTO_THUMBNAIL_WIDTH = 512
+WEBP_QUALITY = 80
+# 画像として読めなかった元画像の印(この幅の行はdataが空)
+UNDECODABLE_WIDTH = 0
+
+# image_kind -> (主キー列, 画像列, 画像のハッシュの列)
+IMAGE_SOURCES = {
+    "brand": (Brand.brand_id, Brand.brand_picture, Brand.brand_picture_hash),
+    "ec_brand": (EC_Brand.ec_brand_id, EC_Brand.picture, EC_Brand.picture_hash),
+    "user": (User.user_id, User.user_picture, User.user_picture_hash),
+    "photo": (Photo.photo_id, Photo.photo_data, Photo.photo_data_hash),
+}
+# モデル -> image_kind
+IMAGE_KINDS = {id_column.class_: image_kind for image_kind, (id_column, _, _) in IMAGE_SOURCES.items()}
+
+
+def source_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+# 元画像の先頭のバイト列から形式を判定する(縮小版が無く元画像を返す場合のMIMEタイプ。db_control/photos.pyでも使う)
+def guess_mime_type(data: bytes):
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+# 1.画像のバイト列から、幅ごとのWebPのバイト列を作る(画像として読めない場合は空のdict)
+def make_variants(data: bytes, widths=THUMBNAIL_WIDTHS):
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)  # スマホ写真の向きを反映しておく
+    except (UnidentifiedImageError, OSError):
+        return {}
+
+    # 透過はそのまま残し、それ以外はRGBにそろえる
+    image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+
+    variants = {}
+    for width in widths:
+        resized = image.copy()
+        if resized.width > width:
+            height = max(1, round(resized.height * width / resized.width))
+            resized = resized.resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=6)
+        variants[width] = buffer.getvalue()
+
+    return variants
+
+
+# 2.1枚の画像について縮小版を作り直して保存する(ジョブやバックフィルで使う。commitは呼び出し側で行う)
+# 画像として読めない場合は、次のバックフィルで読み直さないようにUNDECODABLE_WIDTHの行を印として残す
+def ingest_image(db: Session, image_kind: str, image_id: int, data: bytes | None):
+    db.execute(delete(ImageVariant).where(ImageVariant.image_kind == image_kind, ImageVariant.image_id == image_id))
+    if not data:
+        return {}
+
+    variants = make_variants(data)
+    now = datetime.now()
+    digest = source_hash(data)
+    rows = variants.items() if variants else [(UNDECODABLE_WIDTH, b"")]
+    for width, variant in rows:
+        db.add(
+            ImageVariant(
+                image_kind=image_kind,
+                image_id=image_id,
+                width=width,
+                mime_type="image/webp" if variants else "",
+                data=variant,
+                source_size=len(data),
+                source_hash=digest,
+                created_at=now,
+            )
+        )
+    return variants
+
+
+# 元画像の行のハッシュが空なら付ける(ほかのリクエストが先に付けていれば書き換えない)
+def fill_source_hash(db: Session, image_kind: str, image_id: int, digest: str, force: bool = False):
+    id_column, _, hash_column = IMAGE_SOURCES[image_kind]
+    statement = update(id_column.class_).where(id_column == image_id)
+    if not force:
+        statement = statement.where(hash_column.is_(None))
+    db.execute(statement.values({hash_column.key: digest}))
+
+
+# 2-1.ジョブ: 元画像を読み、縮小版が今の元画像のものでなければ作り直してコミットする(何度実行しても同じ結果になる)
+def ingest_image_job(image_kind: str, image_id: int, new_session):
+    id_column, data_column, hash_column = IMAGE_SOURCES[image_kind]
+    db = new_session()
+    try:
+        row = db.execute(select(data_column, hash_column).where(id_column == image_id)).first()
+        data, current_hash = row if row is not None else (None, None)
+        done_hash = db.execute(select(ImageVariant.source_hash).where(ImageVariant.image_kind == image_kind, ImageVariant.image_id == image_id).limit(1)).scalar()
+        if data and current_hash is not None and done_hash == current_hash:
+            return
+        if data and current_hash is None:
+            fill_source_hash(db, image_kind, image_id, source_hash(data))
+        ingest_image(db, image_kind, image_id, data)
+        db.commit()
+    finally:
+        db.close()
+
+
+# 2-2.ORMで画像の列を書き換えた(追加・変更・削除した)行を、flushの前に集め、ハッシュを付け直しておく(ハッシュの計算は変換に比べて十分軽い)
+@event.listens_for(Session, "before_flush")
+def _collect_changed_images(session, flush_context, instances):
+    changed = session.info.setdefault("changed_images", [])
+    for obj in list(session.new) + list(session.dirty):
+        if type(obj) not in IMAGE_KINDS:
+            continue
+        _, data_column, hash_column = IMAGE_SOURCES[IMAGE_KINDS[type(obj)]]
+        if obj not in session.new and not inspect(obj).attrs[data_column.key].history.has_changes():
+            continue
+        data = getattr(obj, data_column.key)
+        # レスポンス用にBase64の文字列を入れただけの行などは対象にしない
+        if data is not None and not isinstance(data, bytes):
+            continue
+        setattr(obj, hash_column.key, source_hash(data) if data else None)
+        changed.append((obj, not data))
+    for obj in session.deleted:
+        if type(obj) in IMAGE_KINDS:
+            changed.append((obj, True))
+
+
+# 2-3.flushの後(主キーが決まってから)に古い縮小版を消し、画像のある行はコミットの後に作り直すように覚えておく
+@event.listens_for(Session, "after_flush_postexec")
+def _invalidate_changed_images(session, flush_context):
+    changed = session.info.pop("changed_images", None)
+    pending = session.info.setdefault("images_to_ingest", set())
+    for obj, removed in changed or []:
+        image_kind = IMAGE_KINDS[type(obj)]
+        image_id = getattr(obj, IMAGE_SOURCES[image_kind][0].key)
+        session.execute(delete(ImageVariant).where(ImageVariant.image_kind == image_kind, ImageVariant.image_id == image_id))
+        if removed:
+            pending.discard((image_kind, image_id))
+        else:
+            pending.add((image_kind, image_id))
+
+
+# 2-4.コミットの後に縮小版を作るジョブを投入する(同じ画像のジョブが実行を待っていれば投入しない)。ロールバックした場合は作らない
+@event.listens_for(Session, "after_commit")
+def _submit_changed_images(session):
+    pending = session.info.pop("images_to_ingest", None)
+    if not pending:
+        return
+    bind = session.get_bind()
+    for image_kind, image_id in sorted(pending):
+        job_queue.submit("ingest_image", ingest_image_job, image_kind, image_id, lambda: Session(bind=bind), key=(image_kind, image_id))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_images(session):
+    session.info.pop("changed_images", None)
+    session.info.pop("images_to_ingest", None)
+
+
+# image_variants.source_hashと、元画像の行のハッシュの列が無ければ追加する。追加した列の名前を返す
+# (元画像のハッシュは空のまま追加されるので、バックフィルでハッシュを付けるまでは元画像を返す)
+def add_source_hash_columns(engine):
+    inspector = inspect(engine)
+    tables = [(ImageVariant.__tablename__, "source_hash")] + [(hash_column.class_.__tablename__, hash_column.key) for _, _, hash_column in IMAGE_SOURCES.values()]
+    added = []
+    for table, column in tables:
+        if column in {c["name"] for c in inspector.get_columns(table)}:
+            continue
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} VARCHAR(64) NULL"))
+        added.append(f"{table}.{column}")
+    return added
+
+
+# 3.既存の画像の縮小版をまとめて作る
+# 主キー順にbatch_size件ずつハッシュだけを読み、ハッシュが空か縮小版のハッシュと一致しない画像だけ元画像を読む
+# (一度にメモリに載る元画像はbatch_size枚まで)。forceなら全部の画像のハッシュを付け直して作り直す
+def backfill(db: Session, image_kind: str, batch_size: int = 50, force: bool = False):
+    id_column, data_column, hash_column = IMAGE_SOURCES[image_kind]
+    last_id = 0
+    processed = 0
+    source_bytes = 0
+    list_bytes = 0  # 一覧で使う幅の縮小版の合計サイズ
+
+    while True:
+        rows = db.execute(select(id_column, hash_column).where(id_column > last_id, data_column.is_not(None)).order_by(id_column).limit(batch_size)).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        # 元画像と同じハッシュの縮小版(読めなかった印を含む)がある画像は飛ばす
+        done_hashes = dict(
+            db.execute(
+                select(ImageVariant.image_id, ImageVariant.source_hash).where(ImageVariant.image_kind == image_kind, ImageVariant.image_id.in_([row[0] for row in rows])).distinct()
+            ).all()
+        )
+        current_hashes = dict(rows)
+        todo = [image_id for image_id, digest in rows if force or digest is None or done_hashes.get(image_id) != digest]
+
+        if todo:
+            for image_id, data in db.execute(select(id_column, data_column).where(id_column.in_(todo)).order_by(id_column)).all():
+                if not data:
+                    continue
+                if force or current_hashes[image_id] is None:
+                    fill_source_hash(db, image_kind, image_id, source_hash(data), force)
+                variants = ingest_image(db, image_kind, image_id, data)
+                processed += 1
+                source_bytes += len(data)
+                list_bytes += len(variants.get(LIST_THUMBNAIL_WIDTH, data))
+        db.commit()
+
+    return processed, source_bytes, list_bytes
+
+
+# 4.一覧表示用の画像を取得する
+# 4-1.指定したidの縮小版を1回のクエリでまとめて取得する({image_id: bytes})
+# 元画像の行のハッシュが縮小版を作ったときと違えば(同じサイズの画像に差し替えた場合も)、古い縮小版とみなして返さない
+# 比べるのはハッシュの列だけなので、元画像のBLOBは読まない
+def get_thumbnails(db: Session, image_kind: str, image_ids, width: int = LIST_THUMBNAIL_WIDTH):
+    image_ids = list(set(image_ids))
+    if not image_ids:
+        return {}
+    id_column, _, hash_column = IMAGE_SOURCES[image_kind]
+    rows = db.execute(
+        select(ImageVariant.image_id, ImageVariant.data)
+        .join(id_column.class_, id_column == ImageVariant.image_id)
+        .where(
+            ImageVariant.image_kind == image_kind,
+            ImageVariant.width == width,
+            ImageVariant.image_id.in_(image_ids),
+            ImageVariant.source_hash == hash_column,
+        )
+    ).all()
+    return {image_id: data for image_id, data in rows}
+
+
+# 4-2.縮小版があればそれを、なければ元画像をBase64にして、MIMEタイプと一緒に返す({image_id: (str, mime_type)})
+def get_list_pictures_base64(db: Session, image_kind: str, image_ids, width: int = LIST_THUMBNAIL_WIDTH):
+    pictures = {image_id: (data, "image/webp") for image_id, data in get_thumbnails(db, image_kind, image_ids, width).items()}
+
+    # 縮小版がまだ作られていない画像は元画像を使う
+    missing_ids = [image_id for image_id in set(image_ids) if image_id not in pictures]
+    if missing_ids:
+        id_column, data_column, _ = IMAGE_SOURCES[image_kind]
+        rows = db.execute(select(id_column, data_column).where(id_column.in_(missing_ids), data_column.is_not(None))).all()
+        pictures.update({image_id: (data, guess_mime_type(data)) for image_id, data in rows if data})
+
+    return {image_id: (base64.b64encode(data).decode('utf-8'), mime_type) for image_id, (data, mime_type) in pictures.items()}
+
+
+if __name__ == "__main__":
+    from db_control.connect import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(description="Generate WebP thumbnail variants for stored images")
+    parser.add_argument("--kind", action="append", choices=sorted(IMAGE_SOURCES), help="image kind to process (repeatable, default: all)")
+    parser.add_argument("--batch-size", type=int, default=50, help="source images loaded per batch")
+    parser.add_argument("--force", action="store_true", help="regenerate variants that already exist")
+    args = parser.parse_args()
+
+    for column in add_source_hash_columns(engine):
+        print(f"added {column}")
+
+    db = SessionLocal()
+    try:
+        for image_kind in args.kind or sorted(IMAGE_SOURCES):
+            start = time.perf_counter()
+            processed, source_bytes, list_bytes = backfill(db, image_kind, args.batch_size, args.force)
+            elapsed = time.perf_counter() - start
+            print(f"{image_kind}: {processed} images in {elapsed:.2f}s, originals {source_bytes / 1024:.0f} KiB -> {LIST_THUMBNAIL_WIDTH}px thumbnails {list_bytes / 1024:.0f} KiB")
+    finally:
+        db.close()
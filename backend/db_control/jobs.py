@@ -0,0 +1,262 @@
+# リクエストの応答を待たせずに済む後処理(アンケート回答後のブランドの平均スコアの集計など)を、
+# プロセス内のスレッドで順に実行するジョブキュー(外部のブローカーは使わない)
+# キューの長さには上限があり、いっぱいのときは投入を断る(リクエスト側は待たない)
+# 失敗したジョブは間隔を倍にしながら再試行し、上限回数を超えたら諦める(再試行待ちのジョブはヒープに入れておき、専用のスレッドが時刻になったらキューに戻す)
+# アプリの起動時(lifespan)にワーカーを起動し、終了時は投入を止めてから残りのジョブを実行し終えるまで待つ
+# ワーカーが起動していない場合(lifespanを通さないテストやスクリプト)は、投入した時点でその場で実行する
+# keyを指定したジョブは、同じ名前・keyのジョブが実行を待っている間は重ねて投入しない(同じブランドの集計を何度も積まない)
+import heapq
+import os
+import threading
+import time
+from collections import deque
+from queue import Full, Queue
+
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import APIRouter
+from sqlalchemy.orm import Session
+
+# 環境変数のロード
+load_dotenv()
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# 失敗したときに再試行する回数と、1回目の再試行までの秒数(以降は倍にする)
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", "3"))
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "0.5"))
+# 終了時に残りのジョブを待つ最大の秒数
+JOB_DRAIN_TIMEOUT_SECONDS = float(os.getenv("JOB_DRAIN_TIMEOUT_SECONDS", "10"))
+# レイテンシの集計に使う直近のジョブの数(ジョブの名前ごと)
+JOB_LATENCY_WINDOW = 1000
+# 再試行の時刻になってもキューがいっぱいだった場合に、もう一度キューに戻そうとするまでの秒数
+JOB_RETRY_POLL_SECONDS = 0.05
+
+router = APIRouter()
+
+
+class Job:
+    __slots__ = ("name", "func", "args", "key", "attempts", "enqueued_at", "started_at", "queued")
+
+    def __init__(self, name: str, func, args: tuple, key=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.key = key
+        self.attempts = 0
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.queued = False  # ワーカーで実行するか(Falseならその場で実行)
+
+
+class JobStats:
+    __slots__ = ("submitted", "succeeded", "failed", "retried", "rejected", "deduplicated", "wait_ms", "run_ms")
+
+    def __init__(self):
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0  # 再試行しても成功しなかった数
+        self.retried = 0
+        self.rejected = 0  # キューがいっぱいで断った数
+        self.deduplicated = 0  # 同じkeyのジョブが実行待ちだったので投入しなかった数
+        self.wait_ms = deque(maxlen=JOB_LATENCY_WINDOW)  # 投入から実行開始まで(1回目)
+        self.run_ms = deque(maxlen=JOB_LATENCY_WINDOW)  # 成功した回の実行時間
+
+    def summary(self):
+        summary = {"submitted": self.submitted, "succeeded": self.succeeded, "failed": self.failed, "retried": self.retried, "rejected": self.rejected, "deduplicated": self.deduplicated}
+        for name in ("wait_ms", "run_ms"):
+            values = list(getattr(self, name))
+            summary[name] = {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)), "max": max(values)} if values else None
+        return summary
+
+
+class JobQueue:
+    def __init__(self, maxsize: int = JOB_QUEUE_SIZE, workers: int = JOB_WORKERS, max_retries: int = JOB_MAX_RETRIES, retry_backoff: float = JOB_RETRY_BACKOFF_SECONDS):
+        self.queue = Queue(maxsize)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._threads = []
+        self._retry_thread = None
+        self._accepting = False
+        self._stopping = False
+        self._pending = 0  # 投入されてまだ終わっていないジョブの数(再試行待ちを含む)
+        self._retries = []  # 再試行待ちのジョブの(再試行する時刻, 順番, Job)のヒープ
+        self._retry_seq = 0
+        self._waiting_keys = set()  # 実行を待っているジョブの(名前, key)
+        self._condition = threading.Condition()
+        self._stats = {}
+
+    def _stats_for(self, name: str):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = JobStats()
+        return stats
+
+    # 1.ワーカーと再試行のスレッドを起動する
+    def start(self):
+        with self._condition:
+            if self._accepting:
+                return
+            self._accepting = True
+            self._stopping = False
+        self._threads = [threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True) for i in range(self.workers)]
+        self._retry_thread = threading.Thread(target=self._retry_loop, name="job-retry", daemon=True)
+        for thread in self._threads + [self._retry_thread]:
+            thread.start()
+
+    def is_running(self):
+        return self._accepting
+
+    # 2.ジョブを投入する。受け付けたら(同じkeyのジョブが実行待ちだった場合も)True、キューがいっぱいで断った場合はFalse
+    # (ワーカーが起動していなければその場で実行する)
+    def submit(self, name: str, func, *args, key=None):
+        job = Job(name, func, args, key)
+        with self._condition:
+            stats = self._stats_for(name)
+            if key is not None:
+                if (name, key) in self._waiting_keys:
+                    stats.deduplicated += 1
+                    return True
+                self._waiting_keys.add((name, key))
+            stats.submitted += 1
+            if not self._accepting:
+                inline = True
+            else:
+                inline = False
+                try:
+                    self.queue.put_nowait(job)
+                except Full:
+                    stats.rejected += 1
+                    self._waiting_keys.discard((name, key))
+                    print(f"Job queue is full, dropped {name}")
+                    return False
+                job.queued = True
+                self._pending += 1
+
+        if inline:
+            self._run(job, retry=False)
+        return True
+
+    # 3.ワーカー: キューからジョブを取り出して実行する(Noneが来たら終了)
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self._run(job, retry=True)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job: Job, retry: bool):
+        if job.started_at is None:
+            job.started_at = time.perf_counter()
+            with self._condition:
+                self._stats_for(job.name).wait_ms.append((job.started_at - job.enqueued_at) * 1000)
+                # 実行を始めた後に投入された同じkeyのジョブは、この実行より新しいデータを見るので受け付ける
+                self._waiting_keys.discard((job.name, job.key))
+
+        job.attempts += 1
+        start = time.perf_counter()
+        try:
+            job.func(*job.args)
+        except Exception as e:
+            if retry and job.attempts <= self.max_retries:
+                delay = self.retry_backoff * 2 ** (job.attempts - 1)
+                print(f"Job {job.name} failed ({e!r}), retrying in {delay:.1f}s ({job.attempts}/{self.max_retries})")
+                # 再試行までの間ワーカーをふさがないよう、再試行待ちのヒープに入れておく
+                with self._condition:
+                    self._stats_for(job.name).retried += 1
+                    heapq.heappush(self._retries, (time.monotonic() + delay, self._retry_seq, job))
+                    self._retry_seq += 1
+                    self._condition.notify_all()
+                return
+            print(f"Job {job.name} failed after {job.attempts} attempts: {e!r}")
+            self._finish(job, succeeded=False)
+            return
+        with self._condition:
+            self._stats_for(job.name).run_ms.append((time.perf_counter() - start) * 1000)
+        self._finish(job, succeeded=True)
+
+    # 再試行のスレッド: 再試行の時刻になったジョブをキューに戻す(キューがいっぱいならヒープに残して少し後にもう一度)
+    def _retry_loop(self):
+        with self._condition:
+            while not self._stopping:
+                if not self._retries:
+                    self._condition.wait()
+                    continue
+                due, _, job = self._retries[0]
+                if due > time.monotonic():
+                    self._condition.wait(due - time.monotonic())
+                    continue
+                try:
+                    self.queue.put_nowait(job)
+                except Full:
+                    self._condition.wait(JOB_RETRY_POLL_SECONDS)
+                    continue
+                heapq.heappop(self._retries)
+
+    def _finish(self, job: Job, succeeded: bool):
+        with self._condition:
+            stats = self._stats_for(job.name)
+            if succeeded:
+                stats.succeeded += 1
+            else:
+                stats.failed += 1
+            if job.queued:
+                self._pending -= 1
+                self._condition.notify_all()
+
+    # 4.新しい投入を止め、残りのジョブ(再試行待ちを含む)が終わるまで最大timeout秒待ってからワーカーを止める
+    # 待ちきれなかったジョブの数を返す
+    def drain(self, timeout: float = JOB_DRAIN_TIMEOUT_SECONDS):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._accepting = False
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            left = self._pending
+            self._stopping = True
+            self._condition.notify_all()
+
+        # ワーカーにはキューの最後に止める印(None)を入れて知らせる(キューが空かないまま時間切れになったら諦める)
+        for _ in self._threads:
+            try:
+                self.queue.put(None, timeout=max(deadline - time.monotonic(), 0.1))
+            except Full:
+                break
+        for thread in self._threads + [self._retry_thread]:
+            thread.join(max(deadline - time.monotonic(), 0.1))
+        self._threads = []
+        self._retry_thread = None
+        return left
+
+    def stats(self):
+        with self._condition:
+            return {
+                "running": self._accepting,
+                "workers": len(self._threads),
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "pending": self._pending,
+                "retry_waiting": len(self._retries),
+                "jobs": {name: stats.summary() for name, stats in self._stats.items()},
+            }
+
+
+job_queue = JobQueue()
+
+
+# ジョブの中で使うSessionを作る関数を返す(リクエストのSessionは応答後に閉じられるので、同じDBにつながる別のSessionを作る)
+def session_factory(db: Session):
+    bind = db.get_bind()
+    return lambda: Session(bind=bind)
+
+
+# キューの長さ、ジョブの名前ごとの件数・待ち時間・実行時間を返す
+@router.get("/jobs/stats")
+def get_job_stats():
+    return job_queue.stats()
@@ -0,0 +1,167 @@
+# ダミーデータのExcel(BeerLog2.0_dummyData_inserted0731.xlsx)をDBへまとめて投入するローダー
+# シートごとにmymodels.pyのテーブルの列へ合わせ、外部キーの順(親テーブルから)にchunk_size行ずつexecutemanyでINSERTする
+# chunkごとにコミットするので、途中で止まっても再実行すれば投入済みの行(主キーが同じ行)を飛ばして続きから入る
+# 最後にsurveysからsurvey_vectorsを作り直す(db_control/survey_vectors.py)
+# survey_raw_datasを集計したbrand_average_scores、purchase_detailsを集計したbrand_purchase_countsも作り直す
+# (db_control/average_scores.py, db_control/purchase_counts.py)
+# backendディレクトリで以下のように実行する(テーブルが無ければ作成する)
+#   python -m db_control.load_dummy_data --db-url sqlite:///local.db
+#   python -m db_control.load_dummy_data --db-url sqlite:///local.db --reset   (全テーブルを空にしてから入れ直す)
+import argparse
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import Date, DateTime, String, create_engine, delete, select
+from sqlalchemy.orm import Session
+
+from db_control.average_scores import refresh_average_scores
+from db_control.migrate_purchase_details import compact_details
+from db_control.mymodels import Base
+from db_control.purchase_counts import refresh_purchase_counts
+from db_control.survey_vectors import ensure_survey_vectors
+
+EXCEL_PATH = os.path.join(os.path.dirname(__file__), "BeerLog2.0_dummyData_inserted0731.xlsx")
+LOAD_CHUNK_SIZE = 1000
+# ExcelのEC_Setはalgorithm_funcが入っていないので、ec_set_idごとのアルゴリズムをここで決める
+ALGORITHMS = {
+    1: "recommend_preferred_products",
+    2: "recommend_preferred_products",
+    3: "recommend_diverse_preferred_products",
+    4: "recommend_adventurous_products",
+    5: "recommend_luxury_products",
+    6: "recommend_budget_products",
+    7: "recommend_popular_products",
+}
+
+
+# 1.Excelの1シートを、テーブルの列にそろえたdictのリストにする(NaNはNone、日付は列の型に合わせてdate/datetime)
+def read_sheet_rows(sheet: pd.DataFrame, table_name: str):
+    table = Base.metadata.tables[table_name]
+    sheet = sheet.copy()
+    # postsのratingは列名の無い隣の列に入っている
+    if table_name == "posts" and "Unnamed: 5" in sheet.columns:
+        sheet["rating"] = sheet["rating"].fillna(sheet["Unnamed: 5"])
+
+    columns = [column for column in table.columns if column.name in sheet.columns]
+    rows = []
+    for record in sheet[[column.name for column in columns]].astype(object).to_dict("records"):
+        row = {}
+        for column in columns:
+            value = record[column.name]
+            if pd.isna(value):
+                value = None
+            elif isinstance(column.type, Date) and isinstance(value, datetime):
+                value = value.date()
+            elif isinstance(column.type, DateTime) and isinstance(value, pd.Timestamp):
+                value = value.to_pydatetime()
+            elif isinstance(column.type, String) and not isinstance(value, str):
+                value = str(value)
+            elif isinstance(value, float) and value.is_integer() and column.type.python_type is int:
+                value = int(value)
+            row[column.name] = value
+        rows.append(row)
+
+    if table_name == "ec_sets":
+        for row in rows:
+            row["algorithm_func"] = ALGORITHMS.get(row["ec_set_id"], "recommend_preferred_products")
+    # Excelの明細は1缶1行なので、(ec_set_id, ec_brand_id)ごとに本数をまとめる
+    if table_name == "purchase_details":
+        rows = compact_details(rows)
+    return rows
+
+
+# 2.chunk_size行ずつまとめてINSERTする(executemany)。on_chunkには投入済みの行数が渡される
+def insert_rows(connection, table_name: str, rows, chunk_size: int = LOAD_CHUNK_SIZE, on_chunk=None):
+    table = Base.metadata.tables[table_name]
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            connection.execute(table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+            if on_chunk is not None:
+                on_chunk(count)
+    if chunk:
+        connection.execute(table.insert(), chunk)
+        count += len(chunk)
+        if on_chunk is not None:
+            on_chunk(count)
+    return count
+
+
+# 3.投入済みの行(主キーが同じ行)を除く
+def skip_loaded_rows(connection, table_name: str, rows: list):
+    table = Base.metadata.tables[table_name]
+    key_columns = list(table.primary_key.columns)
+    loaded = set(connection.execute(select(*key_columns)).all())
+    if not loaded:
+        return rows
+    return [row for row in rows if tuple(row.get(column.name) for column in key_columns) not in loaded]
+
+
+# 4.1テーブル分を投入する(chunkごとにコミットし、進捗を表示する)
+def load_table(engine, table_name: str, rows: list, chunk_size: int = LOAD_CHUNK_SIZE):
+    with engine.connect() as connection:
+        pending = skip_loaded_rows(connection, table_name, rows)
+        skipped = len(rows) - len(pending)
+        start = time.perf_counter()
+
+        def on_chunk(count: int):
+            connection.commit()
+            print(f"\r{table_name}: {skipped + count}/{len(rows)} rows", end="", flush=True)
+
+        count = insert_rows(connection, table_name, pending, chunk_size, on_chunk)
+        connection.commit()
+        elapsed = time.perf_counter() - start
+
+    rate = f"{count / elapsed:.0f} rows/s" if count else "already loaded"
+    print(f"\r{table_name}: {skipped + count}/{len(rows)} rows ({count} inserted, {rate})")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-load the Excel dummy dataset into the database")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--excel", default=EXCEL_PATH, help="Excel file to load")
+    parser.add_argument("--chunk-size", type=int, default=LOAD_CHUNK_SIZE, help="rows per executemany batch and commit")
+    parser.add_argument("--reset", action="store_true", help="empty all tables before loading")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    Base.metadata.create_all(engine)
+    start = time.perf_counter()
+    sheets = pd.read_excel(args.excel, sheet_name=None)
+    print(f"Read {len(sheets)} sheets in {time.perf_counter() - start:.1f}s")
+
+    if args.reset:
+        with engine.begin() as connection:
+            # 子テーブルから順に空にする
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(delete(table))
+
+    total = 0
+    for table in Base.metadata.sorted_tables:
+        if table.name in sheets:
+            total += load_table(engine, table.name, read_sheet_rows(sheets[table.name], table.name), args.chunk_size)
+
+    # リコメンドが読むsurvey_vectorsをsurveysに合わせる
+    with Session(engine) as db:
+        count = ensure_survey_vectors(db)
+    print(f"survey_vectors: {'up to date' if count is None else f'rebuilt {count} rows'}")
+    with Session(engine) as db:
+        count = refresh_average_scores(db)
+        purchase_count = refresh_purchase_counts(db)
+        db.commit()
+    print(f"brand_average_scores: {count} rows")
+    print(f"brand_purchase_counts: {purchase_count} rows")
+
+    elapsed = time.perf_counter() - start
+    print(f"Inserted {total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)")
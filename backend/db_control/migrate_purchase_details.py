@@ -0,0 +1,112 @@
+# purchase_detailsを「1缶1行」から「1購入内の(ec_set_id, ec_brand_id)ごとに本数(quantity)を持つ1行」へ移行する
+# 1.quantity列が無ければ追加する(既存の行はすべて1になる)
+# 2.purchase_idのまとまりごとに、同じ(ec_set_id, ec_brand_id, category, name, price)の行を1行にまとめ、quantityに本数の合計を入れる
+#   detail_idは最初に出てきた順に1から振り直す。まとまりごとにコミットするので、途中で止まっても再実行すれば続きから移行できる
+#   (移行済みの購入はまとめる行が無いので何もしない)
+# backendディレクトリで以下のように実行する
+#   python -m db_control.migrate_purchase_details
+#   python -m db_control.migrate_purchase_details --db-url sqlite:///local.db --chunk-size 1000
+import argparse
+import time
+
+from sqlalchemy import create_engine, delete, func, inspect, select, text
+
+from db_control.mymodels import PurchaseDetail
+
+MIGRATION_CHUNK_SIZE = 500
+
+
+# 明細の行(dict)を(ec_set_id, ec_brand_id, category, name, price)ごとにまとめ、quantityに本数の合計を入れる
+# 最初に出てきた順に並べ、detail_idを1から振り直す(購入時の登録や、Excelからの投入でも使う)
+def compact_details(rows):
+    groups = {}
+    for row in rows:
+        key = (row["purchase_id"], row["ec_set_id"], row["ec_brand_id"], row["category"], row["name"], row["price"])
+        if key in groups:
+            groups[key]["quantity"] += row.get("quantity") or 1
+        else:
+            groups[key] = dict(row, quantity=row.get("quantity") or 1)
+
+    detail_ids = {}
+    compacted = []
+    for row in groups.values():
+        detail_ids[row["purchase_id"]] = detail_ids.get(row["purchase_id"], 0) + 1
+        compacted.append(dict(row, detail_id=detail_ids[row["purchase_id"]]))
+    return compacted
+
+
+# 1.quantity列を追加する
+def add_quantity_column(engine):
+    columns = {column["name"] for column in inspect(engine).get_columns(PurchaseDetail.__tablename__)}
+    if "quantity" in columns:
+        return False
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {PurchaseDetail.__tablename__} ADD COLUMN quantity INTEGER NOT NULL DEFAULT 1"))
+    return True
+
+
+# 2.purchase_idのまとまり1つ分をまとめ直す(まとめる行が無い購入はそのまま)。(移行前の行数, 移行後の行数)を返す
+def migrate_chunk(connection, purchase_ids: list[int]):
+    table = PurchaseDetail.__table__
+    rows = connection.execute(select(table).where(table.c.purchase_id.in_(purchase_ids)).order_by(table.c.purchase_id, table.c.detail_id)).mappings().all()
+    compacted = compact_details(dict(row) for row in rows)
+    if len(compacted) == len(rows):
+        return len(rows), len(rows)
+
+    connection.execute(delete(table).where(table.c.purchase_id.in_(purchase_ids)))
+    connection.execute(table.insert(), compacted)
+    return len(rows), len(compacted)
+
+
+# 3.全購入をまとまりごとに移行する
+def migrate(engine, chunk_size: int = MIGRATION_CHUNK_SIZE):
+    table = PurchaseDetail.__table__
+    with engine.connect() as connection:
+        purchase_ids = connection.execute(select(table.c.purchase_id).distinct().order_by(table.c.purchase_id)).scalars().all()
+
+        start = time.perf_counter()
+        before_total = 0
+        after_total = 0
+        for i in range(0, len(purchase_ids), chunk_size):
+            before, after = migrate_chunk(connection, purchase_ids[i : i + chunk_size])
+            connection.commit()
+            before_total += before
+            after_total += after
+            print(f"\r{min(i + chunk_size, len(purchase_ids))}/{len(purchase_ids)} purchases", end="", flush=True)
+        print()
+    return len(purchase_ids), before_total, after_total, time.perf_counter() - start
+
+
+# MySQLではテーブルのデータ・インデックスのサイズも表示する(それ以外のDBはNone)
+def table_size(engine):
+    if engine.dialect.name != "mysql":
+        return None
+    with engine.connect() as connection:
+        query = text("SELECT data_length, index_length FROM information_schema.TABLES WHERE table_schema = DATABASE() AND table_name = :table_name")
+        return connection.execute(query, {"table_name": PurchaseDetail.__tablename__}).first()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collapse per-can purchase_details rows into quantity rows")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE, help="purchases per transaction")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    if add_quantity_column(engine):
+        print("Added purchase_details.quantity")
+    size_before = table_size(engine)
+
+    purchases, before, after, elapsed = migrate(engine, args.chunk_size)
+    with engine.connect() as connection:
+        total_cans = connection.execute(select(func.coalesce(func.sum(PurchaseDetail.quantity), 0))).scalar()
+    print(f"{purchases} purchases: {before} -> {after} rows in {elapsed:.1f}s ({total_cans} cans, {total_cans / max(after, 1):.1f} cans per row)")
+
+    size_after = table_size(engine)
+    if size_before is not None and size_after is not None:
+        # InnoDBの統計は非同期に更新されるので、正確な値はANALYZE TABLEの後に確認する
+        print(f"data {size_before[0]} -> {size_after[0]} bytes, index {size_before[1]} -> {size_after[1]} bytes")
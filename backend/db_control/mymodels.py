@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Integer, String, Text, LargeBinary, Date, DateTime, Boolean, Float, Numeric, ForeignKey, PrimaryKeyConstraint, Column
+from sqlalchemy import create_engine, Integer, String, Text, LargeBinary, Date, DateTime, Boolean, Float, Numeric, ForeignKey, PrimaryKeyConstraint, Column, Index
 from sqlalchemy.orm import declarative_base, relationship, mapped_column, Mapped
 from datetime import datetime, date
 from pydantic import BaseModel
@@ -12,6 +12,7 @@ class User(Base):
     user_mail: Mapped[str] = mapped_column(String(255), nullable=False)
     user_password: Mapped[str] = mapped_column(String(255), nullable=False)
     user_picture: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
+    user_picture_hash: Mapped[str] = mapped_column(String(64), nullable=True)  # user_pictureのSHA-256(縮小版が古くないかの確認に使う。db_control/images.py)
     user_profile: Mapped[str] = mapped_column(Text)
     birthdate: Mapped[date] = mapped_column(Date)
     gender: Mapped[int] = mapped_column(Integer)
@@ -46,6 +47,7 @@ class Photo(Base):
     photo_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     post_id: Mapped[int] = mapped_column(Integer, ForeignKey('posts.post_id'))
     photo_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
+    photo_data_hash: Mapped[str] = mapped_column(String(64), nullable=True)  # photo_dataのSHA-256
     posts = relationship("Post", back_populates="photos")
 
 class Store(Base):
@@ -64,6 +66,7 @@ class Brand(Base):
     brand_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     brand_name: Mapped[str] = mapped_column(String(255), nullable=False)
     brand_picture: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
+    brand_picture_hash: Mapped[str] = mapped_column(String(64), nullable=True)  # brand_pictureのSHA-256
     category: Mapped[str] = mapped_column(String(50))
     manufacturer_id: Mapped[int] = mapped_column(Integer, ForeignKey('manufacturers.manufacturer_id'))
     manufacturers = relationship("Manufacturer", back_populates="brands")
@@ -86,6 +89,11 @@ class Favorite(Base):
     users = relationship("User", back_populates="favorites")
     brands = relationship("Brand", back_populates="favorites")
 
+    # 同一ユーザーが同じbrand_idを重複して登録できないようにする(add_favoriteの重複チェックを兼ねる)
+    __table_args__ = (
+        Index('uq_favorites_user_id_brand_id', 'user_id', 'brand_id', unique=True),
+    )
+
 class Preference(Base):
     __tablename__ = "preferences"
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.user_id'), primary_key=True)
@@ -94,6 +102,14 @@ class Preference(Base):
     users = relationship("User", back_populates="preferences")
     items = relationship("Item", back_populates="preferences")
 
+# ユーザーごとの好み(preferences)のバージョン。好みを更新するたびに1増える
+# 好みから計算した結果をキャッシュする側は、このバージョンが変わっていたら計算し直す
+class PreferenceVersion(Base):
+    __tablename__ = "preference_versions"
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime)
+
 class Item(Base):
     __tablename__ = "items"
     item_id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -117,8 +133,41 @@ class Survey(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('survey_id', 'item_id'),
+        # リコメンドでgender・年齢帯・brand_idで絞り込むため
+        Index('ix_surveys_gender_age_brand_item', 'gender', 'age_lower_limit', 'age_upper_limit', 'brand_id', 'item_id'),
+    )
+
+# surveysを1つのsurvey_id(ブランド・性別・年齢帯)につき1行にまとめ、8項目のスコアを列に持たせたテーブル
+# リコメンドはこちらを読む(surveysの8行を読んでPythonで並べ替える必要がなくなる)。surveysが正で、内容はdb_control/survey_vectors.pyで作り直す
+class SurveyVector(Base):
+    __tablename__ = "survey_vectors"
+    survey_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    brand_id: Mapped[int] = mapped_column(Integer, ForeignKey('brands.brand_id'))
+    age_lower_limit: Mapped[int] = mapped_column(Integer)
+    age_upper_limit: Mapped[int] = mapped_column(Integer)
+    gender: Mapped[int] = mapped_column(Integer)
+    score1: Mapped[float] = mapped_column(Float, nullable=True)  # item_id=1のスコア(surveysに無い項目はNULL)
+    score2: Mapped[float] = mapped_column(Float, nullable=True)
+    score3: Mapped[float] = mapped_column(Float, nullable=True)
+    score4: Mapped[float] = mapped_column(Float, nullable=True)
+    score5: Mapped[float] = mapped_column(Float, nullable=True)
+    score6: Mapped[float] = mapped_column(Float, nullable=True)
+    score7: Mapped[float] = mapped_column(Float, nullable=True)
+    score8: Mapped[float] = mapped_column(Float, nullable=True)
+
+    __table_args__ = (
+        # リコメンドでgender・年齢帯・brand_idで絞り込むため
+        Index('ix_survey_vectors_gender_age_brand', 'gender', 'age_lower_limit', 'age_upper_limit', 'brand_id'),
     )
 
+# テーブル単位のデータのバージョン。内容を書き換えるたびに同じトランザクションで1増やす
+# (name="survey_vectors"はdb_control/survey_vectors.pyが行を作り直すたびに増やす。スナップショットはこれでDBと一致しているかを確認する)
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime)
+
 class SurveyRawData(Base):
     __tablename__ = "survey_raw_datas"
     raw_data_id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -133,7 +182,20 @@ class SurveyRawData(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('raw_data_id', 'item_id'),
+        # brandごとの平均スコアの集計用
+        Index('ix_survey_raw_datas_brand_id_item_id', 'brand_id', 'item_id'),
     )
+
+# survey_raw_datasのブランド・項目ごとの平均スコア。survey_raw_datasが正で、内容はdb_control/average_scores.pyで集計し直す
+# (アンケートの回答後はジョブで該当するブランドの行を作り直す。DBに置くので全ワーカーで同じ値を読む)
+class BrandAverageScore(Base):
+    __tablename__ = "brand_average_scores"
+    brand_id: Mapped[int] = mapped_column(Integer, ForeignKey('brands.brand_id'), primary_key=True)
+    item_id: Mapped[int] = mapped_column(Integer, ForeignKey('items.item_id'), primary_key=True)
+    average_score: Mapped[float] = mapped_column(Float)
+    response_count: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(DateTime)
+
 class EC_Brand(Base):
     __tablename__ = "ec_brands"
     ec_brand_id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -141,11 +203,16 @@ class EC_Brand(Base):
     category: Mapped[str] = mapped_column(String(50))
     name: Mapped[str] = mapped_column(String(255))
     picture: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
+    picture_hash: Mapped[str] = mapped_column(String(64), nullable=True)  # pictureのSHA-256
     description: Mapped[str] = mapped_column(Text)
     price: Mapped[int] = mapped_column(Integer)
     brands = relationship("Brand", back_populates="ec_brands")
     purchase_details = relationship("PurchaseDetail", back_populates="ec_brands")
 
+    __table_args__ = (
+        Index('ix_ec_brands_category_brand_id', 'category', 'brand_id'),
+    )
+
 class Purchase(Base):
     __tablename__ = "purchases"
     purchase_id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -157,6 +224,11 @@ class Purchase(Base):
     users = relationship("User", back_populates="purchases")
     purchase_details = relationship("PurchaseDetail", back_populates="purchases")
 
+    # 購入履歴(ユーザーごとに日時の降順)・直近の購入の抽出用
+    __table_args__ = (
+        Index('ix_purchases_user_id_date_time', 'user_id', 'date_time'),
+    )
+
 class PurchaseDetail(Base):
     __tablename__ = "purchase_details"
     purchase_id: Mapped[int] = mapped_column(Integer, ForeignKey("purchases.purchase_id"), primary_key=True)
@@ -166,9 +238,20 @@ class PurchaseDetail(Base):
     category: Mapped[str] = mapped_column(String(50))
     name: Mapped[str] = mapped_column(String(255))
     price: Mapped[int] = mapped_column(Integer)
+    # 1行 = 1購入内の(ec_set_id, ec_brand_id)ごとの本数。以前の1缶1行のデータはmigrate_purchase_details.pyでまとめる
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
     ec_brands = relationship("EC_Brand", back_populates="purchase_details")
     purchases = relationship("Purchase", back_populates="purchase_details")
     ec_sets = relationship("EC_Set", back_populates="purchase_details")
+    # purchase_idでの絞り込みは主キー(purchase_id, detail_id)の先頭列で効くので、別途インデックスは作らない
+
+# purchase_detailsのブランドごとの購入本数の合計。purchase_detailsが正で、内容はdb_control/purchase_counts.pyで集計し直す
+# (購入後はジョブで購入したブランドの行を作り直す。入力補完の人気順はpurchase_details全体を集計せずにこちらを読む)
+class BrandPurchaseCount(Base):
+    __tablename__ = "brand_purchase_counts"
+    brand_id: Mapped[int] = mapped_column(Integer, ForeignKey('brands.brand_id'), primary_key=True)
+    quantity: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(DateTime)
 
 
 class EC_Set(Base):
@@ -197,4 +280,31 @@ class EC_Set(Base):
 #     algorithm_func: Mapped[str] = mapped_column(String(255))
 #     description: Mapped[str] = mapped_column(Text)
 #     ec_sets_national = relationship("EC_Set", foreign_keys="[EC_Set.national_algorithm_id]", back_populates="national_algorithm")
-#     ec_sets_craft = relationship("EC_Set", foreign_keys="[EC_Set.craft_algorithm_id]", back_populates="craft_algorithm")
\ No newline at end of file
+#     ec_sets_craft = relationship("EC_Set", foreign_keys="[EC_Set.craft_algorithm_id]", back_populates="craft_algorithm")
+
+# recommendation_by_cosine_similarityの結果をユーザー・カテゴリごとに事前計算して保存しておくテーブル
+# brand_ids(int32)とrec_scores(float64)はrec_score降順に並べた配列をバイト列にして格納する
+class PrecomputedRecommendation(Base):
+    __tablename__ = "precomputed_recommendations"
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    category: Mapped[str] = mapped_column(String(50), primary_key=True)
+    age: Mapped[int] = mapped_column(Integer)
+    gender: Mapped[int] = mapped_column(Integer)
+    preference_version: Mapped[int] = mapped_column(Integer)  # 計算時のpreference_versions.version
+    brand_ids: Mapped[bytes] = mapped_column(LargeBinary)
+    rec_scores: Mapped[bytes] = mapped_column(LargeBinary)
+    computed_at: Mapped[datetime] = mapped_column(DateTime)
+
+# アップロードされた画像(brands.brand_picture, ec_brands.picture, users.user_picture, photos.photo_data)から作った縮小版
+# 一覧系のエンドポイントでは元画像の代わりにこちらを返す(db_control/images.pyで作成する)
+# 画像として読めなかった元画像には、width=0・dataが空の行を印として入れておく(バックフィルで毎回読み直さないように)
+class ImageVariant(Base):
+    __tablename__ = "image_variants"
+    image_kind: Mapped[str] = mapped_column(String(20), primary_key=True)  # brand / ec_brand / user / photo
+    image_id: Mapped[int] = mapped_column(Integer, primary_key=True)  # 元画像の行の主キー
+    width: Mapped[int] = mapped_column(Integer, primary_key=True)
+    mime_type: Mapped[str] = mapped_column(String(50))
+    data: Mapped[bytes] = mapped_column(LargeBinary(16777215))  # MySQLではMEDIUMBLOBになる
+    source_size: Mapped[int] = mapped_column(Integer)  # 元画像のバイト数
+    source_hash: Mapped[str] = mapped_column(String(64), nullable=True)  # 作ったときの元画像のSHA-256(元画像の行の*_hashと一致するものだけ使う)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
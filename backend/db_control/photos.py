@@ -0,0 +1,105 @@
+# 投稿写真のギャラリー
+# 一覧はphoto_idをカーソルにしたページ単位で返し、画像そのものは含めずに縮小版・元画像のURLだけを返す
+# 画像は同じphoto_idのまま差し替わる(縮小版も同じidで作り直す)ので、元画像のハッシュ(photo_data_hash)をETagにして
+# ブラウザには毎回確認させる(変わっていなければ304を返し、画像は送らない。確認ではハッシュの列だけを読む)
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from db_control.connect import get_db
+from db_control.images import get_thumbnails, guess_mime_type, PHOTO_THUMBNAIL_WIDTH, THUMBNAIL_WIDTHS
+from db_control.mymodels import Photo, Post, User
+from db_control.schemas import PhotoGalleryPage
+
+router = APIRouter()
+
+# 1ページあたりの件数の上限
+MAX_PAGE_SIZE = 100
+# キャッシュしてよいが、使う前に毎回ETagで確認させる
+IMAGE_CACHE_CONTROL = "private, no-cache"
+
+
+# 1.ユーザーの写真をphoto_id順に1ページ分取得する(cursorより後ろのphoto_idから、limit件)
+def get_gallery_page(db: Session, user_id: int, cursor: int | None, limit: int):
+    query = select(Photo.photo_id, Photo.post_id).join(Post, Post.post_id == Photo.post_id).where(Post.user_id == user_id)
+    if cursor is not None:
+        query = query.where(Photo.photo_id > cursor)
+    # 次のページがあるかを知るために1件多く取る
+    rows = db.execute(query.order_by(Photo.photo_id).limit(limit + 1)).all()
+
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    photos = [
+        {
+            "photo_id": photo_id,
+            "post_id": post_id,
+            "thumbnail_url": f"/photos/{photo_id}/thumbnail",
+            "photo_url": f"/photos/{photo_id}",
+        }
+        for photo_id, post_id in rows[:limit]
+    ]
+    return {"photos": photos, "next_cursor": next_cursor}
+
+
+# 2.写真のETag(元画像のハッシュが無い写真はNone。ORMを通さずに入れてまだバックフィルしていない場合)
+def photo_etag(photo_hash: str | None, suffix: str = ""):
+    return f'"{photo_hash}{suffix}"' if photo_hash else None
+
+
+def image_headers(etag: str | None):
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag:
+        headers["ETag"] = etag
+    return headers
+
+
+def is_not_modified(etag: str | None, if_none_match: str | None):
+    return etag is not None and if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+# ユーザーの写真一覧(1ページ分)
+@router.get("/users/{user_id}/photos", response_model=PhotoGalleryPage)
+def read_user_photo_gallery(
+    user_id: int,
+    cursor: int | None = Query(None, description="前のページのnext_cursor"),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+):
+    if db.get(User, user_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return get_gallery_page(db, user_id, cursor, limit)
+
+
+# 写真の縮小版(WebP)。まだ作られていなければ元画像を返す
+@router.get("/photos/{photo_id}/thumbnail")
+def read_photo_thumbnail(
+    photo_id: int,
+    width: int = Query(PHOTO_THUMBNAIL_WIDTH),
+    if_none_match: str | None = Header(default=None),
+    db: Session = Depends(get_db),
+):
+    if width not in THUMBNAIL_WIDTHS:
+        raise HTTPException(status_code=400, detail=f"width must be one of {list(THUMBNAIL_WIDTHS)}")
+
+    photo_hash = db.execute(select(Photo.photo_data_hash).where(Photo.photo_id == photo_id)).scalar()
+    etag = photo_etag(photo_hash, f"-{width}")
+    if is_not_modified(etag, if_none_match):
+        return Response(status_code=304, headers=image_headers(etag))
+
+    thumbnail = get_thumbnails(db, "photo", [photo_id], width).get(photo_id)
+    if thumbnail is None:
+        return read_photo(photo_id, if_none_match, db)
+    return Response(content=thumbnail, media_type="image/webp", headers=image_headers(etag))
+
+
+# 写真の元画像を返す(BLOBは1回のクエリで読む)
+@router.get("/photos/{photo_id}")
+def read_photo(photo_id: int, if_none_match: str | None = Header(default=None), db: Session = Depends(get_db)):
+    photo_hash = db.execute(select(Photo.photo_data_hash).where(Photo.photo_id == photo_id)).scalar()
+    etag = photo_etag(photo_hash)
+    if is_not_modified(etag, if_none_match):
+        return Response(status_code=304, headers=image_headers(etag))
+
+    data = db.execute(select(Photo.photo_data).where(Photo.photo_id == photo_id)).scalar()
+    if not data:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return Response(content=data, media_type=guess_mime_type(data), headers=image_headers(etag))
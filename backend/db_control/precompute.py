@@ -0,0 +1,106 @@
+# 全ユーザー×全カテゴリのcos類似度ランキングを事前計算して、precomputed_recommendationsテーブルに保存する夜間バッチ
+# backendディレクトリで以下のように実行する
+#   python -m db_control.precompute --workers 4 --chunk-size 50
+# /recommend は新鮮な事前計算結果があればそれを使い、なければその場で計算する(recommend.get_cached_ranking)
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy import select, delete
+
+from db_control import connect
+from db_control.mymodels import User, Brand, PrecomputedRecommendation
+from db_control.recommend import get_user_age_and_gender, get_preference_version, get_user_preference_vector, get_survey_vectors, rank_by_cosine_similarity, pack_ranking
+
+
+# ワーカープロセスの初期化
+# 親プロセスから引き継いだコネクションを使い回さないように、エンジンのコネクションプールを破棄しておく
+def init_worker():
+    connect.engine.dispose(close=False)
+
+
+# 1.ワーカープロセスで実行する処理
+# user_idのまとまり(chunk)について、全カテゴリのランキングを計算して保存用の値(dict)のリストで返す
+def compute_chunk(user_ids: list[int], categories: list[str]):
+    db = connect.SessionLocal()
+    rows = []
+    try:
+        # 同じ(age, gender, category)の製品ベクトルはユーザー間で共通なので使い回す
+        vectors_cache = {}
+        for user_id in user_ids:
+            age, gender = get_user_age_and_gender(user_id, db)
+            if age is None or gender is None:
+                continue
+            # 計算中に好みが更新された場合に古い結果を新しいものと取り違えないよう、バージョンは先に読んでおく
+            preference_version = get_preference_version(user_id, db)
+            user_vector = get_user_preference_vector(user_id, db)
+
+            for category in categories:
+                key = (age, gender, category)
+                if key not in vectors_cache:
+                    vectors_cache[key] = get_survey_vectors(age, gender, category, db)
+                ranking = rank_by_cosine_similarity(*vectors_cache[key], user_vector)
+                rows.append(pack_ranking(user_id, age, gender, category, ranking, preference_version))
+    finally:
+        db.close()
+
+    return len(user_ids), rows
+
+
+# 2.計算結果を保存する(ユーザー単位で古い行を消してから入れ直す)
+def save_rows(db, user_ids: list[int], rows: list[dict]):
+    try:
+        db.execute(delete(PrecomputedRecommendation).where(PrecomputedRecommendation.user_id.in_(user_ids)))
+        if rows:
+            db.bulk_insert_mappings(PrecomputedRecommendation, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+def chunked(values: list, size: int):
+    return [values[i : i + size] for i in range(0, len(values), size)]
+
+
+# 3.全ユーザーをchunkに分けてプロセスプールで並列に計算する
+def run(workers: int, chunk_size: int):
+    db = connect.SessionLocal()
+    try:
+        user_ids = db.execute(select(User.user_id).order_by(User.user_id)).scalars().all()
+        categories = db.execute(select(Brand.category).where(Brand.category.is_not(None)).distinct()).scalars().all()
+
+        print(f"Precomputing recommendations: {len(user_ids)} users x {len(categories)} categories, {workers} workers")
+
+        start = time.perf_counter()
+        done_users = 0
+        saved_rows = 0
+        chunks = chunked(user_ids, chunk_size)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = {executor.submit(compute_chunk, chunk, categories): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                num_users, rows = future.result()
+                save_rows(db, futures[future], rows)
+
+                done_users += num_users
+                saved_rows += len(rows)
+                elapsed = time.perf_counter() - start
+                print(f"  {done_users}/{len(user_ids)} users ({done_users / elapsed:.1f} users/s)")
+
+        elapsed = time.perf_counter() - start
+        throughput = len(user_ids) / elapsed if elapsed > 0 else 0.0
+        print(f"Done: {saved_rows} rows in {elapsed:.2f}s ({throughput:.1f} users/s)")
+        return throughput
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute cosine-similarity rankings for all users and categories")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=50, help="users per task")
+    args = parser.parse_args()
+
+    run(args.workers, args.chunk_size)
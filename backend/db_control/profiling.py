@@ -0,0 +1,266 @@
+# 遅いリクエストの中でどこに時間が掛かっているかを調べるための、リクエスト単位のプロファイラ(必要なときだけ有効にする)
+# 次のどちらかの場合に、そのリクエストのエンドポイントの処理をcProfileで計測する
+#   ヘッダー X-Profile-Token が環境変数PROFILING_TOKENと一致する(PROFILING_TOKENが空なら使えない)
+#   PROFILING_SAMPLE_RATEの割合で無作為に選ばれた(ステージングで常時少しずつ集める場合)
+# 計測の対象はroute_class=ProfiledRouteを指定したルーター(recommend.py, purchase.py)のエンドポイント
+# 結果はPROFILING_DIRに<id>.prof(pstats形式。snakevizなどで見る)と<id>.json(上位の関数、SQLとPythonの時間)として書き出し
+# (PROFILING_MAX_FILESより多くなったら古いものから消す)、
+# レスポンスには X-Profile-Id, X-Profile-Total-Ms, X-Profile-SQL-Ms, X-Profile-Python-Ms のヘッダーを付ける
+# 書き出したJSONは GET /profiling/{profile_id} (X-Profile-Tokenが必要)でも取得できる
+# 計測しないリクエストでは、ヘッダーの確認とContextVarの参照が増えるだけ(SQLのイベントは有効なときだけ登録する)
+# cProfileはプロセス内で同時に1つしか有効にできないので、関数の計測は同時に1リクエストだけ行う
+# (ほかのリクエストが計測中の場合は、関数は計測せずに時間とSQLの内訳だけを残す。レスポンスはそのまま返す)
+import asyncio
+import cProfile
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from functools import wraps
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 環境変数のロード
+load_dotenv()
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+# JSONに載せる関数の数(累積時間の多い順)
+PROFILING_TOP_N = int(os.getenv("PROFILING_TOP_N", "20"))
+# PROFILING_DIRに残す計測結果の数(古いものから消す)
+PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES", "200"))
+
+PROFILING_AVAILABLE = bool(PROFILING_TOKEN) or PROFILING_SAMPLE_RATE > 0
+
+router = APIRouter()
+
+
+class RequestProfile:
+    __slots__ = ("profile_id", "path", "profiler", "functions_profiled", "sql_seconds", "sql_count", "started_at")
+
+    def __init__(self, path: str):
+        self.profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.path = path
+        self.profiler = cProfile.Profile()
+        self.functions_profiled = False  # cProfileで関数を計測できたか(ほかのリクエストが計測中なら計測しない)
+        self.sql_seconds = 0.0
+        self.sql_count = 0
+        self.started_at = time.perf_counter()
+
+    # 上位の関数と時間の内訳をまとめる
+    def summary(self, total_seconds: float):
+        self.profiler.create_stats()
+        rows = []
+        # ProfiledRoute以外のエンドポイントでは関数の計測結果は空になる
+        for (filename, line, function), (_, ncalls, tottime, cumtime, _) in self.profiler.stats.items():
+            rows.append({"function": f"{filename}:{line}({function})", "ncalls": ncalls, "tottime_ms": tottime * 1000, "cumtime_ms": cumtime * 1000})
+        rows.sort(key=lambda row: row["cumtime_ms"], reverse=True)
+        return {
+            "profile_id": self.profile_id,
+            "path": self.path,
+            "total_ms": total_seconds * 1000,
+            "sql_ms": self.sql_seconds * 1000,
+            "sql_count": self.sql_count,
+            "python_ms": max(total_seconds - self.sql_seconds, 0.0) * 1000,
+            "functions_profiled": self.functions_profiled,
+            "top_functions": rows[:PROFILING_TOP_N],
+        }
+
+    def write(self, summary: dict):
+        os.makedirs(PROFILING_DIR, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(PROFILING_DIR, f"{self.profile_id}.prof"))
+        with open(os.path.join(PROFILING_DIR, f"{self.profile_id}.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        remove_old_profiles()
+
+
+# PROFILING_MAX_FILESより多い計測結果を、古いものから消す
+def remove_old_profiles():
+    try:
+        names = [name for name in os.listdir(PROFILING_DIR) if name.endswith(".json")]
+    except FileNotFoundError:
+        return
+    if len(names) <= PROFILING_MAX_FILES:
+        return
+    names.sort(key=lambda name: os.path.getmtime(os.path.join(PROFILING_DIR, name)))
+    for name in names[:len(names) - PROFILING_MAX_FILES]:
+        for path in (os.path.join(PROFILING_DIR, name), os.path.join(PROFILING_DIR, name[:-len(".json")] + ".prof")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+current_profile: ContextVar[RequestProfile | None] = ContextVar("current_profile", default=None)
+
+
+def is_authorized(token: str | None):
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, PROFILING_TOKEN)
+
+
+# 1.SQLの実行時間を、計測中のリクエストに足していく
+if PROFILING_AVAILABLE:
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_profile.get() is not None:
+            conn.info.setdefault("profiling_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile.get()
+        started_at = conn.info.get("profiling_started_at")
+        if profile is not None and started_at:
+            profile.sql_seconds += time.perf_counter() - started_at.pop()
+            profile.sql_count += 1
+
+
+# 2.エンドポイントの関数をcProfileで包む(計測中のリクエストの場合だけ)
+# defのエンドポイントはスレッドプールで動くので、プロファイラはそのスレッドで有効にする必要がある
+# 同時に有効にできるcProfileは1つだけなので、ロックを取れたリクエストだけ計測する(取れなければ計測せずに実行する)
+_profiler_lock = threading.Lock()
+
+
+def start_profiler(profile: RequestProfile):
+    if not _profiler_lock.acquire(blocking=False):
+        return False
+    try:
+        profile.profiler.enable()
+    except ValueError:
+        # ほかのプロファイラ(アプリの外で有効にしたものなど)が動いている
+        _profiler_lock.release()
+        return False
+    profile.functions_profiled = True
+    return True
+
+
+def stop_profiler(profile: RequestProfile):
+    profile.profiler.disable()
+    _profiler_lock.release()
+
+
+# asyncのエンドポイントは、awaitで止まっている間にほかのコルーチンが動くので、コルーチンを1ステップずつ進め、
+# 進めている間だけプロファイラを有効にする(待っている間のほかのリクエストの処理は計測に入れない)
+class ProfiledCoroutine:
+    __slots__ = ("coroutine", "profile")
+
+    def __init__(self, coroutine, profile: RequestProfile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            profiling = start_profiler(self.profile)
+            try:
+                if error is None:
+                    yielded = self.coroutine.send(value)
+                else:
+                    yielded = self.coroutine.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                if profiling:
+                    stop_profiler(self.profile)
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                self.coroutine.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+
+def profiled(endpoint):
+    if asyncio.iscoroutinefunction(endpoint):
+
+        @wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            return await ProfiledCoroutine(endpoint(*args, **kwargs), profile)
+
+        return async_wrapper
+
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None or not start_profiler(profile):
+            return endpoint(*args, **kwargs)
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            stop_profiler(profile)
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint) if PROFILING_AVAILABLE else endpoint, **kwargs)
+
+
+# 3.計測するリクエストを選び、計測結果をレスポンスのヘッダーとファイルに出す(ASGIのミドルウェア)
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILING_AVAILABLE:
+            await self.app(scope, receive, send)
+            return
+
+        token = None
+        for name, value in scope["headers"]:
+            if name == b"x-profile-token":
+                token = value.decode("latin-1")
+                break
+        # ヘッダーで指定された場合だけ、レスポンスのヘッダーに結果を付ける(無作為に選ばれた場合はファイルに書くだけ)
+        attach = is_authorized(token)
+        if not attach and not (PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["path"])
+        reset_token = current_profile.set(profile)
+
+        # レスポンスのヘッダーを送る時点までの時間を計測結果とする(本文の送信は含めない)
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                summary = profile.summary(time.perf_counter() - profile.started_at)
+                profile.write(summary)
+            if message["type"] == "http.response.start" and attach:
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile.profile_id.encode()))
+                for name in ("total_ms", "sql_ms", "python_ms"):
+                    headers.append((f"x-profile-{name.replace('_ms', '')}-ms".encode(), f"{summary[name]:.2f}".encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            current_profile.reset(reset_token)
+
+
+# 書き出した計測結果(JSON)を返す
+@router.get("/profiling/{profile_id}")
+def get_profile(profile_id: str, x_profile_token: str | None = Header(default=None)):
+    if not is_authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if not all(c.isalnum() or c == "-" for c in profile_id):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    try:
+        with open(os.path.join(PROFILING_DIR, f"{profile_id}.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Profile not found")
@@ -4,20 +4,26 @@ from sqlalchemy import select, and_, func
 
 
 from db_control.mymodels import Purchase, PurchaseDetail, EC_Brand, Brand
+from db_control.migrate_purchase_details import compact_details
 from db_control.connect import get_db
 from db_control.token import get_current_user_id
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 
-from db_control.schemas import PurchaseSetItem, TransactionResponse, ECSearchResult, Purchaselog, PurchaseItem, PurchaselogPage
+from db_control.catalog import get_catalog
+from db_control.images import get_list_pictures_base64
+from db_control.purchase_counts import submit_purchase_count_refresh
+from db_control.profiling import ProfiledRoute
+from db_control.schemas import PurchaseSetItem, TransactionResponse, ECSearchResult, PurchaselogPage
 from typing import List
-import base64
 
 # from .mymodels import Survey, Brand, Preference, User, EC_Brand, EC_Set
 
 from scipy.spatial.distance import cosine
 from datetime import date, datetime
 
-router = APIRouter()
+# 遅いリクエストを調べるときはエンドポイントをプロファイルできるようにしておく(db_control/profiling.py)
+router = APIRouter(route_class=ProfiledRoute)
 
 
 @router.post("/purchase", response_model=TransactionResponse)
@@ -43,44 +49,37 @@ def create_purchase(purchase: List[PurchaseSetItem], db: Session = Depends(get_d
         purchase_id = transaction.purchase_id
 
         # 取引明細へ登録
-        detail_id = 0
-        for id1, set in enumerate(purchase):
-            # ナショナルについて書き込み
-            for id2, item in enumerate(set.national_set.details):
-                for count in range(item.count):
-                    detail_id += 1
-                    detail = PurchaseDetail(
-                        purchase_id=purchase_id,
-                        ec_set_id=item.ec_set_id,
-                        detail_id=detail_id,
-                        ec_brand_id=item.ec_brand_id,
-                        category=item.category,
-                        name=item.name,
-                        price=item.price,
-                    )
-                    db.add(detail)
-                    total_amount += item.price
-                    # ナショナルについて書き込み
-
-            for id2, item in enumerate(set.craft_set.details):
-                for count in range(item.count):
-                    detail_id += 1
-                    detail = PurchaseDetail(
-                        purchase_id=purchase_id,
-                        ec_set_id=item.ec_set_id,
-                        detail_id=detail_id,
-                        ec_brand_id=item.ec_brand_id,
-                        category=item.category,
-                        name=item.name,
-                        price=item.price,
-                    )
-                    db.add(detail)
-                    total_amount += item.price
+        # 1購入内の(ec_set_id, ec_brand_id)ごとに1行とし、本数はquantityに入れる
+        rows = []
+        for set in purchase:
+            # ナショナル・クラフトの順に書き込み
+            for item in set.national_set.details + set.craft_set.details:
+                if item.count <= 0:
+                    continue
+                rows.append(
+                    {
+                        "purchase_id": purchase_id,
+                        "ec_set_id": item.ec_set_id,
+                        "ec_brand_id": item.ec_brand_id,
+                        "category": item.category,
+                        "name": item.name,
+                        "price": item.price,
+                        "quantity": item.count,
+                    }
+                )
+                total_amount += item.price * item.count
+
+        db.add_all([PurchaseDetail(**row) for row in compact_details(rows)])
 
         # 取引テーブルを更新
         transaction.total_amount = total_amount
         db.commit()
 
+        # 入力補完の人気順に使うブランドごとの購入本数は、応答を返した後にジョブで集計し直す
+        ec_brands_by_id = get_catalog(db).ec_brands_by_id
+        brand_ids = [ec_brands_by_id[row["ec_brand_id"]].brand_id for row in rows if row["ec_brand_id"] in ec_brands_by_id]
+        submit_purchase_count_refresh([brand_id for brand_id in brand_ids if brand_id is not None], db)
+
     except Exception as e:
         db.rollback()
         # print(f"Error occurred: {str(e)}")
@@ -158,50 +157,46 @@ def get_purchaselog(
                 PurchaseDetail.name,
                 PurchaseDetail.price,
                 PurchaseDetail.ec_set_id,
-                func.count(PurchaseDetail.ec_brand_id).label('count'),
+                PurchaseDetail.quantity.label('count'),
             )
             .filter(PurchaseDetail.purchase_id == purchase.purchase_id)
-            .group_by(
-                PurchaseDetail.ec_brand_id,
-                PurchaseDetail.category,
-                PurchaseDetail.name,
-                PurchaseDetail.price,
-                PurchaseDetail.ec_set_id,
-            )
+            .order_by(PurchaseDetail.detail_id)
             .all()
         )
 
+        # 明細のec_brand_idからbrand_idを引き、Brandの画像の一覧表示用の縮小版(なければ元画像)をまとめて取得する
+        ec_brand_ids = [row.ec_brand_id for row in purchase_details]
+        brand_id_by_ec_brand = dict(db.query(EC_Brand.ec_brand_id, EC_Brand.brand_id).filter(EC_Brand.ec_brand_id.in_(ec_brand_ids)).all())
+        pictures = get_list_pictures_base64(db, "brand", brand_id_by_ec_brand.values())
+
         details = []
 
         for row in purchase_details:
-            ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == row.ec_brand_id).first()
-            picture = None
-            if ec_brand:
-                brand = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-                if brand and brand.brand_picture:
-                    picture = base64.b64encode(brand.brand_picture).decode('utf-8')
+            picture, picture_mime_type = pictures.get(brand_id_by_ec_brand.get(row.ec_brand_id), (None, None))
 
             details.append(
-                PurchaseItem(
-                    ec_brand_id=row.ec_brand_id,
-                    category=row.category,
-                    name=row.name,
-                    price=row.price,
-                    count=row.count,
-                    ec_set_id=row.ec_set_id,
-                    picture=picture,
-                )
+                {
+                    "ec_brand_id": row.ec_brand_id,
+                    "category": row.category,
+                    "name": row.name,
+                    "price": row.price,
+                    "count": row.count,
+                    "ec_set_id": row.ec_set_id,
+                    "picture": picture,
+                    "picture_mime_type": picture_mime_type,
+                }
             )
 
-        log = Purchaselog(
-            purchase_id=purchase.purchase_id,
-            date_time=purchase.date_time,
-            total_amount=purchase.total_amount,
-            total_cans=purchase.total_cans,
-            survey_completion=purchase.survey_completion,
-            details=details,
-        )
+        log = {
+            "purchase_id": purchase.purchase_id,
+            "date_time": purchase.date_time,
+            "total_amount": purchase.total_amount,
+            "total_cans": purchase.total_cans,
+            "survey_completion": bool(purchase.survey_completion),
+            "details": details,
+        }
 
         purchase_logs.append(log)
 
-    return PurchaselogPage(page=page, total_page=total_page, purchaselog=purchase_logs)
+    # DBから自分で組み立てたdictなので、response_modelでの再検証を省いてそのままorjsonで返す
+    return ORJSONResponse({"page": page, "total_page": total_page, "purchaselog": purchase_logs})
@@ -0,0 +1,77 @@
+# purchase_detailsを集計したブランドごとの購入本数の合計(brand_purchase_counts)を作り直す・読む
+# purchase_detailsが正で、brand_purchase_countsはそこから作る(DBのテーブルなので、どのワーカーから読んでも同じ値になる)
+# 購入後はジョブ(refresh_brand_purchase_count_job)で購入したブランドの行を作り直す(同じブランドのジョブは重ねて投入しない)
+# 入力補完の人気順(db_control/autocomplete.py)は、一番大きいpurchase_detailsを集計せずにこちらを読む
+# backendディレクトリで以下のように実行する(テーブルが無ければ作成し、全ブランドの分を集計し直す)
+#   python -m db_control.purchase_counts
+#   python -m db_control.purchase_counts --db-url sqlite:///local.db
+import argparse
+from datetime import datetime
+
+from sqlalchemy import create_engine, delete, func, select
+from sqlalchemy.orm import Session
+
+from db_control.jobs import job_queue, session_factory
+from db_control.mymodels import BrandPurchaseCount, EC_Brand, PurchaseDetail
+
+
+# 1.purchase_detailsから指定したブランド(Noneなら全ブランド)の購入本数の合計を1回のクエリで集計する(brand_id -> 本数)
+def compute_purchase_counts(db: Session, brand_ids=None):
+    query = select(EC_Brand.brand_id, func.sum(PurchaseDetail.quantity)).join(EC_Brand, PurchaseDetail.ec_brand_id == EC_Brand.ec_brand_id).group_by(EC_Brand.brand_id)
+    if brand_ids is not None:
+        query = query.where(EC_Brand.brand_id.in_(brand_ids))
+    else:
+        query = query.where(EC_Brand.brand_id.is_not(None))
+    return {brand_id: int(quantity or 0) for brand_id, quantity in db.execute(query)}
+
+
+# 2.指定したブランド(Noneなら全ブランド)のbrand_purchase_countsの行を作り直す(コミットは呼び出し側で行う)。作った行数を返す
+def refresh_purchase_counts(db: Session, brand_ids=None):
+    counts = compute_purchase_counts(db, brand_ids)
+    now = datetime.now()
+    rows = [{"brand_id": brand_id, "quantity": quantity, "updated_at": now} for brand_id, quantity in counts.items()]
+    statement = delete(BrandPurchaseCount)
+    if brand_ids is not None:
+        statement = statement.where(BrandPurchaseCount.brand_id.in_(brand_ids))
+    db.execute(statement)
+    if rows:
+        db.execute(BrandPurchaseCount.__table__.insert(), rows)
+    return len(rows)
+
+
+# 2-1.購入後のジョブ: ブランドの行を作り直してコミットする(何度実行しても同じ結果になる)
+def refresh_brand_purchase_count_job(brand_id: int, new_session):
+    db = new_session()
+    try:
+        refresh_purchase_counts(db, [brand_id])
+        db.commit()
+    finally:
+        db.close()
+
+
+# 2-2.ブランドごとに作り直すジョブを投入する(同じブランドのジョブが実行を待っていれば投入しない)
+def submit_purchase_count_refresh(brand_ids, db: Session):
+    for brand_id in sorted(set(brand_ids)):
+        job_queue.submit("refresh_brand_purchase_count", refresh_brand_purchase_count_job, brand_id, session_factory(db), key=brand_id)
+
+
+# 3.全ブランドの購入本数の合計(brand_id -> 本数)。行の無いブランドは購入されていない
+def load_purchase_counts(db: Session):
+    return dict(db.execute(select(BrandPurchaseCount.brand_id, BrandPurchaseCount.quantity)).all())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild brand_purchase_counts from purchase_details")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    BrandPurchaseCount.__table__.create(engine, checkfirst=True)
+    with Session(engine) as db:
+        count = refresh_purchase_counts(db)
+        db.commit()
+    print(f"brand_purchase_counts: {count} rows")
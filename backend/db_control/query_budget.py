@@ -0,0 +1,81 @@
+# エンドポイントごとに発行されるSQLの回数を数えて、決めた上限(予算)を超えていないかを確認するツール
+# N+1のような1件ごとのクエリが入り込んだときに気付けるようにする
+# backendディレクトリで以下のように実行する(上限を超えたエンドポイントがあれば終了コード1で終わる)
+#   python -m db_control.query_budget
+#   python -m db_control.query_budget --db-url sqlite:///local.db --user-id 1
+import argparse
+import sys
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from db_control import connect
+
+
+# 1.チェック対象(名前, パス, クエリパラメータ, 上限)
+# 画像の縮小版がまだ作られていない場合は元画像を取り直す1回が増えるので、その分も上限に含めておく
+def budgets(user_id: int):
+    return [
+        ("user_favorites: all", "/user_favorites", {"user_id": user_id}, 3),
+        ("user_favorites: paginated", "/user_favorites", {"user_id": user_id, "limit": 2, "offset": 1}, 3),
+        ("photo gallery: first page", f"/users/{user_id}/photos", {"limit": 20}, 2),
+    ]
+
+
+# 2.エンジンで実行されたSQLの回数を数える
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+# 3.全エンドポイントを呼び出して、上限を超えた数を返す
+def run(engine, user_id: int):
+    from main import app
+
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[connect.get_db] = get_db
+    counter = QueryCounter(engine)
+    client = TestClient(app)
+
+    failures = 0
+    for name, path, params, budget in budgets(user_id):
+        counter.count = 0
+        response = client.get(path, params=params)
+        status = "ok" if counter.count <= budget else "OVER BUDGET"
+        print(f"[{status}] {name}: {counter.count} queries (budget {budget}, HTTP {response.status_code})")
+        if counter.count > budget:
+            failures += 1
+
+    app.dependency_overrides.clear()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if an endpoint issues more SQL statements than its budget")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--user-id", type=int, default=1, help="user whose data is requested")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        engine = connect.engine
+
+    failures = run(engine, args.user_id)
+    if failures:
+        print(f"{failures} endpoints exceeded their query budget")
+        sys.exit(1)
+    print("All endpoints are within their query budget")
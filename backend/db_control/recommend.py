@@ -1,97 +1,112 @@
 import pandas as pd
+import numpy as np
 from sqlalchemy.orm import Session
 from sqlalchemy import select, and_, func
 
-from db_control.mymodels import Brand, Preference, User, EC_Brand, Survey, EC_Set, Purchase, PurchaseDetail, Favorite
+from db_control.mymodels import Brand, Preference, User, EC_Brand, SurveyVector, EC_Set, Purchase, PurchaseDetail, Favorite, PrecomputedRecommendation, PreferenceVersion
 from db_control.connect import get_db
 from db_control.token import get_current_user_id
 from fastapi import APIRouter, Depends, HTTPException, Query
-
-from db_control.schemas import RecommendQueryParams, RecommendResponseItem, ECSetItem, BrandPreferences
+from fastapi.responses import ORJSONResponse
+
+from db_control.catalog import get_catalog, brand_id_mask
+from db_control.images import get_list_pictures_base64
+from db_control.profiling import ProfiledRoute
+from db_control.singleflight import get_flight
+from db_control.survey_matrix import get_survey_matrix
+from db_control.survey_vectors import SCORE_COLUMNS
+from db_control.snapshot import get_snapshot
+from db_control.schemas import RecommendQueryParams, RecommendResponseItem, ECSetItem, BrandPreferences, RecommendBatchRequest, RecommendBatchResponse
 from typing import List
 
 # from .mymodels import Survey, Brand, Preference, User, EC_Brand, EC_Set
 
-from scipy.spatial.distance import cosine
 from datetime import date, datetime, timedelta
 import math
 import random
-import base64
+import time
+import os
+from dotenv import load_dotenv
+
+# 環境変数のロード
+load_dotenv()
+# 事前計算したリコメンド結果を新鮮とみなす時間(時間単位)。これを過ぎたらその場で計算する
+PRECOMPUTED_RECOMMENDATION_TTL_HOURS = float(os.getenv("PRECOMPUTED_RECOMMENDATION_TTL_HOURS", "24"))
+# ランダムに選ぶアルゴリズム(recommend_diverse_preferred_products)の乱数のseed。テストやベンチマークで結果を再現したいときに指定する
+RECOMMEND_RANDOM_SEED = os.getenv("RECOMMEND_RANDOM_SEED")
+
+# 遅いリクエストを調べるときはエンドポイントをプロファイルできるようにしておく(db_control/profiling.py)
+router = APIRouter(route_class=ProfiledRoute)
+recommend_flight = get_flight("recommend")
+recommend_random = random.Random(None if RECOMMEND_RANDOM_SEED is None else int(RECOMMEND_RANDOM_SEED))
 
-router = APIRouter()
+ITEM_COLUMNS = [f'id{i}' for i in range(1, 9)]
 
 
 # セット情報の取得
 def get_ec_sets_by_category(db: Session, category: str):
-    return (
-        db.query(
-            EC_Set.ec_set_id,
-            EC_Set.set_name,
-            EC_Set.set_description,
-        )
-        .filter(EC_Set.category == category, EC_Set.ec_set_id < 900)  # ec_set_idが900未満のものを抽出(900以上はダミーデータ)
-        .all()
-    )
+    # ec_set_idが900未満のものを抽出(900以上はダミーデータ)
+    return [ec_set for ec_set in get_catalog(db).ec_sets_by_category.get(category, ()) if ec_set.ec_set_id < 900]
 
 
 # 1.製品に関するベクトル情報を取得する
-# 1-1.ageとgenderの条件に当てはまるデータを取得（データが存在するbrand_idを取得するために使う）
-def get_filtered_data_by_age_gender(age: int, gender: int, category: str, db: Session):
+# 1-1.ageとgenderの条件とcategoryに当てはまるブランドの8次元ベクトルを、survey_vectors(1つのsurvey_idにつき1行)から取得する
+# 同じブランドに複数の行が当てはまる場合は、項目ごとにsurvey_idが後ろの行の値を使う(共有している配列と同じ)
+def get_survey_vectors_from_db(age: int, gender: int, category: str, db: Session):
     query = (
-        select(Survey)
+        select(SurveyVector.brand_id, *SCORE_COLUMNS)
         .join(Brand)
         .where(
             and_(
-                Survey.age_lower_limit < age,
-                Survey.age_upper_limit > age,
-                Survey.gender == gender,
+                SurveyVector.age_lower_limit < age,
+                SurveyVector.age_upper_limit > age,
+                SurveyVector.gender == gender,
                 Brand.category == category,
             )
         )
+        .order_by(SurveyVector.survey_id)
     )
 
-    results = db.execute(query).mappings().all()
-
-    return results
-
-
-# 1-2.抽出したデータに含まれるbrand_idの種類を取得
-def get_unique_brand_ids(results):
-    brand_ids = {row['Survey'].brand_id for row in results}  # {}集合なので重複なしが得られる
-    return brand_ids
-
-
-# 1-3.brand_id, age, genderの条件に当てはまるデータをSuveyから抽出して、brand_idのベクトル情報として整理する
-def get_filtered_data(brand_id: int, age: int, gender: int, db: Session):
-    query = select(Survey).where(and_(Survey.brand_id == brand_id, Survey.age_lower_limit < age, Survey.age_upper_limit > age, Survey.item_id.in_([1, 2, 3, 4, 5, 6, 7, 8]), Survey.gender == gender))
+    vectors = {}
+    for brand_id, *scores in db.execute(query).all():
+        vector = vectors.setdefault(brand_id, [None] * len(SCORE_COLUMNS))
+        for i, score in enumerate(scores):
+            if score is not None:
+                vector[i] = score
 
-    # 出力結果をうまく扱えなかったので辞書形式にする
-    results = db.execute(query).mappings().fetchall()
-
-    # スコアを8次元のベクトルとして整理
-    data = {'brand_id': [brand_id], 'age': [age], 'gender': [gender], 'id1': [None], 'id2': [None], 'id3': [None], 'id4': [None], 'id5': [None], 'id6': [None], 'id7': [None], 'id8': [None]}
+    brand_ids = sorted(vectors)
+    return np.array(brand_ids, dtype=np.int64), np.array([vectors[brand_id] for brand_id in brand_ids], dtype=np.float64).reshape(len(brand_ids), len(SCORE_COLUMNS))
 
-    for row in results:
-        survey = row['Survey']  # 辞書からオブジェクトを取り出す
-        item_id = survey.item_id
-        if 1 <= item_id <= 8:
-            data[f'id{item_id}'][0] = survey.score
 
-    df = pd.DataFrame(data)
-    return df
+# 1-2. 年齢・性別・categoryに当てはまるブランドの(brand_idの配列, 8次元ベクトルの配列)をbrand_id順に返す
+# DBと一致しているディスク上のスナップショット(db_control/snapshot.py)があればそこから作る
+# 無ければワーカー間で共有しているsurveysの配列(db_control/survey_matrix.py)から、共有ディレクトリも使えない場合はDBから作る
+def get_survey_vectors(age: int, gender: int, category: str, db: Session):
+    snapshot = get_snapshot(db)
+    if snapshot is not None:
+        brand_ids, vectors = snapshot.survey_vectors_for(age, gender, category)
+    else:
+        try:
+            matrix = get_survey_matrix(db)
+        except OSError:
+            return get_survey_vectors_from_db(age, gender, category, db)
 
+        category_brand_ids = [brand.brand_id for brand in get_catalog(db).brands_by_category.get(category, ())]
+        brand_ids, vectors = matrix.vectors_for(age, gender, category_brand_ids)
 
-# 1-4. 各brand_idについて、get_filtered_dataを使用してデータを取得し、一つのDataFrameを作成
-def get_combined_data(age: int, gender: int, category: str, db: Session):
-    results = get_filtered_data_by_age_gender(age, gender, category, db)
-    brand_ids = get_unique_brand_ids(results)
+    return brand_ids.astype(np.int64), np.asarray(vectors, dtype=np.float64)
 
-    combined_data = pd.DataFrame()
 
-    for brand_id in brand_ids:
-        df = get_filtered_data(brand_id, age, gender, db)
-        combined_data = pd.concat([combined_data, df], ignore_index=True)
+# get_survey_vectors(from_db=Trueの場合はget_survey_vectors_from_db)の結果をDataFrameにしたもの(brand_id, age, gender, id1~id8の列)
+def get_combined_data(age: int, gender: int, category: str, db: Session, from_db: bool = False):
+    brand_ids, vectors = (get_survey_vectors_from_db if from_db else get_survey_vectors)(age, gender, category, db)
+    if len(brand_ids) == 0:
+        return pd.DataFrame()
 
+    combined_data = pd.DataFrame(vectors, columns=ITEM_COLUMNS)
+    combined_data.insert(0, 'brand_id', brand_ids)
+    combined_data.insert(1, 'age', age)
+    combined_data.insert(2, 'gender', gender)
     return combined_data
 
 
@@ -105,51 +120,81 @@ def get_user_preferences(user_id: int, db: Session):
     return results
 
 
-# 2-2. item_idに対応するscoreを8次元のベクトルとして整理して、結果をDataFrame形式で出力
+# 2-2. item_idに対応するscoreを8次元のベクトル(回答が無い項目はNaN)として整理する
 def get_user_preference_vector(user_id: int, db: Session):
     results = get_user_preferences(user_id, db)
 
-    # スコアを8次元のベクトルとして整理
-    data = {'user_id': [user_id], 'id1': [None], 'id2': [None], 'id3': [None], 'id4': [None], 'id5': [None], 'id6': [None], 'id7': [None], 'id8': [None]}
-
+    vector = np.full(len(ITEM_COLUMNS), np.nan)
     for row in results:
         preference = row['Preference']  # 辞書からオブジェクトを取り出す
         item_id = preference.item_id
         if 1 <= item_id <= 8:
-            data[f'id{item_id}'][0] = preference.score
+            vector[item_id - 1] = np.nan if preference.score is None else preference.score
 
-    df = pd.DataFrame(data)
-    return df
+    return vector
+
+
+# 2-3. ユーザーの好みのバージョン(一度も更新していなければ0)。事前計算結果が古くないかの確認に使う
+def get_preference_version(user_id: int, db: Session):
+    version = db.execute(select(PreferenceVersion.version).where(PreferenceVersion.user_id == user_id)).scalar()
+    return version or 0
 
 
 # 3.ユーザーの好みベクトルを用いて、各製品のベクトルに対してcos類似度を計算し、リコメンド順にソートしたものを返す
-# 3-1.Cos類似度を計算する関数(scipyを利用)
-def calculate_cosine_similarity(vector1: list[float], vector2: list[float]):
-    return 1 - cosine(vector1, vector2)
+# cos類似度の降順に並べたbrand_idとrec_score
+class Ranking:
+    __slots__ = ("brand_ids", "rec_scores")
+
+    def __init__(self, brand_ids: np.ndarray, rec_scores: np.ndarray):
+        self.brand_ids = brand_ids
+        self.rec_scores = rec_scores
+
+    def __len__(self):
+        return len(self.brand_ids)
+
+    # ng_idなど除外するbrand_idを除いた上位(kinds)個のbrand_id
+    def top(self, kinds: int, excluded_brand_ids=()):
+        return self.brand_ids[~brand_id_mask(self.brand_ids, excluded_brand_ids)][:kinds].tolist()
+
+    # 除外するbrand_idを除いた下位(kinds)個のbrand_id(ランキング順のまま)
+    def bottom(self, kinds: int, excluded_brand_ids=()):
+        if kinds <= 0:
+            return []
+        return self.brand_ids[~brand_id_mask(self.brand_ids, excluded_brand_ids)][-kinds:].tolist()
 
+    # selected_brand_idsに含まれるものだけの上位(kinds)個のbrand_id
+    def top_within(self, kinds: int, selected_brand_ids):
+        return self.brand_ids[brand_id_mask(self.brand_ids, selected_brand_ids)][:kinds].tolist()
 
-# 3-2.combined_dfの8次元ベクトルとuser_dfの8次元ベクトルでcos類似度を計算し、rec_scoreに格納する関数
-def add_recommendation_scores(combined_df: pd.DataFrame, user_vector: pd.DataFrame):
-    combined_df['rec_score'] = 0.0
-    user_vector = user_vector.iloc[0, 1:].values.tolist()  # user_vectorの8次元ベクトルを取得
 
-    for idx, row in combined_df.iterrows():
-        combined_vector = row[['id1', 'id2', 'id3', 'id4', 'id5', 'id6', 'id7', 'id8']].values.tolist()
-        rec_score = calculate_cosine_similarity(combined_vector, user_vector)
-        combined_df.at[idx, 'rec_score'] = rec_score
+# 3-1.scoresを降順に並べる添字(pandasのsort_values(ascending=False)と同じ並び。同点の順序も同じで、NaNは元の順のまま最後)
+def argsort_descending(scores: np.ndarray):
+    nan_mask = np.isnan(scores)
+    index = np.flatnonzero(~nan_mask)[::-1]
+    order = index[scores[index].argsort(kind='quicksort')][::-1]
+    return np.concatenate([order, np.flatnonzero(nan_mask)])
 
-    # 'rec_score'を降順でソート
-    combined_df = combined_df.sort_values(by='rec_score', ascending=False).reset_index(drop=True)
 
-    return combined_df
+# 3-2.各製品の8次元ベクトルとユーザーの8次元ベクトルでcos類似度(1 - scipyのcosine距離)をまとめて計算し、降順に並べる
+def rank_by_cosine_similarity(brand_ids: np.ndarray, vectors: np.ndarray, user_vector: np.ndarray):
+    if len(brand_ids) == 0:
+        return Ranking(np.array([], dtype=np.int64), np.array([], dtype=np.float64))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        uv = vectors @ user_vector
+        uu = np.dot(user_vector, user_vector)
+        vv = np.einsum('ij,ij->i', vectors, vectors)
+        rec_scores = 1 - np.clip(1.0 - uv / np.sqrt(uu * vv), 0.0, 2.0)
+
+    order = argsort_descending(rec_scores)
+    return Ranking(brand_ids[order], rec_scores[order])
 
 
 # 4.1~3をすべてをまとめて、cos類似度でソートした結果を返す
 def recommendation_by_cosine_similarity(user_id: int, age: int, gender: int, category: str, db: Session):
-    combined_df = get_combined_data(age, gender, category, db)
-    user_df = get_user_preference_vector(user_id, db)
-    combined_df = add_recommendation_scores(combined_df, user_df)
-    return combined_df
+    brand_ids, vectors = get_survey_vectors(age, gender, category, db)
+    user_vector = get_user_preference_vector(user_id, db)
+    return rank_by_cosine_similarity(brand_ids, vectors, user_vector)
 
 
 # user_idに対するbirthdateとgenderを基に計算して、age, genderを返す
@@ -169,57 +214,124 @@ def get_user_age_and_gender(user_id: int, db: Session):
     return age, gender
 
 
-# ec_set_id=2の計算
-def recommend_preferred_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session):
+# 5.事前計算したcos類似度ランキングの保存・読み出し(db_control/precompute.pyの夜間バッチで作成する)
+# 5-1.ランキングをPrecomputedRecommendationの1行分の値(dict)に変換する
+def pack_ranking(user_id: int, age: int, gender: int, category: str, ranking: Ranking, preference_version: int):
+    return {
+        "user_id": user_id,
+        "category": category,
+        "age": age,
+        "gender": gender,
+        "preference_version": preference_version,
+        "brand_ids": ranking.brand_ids.astype(np.int32).tobytes(),
+        "rec_scores": ranking.rec_scores.astype(np.float64).tobytes(),
+        "computed_at": datetime.now(),
+    }
+
+
+# 5-2.新鮮な事前計算結果があればランキングに戻して返す(なければNone)
+# 年齢・性別・好みのバージョンが計算時から変わっている場合や、TTLを過ぎている場合は使わない
+def load_precomputed_ranking(user_id: int, age: int, gender: int, category: str, db: Session):
+    query = (
+        select(PrecomputedRecommendation, func.coalesce(PreferenceVersion.version, 0))
+        .outerjoin(PreferenceVersion, PreferenceVersion.user_id == PrecomputedRecommendation.user_id)
+        .where(PrecomputedRecommendation.user_id == user_id, PrecomputedRecommendation.category == category)
+    )
+    result = db.execute(query).first()
+    if result is None:
+        return None
+
+    row, preference_version = result
+    if row.age != age or row.gender != gender or row.preference_version != preference_version:
+        return None
+    if datetime.now() - row.computed_at > timedelta(hours=PRECOMPUTED_RECOMMENDATION_TTL_HOURS):
+        return None
+
+    return Ranking(np.frombuffer(row.brand_ids, dtype=np.int32).astype(np.int64), np.frombuffer(row.rec_scores, dtype=np.float64))
+
+
+# 5-3.事前計算結果があればそれを使い、なければその場で計算する
+def get_cached_ranking(user_id: int, age: int, gender: int, category: str, db: Session):
+    ranking = load_precomputed_ranking(user_id, age, gender, category, db)
+    if ranking is None:
+        ranking = recommendation_by_cosine_similarity(user_id, age, gender, category, db)
+    return ranking
+
+
+# 複数セットをまとめてリコメンドする際に、ユーザー・カテゴリ単位で共通の計算結果を使い回すための入れ物
+# (age/gender、ユーザーの好みベクトル、カテゴリごとのcos類似度ランキング)
+class RecommendContext:
+    def __init__(self, user_id: int, db: Session):
+        self.user_id = user_id
+        self.db = db
+        self.age = None
+        self.gender = None
+        self.user_vector = None
+        self.rankings = {}  # category -> cos類似度でソート済みのランキング
+        self.shared_seconds = 0.0  # 共通部分の計算に掛かった時間の累計
+
+    def get_age_and_gender(self):
+        if self.age is None and self.gender is None:
+            self.age, self.gender = get_user_age_and_gender(self.user_id, self.db)
+        return self.age, self.gender
+
+    def get_user_vector(self):
+        if self.user_vector is None:
+            self.user_vector = get_user_preference_vector(self.user_id, self.db)
+        return self.user_vector
+
+    def get_ranking(self, category: str):
+        if category not in self.rankings:
+            start = time.perf_counter()
+            age, gender = self.get_age_and_gender()
+            ranking = load_precomputed_ranking(self.user_id, age, gender, category, self.db)
+            if ranking is None:
+                brand_ids, vectors = get_survey_vectors(age, gender, category, self.db)
+                ranking = rank_by_cosine_similarity(brand_ids, vectors, self.get_user_vector())
+            self.rankings[category] = ranking
+            self.shared_seconds += time.perf_counter() - start
+        return self.rankings[category]
+
+
+# contextがあれば共通の計算結果を使い、なければ事前計算結果またはその場での計算結果を使う
+def get_ranking(user_id: int, category: str, db: Session, context: RecommendContext | None = None):
+    if context is not None:
+        return context.get_ranking(category)
 
     age, gender = get_user_age_and_gender(user_id, db)
-    recommendation_df = recommendation_by_cosine_similarity(user_id, age, gender, category, db)
+    return get_cached_ranking(user_id, age, gender, category, db)
 
-    # ng_idに含まれないbrand_idを持つ行を抽出
-    # ng_idがNoneまたは空リストでないことを確認
-    if ng_id is not None and len(ng_id) > 0:
-        query_str = ' & '.join([f'brand_id != {i}' for i in ng_id])
-        filtered_recommendation_df = recommendation_df.query(query_str)
-    else:
-        # ng_idがNoneまたは空リストの場合、全ての行を保持
-        filtered_recommendation_df = recommendation_df
 
-    recommendation_df = filtered_recommendation_df.head(kinds)[["brand_id"]]
+# EC_Brandの行のリストをレスポンス用のdictのリストに変換する
+# 画像はBrandの画像の一覧表示用の縮小版(なければ元画像)をBase64にして"picture"に、そのMIMEタイプを"picture_mime_type"に入れる
+def build_response_data(result, cans: int, kinds: int, db: Session):
+    pictures = get_list_pictures_base64(db, "brand", [brand.brand_id for brand in result])
 
-    # recommendation_df = recommendation_df.head(kinds)[["brand_id"]]
+    return [
+        {
+            "ec_brand_id": brand.ec_brand_id,
+            "name": brand.name,
+            "description": brand.description,
+            "price": brand.price,
+            "count": int(cans / kinds),
+            "picture": pictures.get(brand.brand_id, (None, None))[0],  # Base64エンコードされた画像データ
+            "picture_mime_type": pictures.get(brand.brand_id, (None, None))[1],
+        }
+        for brand in result
+    ]
 
-    brand_ids = recommendation_df["brand_id"].tolist()
-    stmt = select(EC_Brand).where(EC_Brand.brand_id.in_(brand_ids))
-    result = db.execute(stmt).scalars().all()
 
-    # resultに画像データを追加したものをresponse_dataとして返す
-    response_data = []
-
-    for brand in result:
-        # 1. EC_Brandテーブルを参照して、brand_idを取得
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == brand.ec_brand_id).first()
-
-        # 2. Brandテーブルを参照して、brand_idに一致するデータのbrand_pictureを取得
-        picture = None
-        if ec_brand:
-            brand_data = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-            if brand_data and brand_data.brand_picture:
-                # 3. データをBase64にエンコードしてresponse_dataに"picture"を追加
-                picture = base64.b64encode(brand_data.brand_picture).decode('utf-8')
-
-        # response_dataに追加
-        response_data.append(
-            {
-                "ec_brand_id": brand.ec_brand_id,
-                "name": brand.name,
-                "description": brand.description,
-                "price": brand.price,
-                "count": int(cans / kinds),
-                "picture": picture,  # Base64エンコードされた画像データを追加
-            }
-        )
+# ec_set_id=2の計算
+def recommend_preferred_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session, context: RecommendContext | None = None):
 
-    return response_data
+    ranking = get_ranking(user_id, category, db, context)
+
+    # ng_idに含まれないbrand_idのうち、上位(kinds)個を取得
+    brand_ids = ranking.top(kinds, ng_id or ())
+    result = get_catalog(db).ec_brands_for_brand_ids(brand_ids)
+
+    # resultに画像データを追加したものをresponse_dataとして返す
+    return build_response_data(result, cans, kinds, db)
 
 
 # 最近１か月で購入されたec_brand_idを購入数が多い順にソートした結果を返す
@@ -231,7 +343,7 @@ def recommendation_by_popularity(user_id: int, category: str, ng_id: list[int],
     # 2. 抽出した各データについてpurchase_idを用いて、PurchaseDetailテーブルを参照して、ng_idに含まれるbrand_idを除外
     purchase_ids = [purchase.purchase_id for purchase in recent_purchases]
     purchase_details = (
-        db.query(PurchaseDetail)
+        db.query(PurchaseDetail.ec_brand_id, PurchaseDetail.quantity)
         .filter(
             PurchaseDetail.purchase_id.in_(purchase_ids),
             PurchaseDetail.category == category,
@@ -240,63 +352,39 @@ def recommendation_by_popularity(user_id: int, category: str, ng_id: list[int],
         .all()
     )
 
-    # 3. 抽出された全PurchaseDetailを確認して、その中に入っている、ec_brand_idを重複なく取得
+    # 3. 抽出された全PurchaseDetailを確認して、ec_brand_idごとに本数(quantity)を合計
     brand_counts = {}
     for detail in purchase_details:
         if detail.ec_brand_id not in brand_counts:
             brand_counts[detail.ec_brand_id] = 0
-        brand_counts[detail.ec_brand_id] += 1
+        brand_counts[detail.ec_brand_id] += detail.quantity
 
-    # 4. 3で作成したec_brand_idのそれぞれについて、個数を計算し、DataFrame形式で求める
-    data = {'ec_brand_id': list(brand_counts.keys()), 'score': list(brand_counts.values())}
-    df = pd.DataFrame(data)
+    # 4. 3で作成したec_brand_idのそれぞれについて、個数を配列にする
+    ec_brand_ids = np.array(list(brand_counts.keys()), dtype=np.int64)
+    scores = np.array(list(brand_counts.values()), dtype=np.float64)
 
-    # 5. "score"が昇順になるように結果をソートしたものを返す
-    df_sorted = df.sort_values(by='score', ascending=False)
+    # 5. 個数が多い順に並べたec_brand_idを返す
+    return ec_brand_ids[argsort_descending(scores)].tolist()
 
-    return df_sorted
 
-
-def recommend_popular_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session):
+def recommend_popular_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session, context: RecommendContext | None = None):
     # 1. recommendation_by_popularity関数を用いて、結果を取得する（ng_idを引数に追加）
-    df_sorted = recommendation_by_popularity(user_id, category, ng_id, db)
+    sorted_ec_brand_ids = recommendation_by_popularity(user_id, category, ng_id, db)
 
     # 2. 上位(kinds)個のデータを取得する際には、ng_listを取り除く必要はありません
-    top_kinds_df = df_sorted.head(kinds)
+    ec_brand_ids = sorted_ec_brand_ids[:kinds]
 
     # 3. そのように得られたec_brand_idについて、EC_Brandテーブルを参照して、ec_brand_idが一致するデータを取得する
-    ec_brand_ids = top_kinds_df['ec_brand_id'].tolist()
-    result = db.query(EC_Brand).filter(EC_Brand.ec_brand_id.in_(ec_brand_ids)).all()
+    result = get_catalog(db).ec_brands_for_ids(ec_brand_ids)
 
     # 4. その結果を用いて、response_dataに変換して返す
     # resultに画像データを追加したものをresponse_dataとして返す
-    response_data = []
-
-    for brand in result:
-        # 1. EC_Brandテーブルを参照して、brand_idを取得
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == brand.ec_brand_id).first()
-
-        # 2. Brandテーブルを参照して、brand_idに一致するデータのbrand_pictureを取得
-        picture = None
-        if ec_brand:
-            brand_data = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-            if brand_data and brand_data.brand_picture:
-                # 3. データをBase64にエンコードしてresponse_dataに"picture"を追加
-                picture = base64.b64encode(brand_data.brand_picture).decode('utf-8')
-
-        # response_dataに追加
-        response_data.append(
-            {
-                "ec_brand_id": brand.ec_brand_id,
-                "name": brand.name,
-                "description": brand.description,
-                "price": brand.price,
-                "count": int(cans / kinds),
-                "picture": picture,  # Base64エンコードされた画像データを追加
-            }
-        )
+    return build_response_data(result, cans, kinds, db)
+
 
-    return response_data
+# リコメンドで使う乱数のseedを設定し直す(評価やベンチマークで実行ごとに同じ結果にするため)
+def seed_recommend_random(seed: int | None):
+    recommend_random.seed(seed)
 
 
 def split_kinds(kinds: int):
@@ -306,260 +394,111 @@ def split_kinds(kinds: int):
     return majority_kinds, minority_kinds
 
 
-def recommend_diverse_preferred_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session):
-    # 1. recommendation_dfを取得
-    age, gender = get_user_age_and_gender(user_id, db)
-    recommendation_df = recommendation_by_cosine_similarity(user_id, age, gender, category, db)
+def recommend_diverse_preferred_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session, context: RecommendContext | None = None):
+    # 1. ランキングを取得
+    ranking = get_ranking(user_id, category, db, context)
 
     # kindsをmajority_kindsとminority_kindsに分割
     majority_kinds, minority_kinds = split_kinds(kinds)
 
     # 2. minority_kindsが0の場合、処理をスキップする
     if minority_kinds > 0:
-        # recommendation_dfからng_idに含まれるものを除き、上位(minority_kinds)個のbrand_idを取得
-        filtered_recommendation_df = recommendation_df[~recommendation_df['brand_id'].isin(ng_id)]
-        top_minor_brand_ids = filtered_recommendation_df.head(minority_kinds)['brand_id'].tolist()
+        # ランキングからng_idに含まれるものを除き、上位(minority_kinds)個のbrand_idを取得
+        top_minor_brand_ids = ranking.top(minority_kinds, ng_id)
 
         # 3. EC_Brandテーブルから、top_minor_brand_idsに含まれるbrand_idに一致するものを抽出
-        minor_brands = db.query(EC_Brand).filter(EC_Brand.brand_id.in_(top_minor_brand_ids)).all()
+        minor_brands = get_catalog(db).ec_brands_for_brand_ids(top_minor_brand_ids)
     else:
         top_minor_brand_ids = []
         minor_brands = []
 
-    # 4. EC_Brandテーブルから、brand_idが(ng_id + top_minor_brand_ids)に含まれず、かつcategoryが一致するものをすべて抽出
+    # 4. categoryが一致するEC_Brandのidの配列から、brand_idが(ng_id + top_minor_brand_ids)に含まれるものを除く
+    # 5. 残りのブランドからランダムに(majority_kinds)個を選び、選んだものだけを取得
     excluded_brand_ids = ng_id + top_minor_brand_ids
-    remaining_brands = (
-        db.query(EC_Brand)
-        .filter(
-            ~EC_Brand.brand_id.in_(excluded_brand_ids),
-            EC_Brand.category == category,
-        )
-        .all()
-    )
-
-    # 5. 残りのブランドからランダムに(majority_kinds)個を取得
-    if len(remaining_brands) > majority_kinds:
-        major_brands = random.sample(remaining_brands, majority_kinds)
-    else:
-        major_brands = remaining_brands
+    major_brands = get_catalog(db).sample_ec_brands_in_category(category, majority_kinds, excluded_brand_ids, recommend_random)
 
     # 6. 3と5の結果をまとめる
     result = minor_brands + major_brands
 
     # 7. 整理してresponse_dataとして返す
     # resultに画像データを追加したものをresponse_dataとして返す
-    response_data = []
-
-    for brand in result:
-        # 1. EC_Brandテーブルを参照して、brand_idを取得
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == brand.ec_brand_id).first()
-
-        # 2. Brandテーブルを参照して、brand_idに一致するデータのbrand_pictureを取得
-        picture = None
-        if ec_brand:
-            brand_data = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-            if brand_data and brand_data.brand_picture:
-                # 3. データをBase64にエンコードしてresponse_dataに"picture"を追加
-                picture = base64.b64encode(brand_data.brand_picture).decode('utf-8')
-
-        # response_dataに追加
-        response_data.append(
-            {
-                "ec_brand_id": brand.ec_brand_id,
-                "name": brand.name,
-                "description": brand.description,
-                "price": brand.price,
-                "count": int(cans / kinds),
-                "picture": picture,  # Base64エンコードされた画像データを追加
-            }
-        )
-
-    return response_data
+    return build_response_data(result, cans, kinds, db)
 
 
-def recommend_adventurous_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session):
-    # 1. recommendation_dfを取得
-    age, gender = get_user_age_and_gender(user_id, db)
-    recommendation_df = recommendation_by_cosine_similarity(user_id, age, gender, category, db)
+def recommend_adventurous_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session, context: RecommendContext | None = None):
+    # 1. ランキングを取得
+    ranking = get_ranking(user_id, category, db, context)
 
     # kindsをmajority_kindsとminority_kindsに分割
     majority_kinds, minority_kinds = split_kinds(kinds)
 
     # 2. minority_kindsが0の場合、処理をスキップする
     if minority_kinds > 0:
-        # recommendation_dfからng_idに含まれるものを除き、上位(minority_kinds)個のbrand_idを取得
-        filtered_recommendation_df = recommendation_df[~recommendation_df['brand_id'].isin(ng_id)]
-        top_minor_brand_ids = filtered_recommendation_df.head(minority_kinds)['brand_id'].tolist()
+        # ランキングからng_idに含まれるものを除き、上位(minority_kinds)個のbrand_idを取得
+        top_minor_brand_ids = ranking.top(minority_kinds, ng_id)
 
         # 3. EC_Brandテーブルから、top_minor_brand_idsに含まれるbrand_idに一致するものを抽出
-        minor_brands = db.query(EC_Brand).filter(EC_Brand.brand_id.in_(top_minor_brand_ids)).all()
+        minor_brands = get_catalog(db).ec_brands_for_brand_ids(top_minor_brand_ids)
     else:
         top_minor_brand_ids = []
         minor_brands = []
 
-    # 4. recommendation_dfから（top_minor_brand_ids + ng_id）に含まれるものを除き、下位(majority_kinds)個のbrand_idを取得
+    # 4. ランキングから（top_minor_brand_ids + ng_id）に含まれるものを除き、下位(majority_kinds)個のbrand_idを取得
     excluded_brand_ids = ng_id + top_minor_brand_ids
-    remaining_recommendation_df = recommendation_df[~recommendation_df['brand_id'].isin(excluded_brand_ids)]
-    bottom_major_brand_ids = remaining_recommendation_df.tail(majority_kinds)['brand_id'].tolist()
+    bottom_major_brand_ids = ranking.bottom(majority_kinds, excluded_brand_ids)
 
     # 5. EC_Brandテーブルから、bottom_major_brand_idsに含まれるbrand_idに一致するものを取得
-    major_brands = db.query(EC_Brand).filter(EC_Brand.brand_id.in_(bottom_major_brand_ids)).all()
+    major_brands = get_catalog(db).ec_brands_for_brand_ids(bottom_major_brand_ids)
 
     # 6. 3と5の結果をまとめる
     result = minor_brands + major_brands
 
     # 7. 整理してresponse_dataとして返す
     # resultに画像データを追加したものをresponse_dataとして返す
-    response_data = []
-
-    for brand in result:
-        # 1. EC_Brandテーブルを参照して、brand_idを取得
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == brand.ec_brand_id).first()
-
-        # 2. Brandテーブルを参照して、brand_idに一致するデータのbrand_pictureを取得
-        picture = None
-        if ec_brand:
-            brand_data = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-            if brand_data and brand_data.brand_picture:
-                # 3. データをBase64にエンコードしてresponse_dataに"picture"を追加
-                picture = base64.b64encode(brand_data.brand_picture).decode('utf-8')
-
-        # response_dataに追加
-        response_data.append(
-            {
-                "ec_brand_id": brand.ec_brand_id,
-                "name": brand.name,
-                "description": brand.description,
-                "price": brand.price,
-                "count": int(cans / kinds),
-                "picture": picture,  # Base64エンコードされた画像データを追加
-            }
-        )
+    return build_response_data(result, cans, kinds, db)
 
-    return response_data
 
+def recommend_luxury_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session, context: RecommendContext | None = None):
+    # 1. ランキングを取得
+    ranking = get_ranking(user_id, category, db, context)
 
-def recommend_luxury_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session):
-    # 1. recommendation_dfを取得
-    age, gender = get_user_age_and_gender(user_id, db)
-    recommendation_df = recommendation_by_cosine_similarity(user_id, age, gender, category, db)
-
-    # 2. ECブランドテーブルを参照して、categoryが一致し、かつng_idに含まれないbrand_idを持つデータを取得
-    all_brands = (
-        db.query(EC_Brand)
-        .filter(
-            EC_Brand.category == category,
-            ~EC_Brand.brand_id.in_(ng_id),
-        )
-        .all()
-    )
+    # 2. カテゴリの価格順(price降順)のbrand_idの配列から、ng_idに含まれるものを除く
+    # 3. 残りの上位半分（小数点以下切り上げ）のbrand_idを取得(価格順の配列はマスタの読み込み時に作成済み)
+    top_half_brand_ids = get_catalog(db).price_tiers(category).upper_half(ng_id)
 
-    # 3. priceで降順にソートして、上位半分（小数点以下切り上げ）のbrand_idを取得
-    sorted_brands = sorted(all_brands, key=lambda x: x.price, reverse=True)
-    top_half_brands_count = math.ceil(len(sorted_brands) / 2)
-    top_half_brand_ids = [brand.brand_id for brand in sorted_brands[:top_half_brands_count]]
-
-    # 4. recommendation_dfから、top_half_brand_idsを含むものを抽出し、rec_scoreの上位(kinds)個のbrand_idを取得
-    filtered_recommendation_df = recommendation_df[recommendation_df['brand_id'].isin(top_half_brand_ids)]
-    top_kinds_df = filtered_recommendation_df.head(kinds)
-    selected_brand_ids = top_kinds_df['brand_id'].tolist()
+    # 4. ランキングから、top_half_brand_idsを含むものを抽出し、rec_scoreの上位(kinds)個のbrand_idを取得
+    selected_brand_ids = ranking.top_within(kinds, top_half_brand_ids)
 
     # 5. EC_Brandテーブルから、selected_brand_idsに一致するものを取得
-    result = db.query(EC_Brand).filter(EC_Brand.brand_id.in_(selected_brand_ids)).all()
+    result = get_catalog(db).ec_brands_for_brand_ids(selected_brand_ids)
 
     # 6. 整理してresponse_dataとして返す
     # resultに画像データを追加したものをresponse_dataとして返す
-    response_data = []
-
-    for brand in result:
-        # 1. EC_Brandテーブルを参照して、brand_idを取得
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == brand.ec_brand_id).first()
-
-        # 2. Brandテーブルを参照して、brand_idに一致するデータのbrand_pictureを取得
-        picture = None
-        if ec_brand:
-            brand_data = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-            if brand_data and brand_data.brand_picture:
-                # 3. データをBase64にエンコードしてresponse_dataに"picture"を追加
-                picture = base64.b64encode(brand_data.brand_picture).decode('utf-8')
-
-        # response_dataに追加
-        response_data.append(
-            {
-                "ec_brand_id": brand.ec_brand_id,
-                "name": brand.name,
-                "description": brand.description,
-                "price": brand.price,
-                "count": int(cans / kinds),
-                "picture": picture,  # Base64エンコードされた画像データを追加
-            }
-        )
-
-    return response_data
+    return build_response_data(result, cans, kinds, db)
 
 
-def recommend_budget_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session):
-    # 1. recommendation_dfを取得
-    age, gender = get_user_age_and_gender(user_id, db)
-    recommendation_df = recommendation_by_cosine_similarity(user_id, age, gender, category, db)
-
-    # 2. ECブランドテーブルを参照して、categoryが一致し、かつng_idに含まれないbrand_idを持つデータを取得
-    all_brands = (
-        db.query(EC_Brand)
-        .filter(
-            EC_Brand.category == category,
-            ~EC_Brand.brand_id.in_(ng_id),
-        )
-        .all()
-    )
+def recommend_budget_products(user_id: int, category: str, cans: int, kinds: int, ng_id: list[int], db: Session, context: RecommendContext | None = None):
+    # 1. ランキングを取得
+    ranking = get_ranking(user_id, category, db, context)
 
-    # 3. priceで昇順にソートして、上位半分（小数点以下切り上げ）のbrand_idを取得
-    sorted_brands = sorted(all_brands, key=lambda x: x.price)
-    top_half_brands_count = math.ceil(len(sorted_brands) / 2)
-    top_half_brand_ids = [brand.brand_id for brand in sorted_brands[:top_half_brands_count]]
+    # 2. カテゴリの価格順(price昇順)のbrand_idの配列から、ng_idに含まれるものを除く
+    # 3. 残りの上位半分（小数点以下切り上げ）のbrand_idを取得(価格順の配列はマスタの読み込み時に作成済み)
+    top_half_brand_ids = get_catalog(db).price_tiers(category).lower_half(ng_id)
 
-    # 4. recommendation_dfから、top_half_brand_idsを含むものを抽出し、rec_scoreの上位(kinds)個のbrand_idを取得
-    filtered_recommendation_df = recommendation_df[recommendation_df['brand_id'].isin(top_half_brand_ids)]
-    top_kinds_df = filtered_recommendation_df.head(kinds)
-    selected_brand_ids = top_kinds_df['brand_id'].tolist()
+    # 4. ランキングから、top_half_brand_idsを含むものを抽出し、rec_scoreの上位(kinds)個のbrand_idを取得
+    selected_brand_ids = ranking.top_within(kinds, top_half_brand_ids)
 
     # 5. EC_Brandテーブルから、selected_brand_idsに一致するものを取得
-    result = db.query(EC_Brand).filter(EC_Brand.brand_id.in_(selected_brand_ids)).all()
+    result = get_catalog(db).ec_brands_for_brand_ids(selected_brand_ids)
 
     # 6. 整理してresponse_dataとして返す
     # resultに画像データを追加したものをresponse_dataとして返す
-    response_data = []
-
-    for brand in result:
-        # 1. EC_Brandテーブルを参照して、brand_idを取得
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == brand.ec_brand_id).first()
-
-        # 2. Brandテーブルを参照して、brand_idに一致するデータのbrand_pictureを取得
-        picture = None
-        if ec_brand:
-            brand_data = db.query(Brand).filter(Brand.brand_id == ec_brand.brand_id).first()
-            if brand_data and brand_data.brand_picture:
-                # 3. データをBase64にエンコードしてresponse_dataに"picture"を追加
-                picture = base64.b64encode(brand_data.brand_picture).decode('utf-8')
-
-        # response_dataに追加
-        response_data.append(
-            {
-                "ec_brand_id": brand.ec_brand_id,
-                "name": brand.name,
-                "description": brand.description,
-                "price": brand.price,
-                "count": int(cans / kinds),
-                "picture": picture,  # Base64エンコードされた画像データを追加
-            }
-        )
-
-    return response_data
+    return build_response_data(result, cans, kinds, db)
 
 
 def create_function_mapping(db: Session):
-    # EC_Setテーブルからec_set_idが900未満のデータを読み込む
-    ec_sets = db.query(EC_Set).filter(EC_Set.ec_set_id < 900).all()
+    # EC_Setのスナップショットからec_set_idが900未満のデータを読み込む
+    ec_sets = [ec_set for ec_set in get_catalog(db).ec_sets if ec_set.ec_set_id < 900]
 
     # マッピング用の辞書を作成
     function_mapping = {}
@@ -607,11 +546,58 @@ def recommend(
     try:
         # ec_set_idに対応した関数を使用する
         algorithm_function = function_mapping[ec_set_id]  # キーが存在しない場合KeyErrorが発生
-        response_data = algorithm_function(user_id, category, cans, kinds, ng_id, db)
     except KeyError:
         raise ValueError(f"No function found for ec_set_id {ec_set_id}")
 
-    return response_data
+    # 同じ条件のリクエストが同時に来た場合は、1回だけ計算して結果を共有する
+    key = (user_id, ec_set_id, category, cans, kinds, tuple(sorted(ng_id)))
+    response_data = recommend_flight.do(key, lambda: algorithm_function(user_id, category, cans, kinds, ng_id, db))
+
+    # 各アルゴリズムが組み立てたdictなので、response_modelでの再検証を省いてそのままorjsonで返す
+    return ORJSONResponse(response_data)
+
+
+# 複数の(ec_set_id, category, cans, kinds, ng_id)をまとめてリコメンドする
+# age/gender、ユーザーの好みベクトル、カテゴリごとのcos類似度ランキングは1回だけ計算して各セットで使い回す
+@router.post("/recommend/batch", response_model=RecommendBatchResponse)
+def recommend_batch(
+    request: RecommendBatchRequest,
+    db: Session = Depends(get_db),
+    user_id: int = Depends(get_current_user_id),  # ヘッダー内のJWTから取得
+):
+    batch_start = time.perf_counter()
+
+    # マッピングのための辞書を作成(ec_set_id : algorithm_func)
+    function_mapping = create_function_mapping(db)
+    context = RecommendContext(user_id, db)
+
+    results = []
+    for params in request.sets:
+        algorithm_function = function_mapping.get(params.ec_set_id)
+        if algorithm_function is None:
+            raise HTTPException(status_code=404, detail=f"No function found for ec_set_id {params.ec_set_id}")
+
+        # セットごとの所要時間を、共通部分(ランキング計算)とセット固有部分(絞り込み・整形)に分けて記録する
+        shared_before = context.shared_seconds
+        start = time.perf_counter()
+        items = algorithm_function(user_id, params.category, params.cans, params.kinds, params.ng_id, db, context)
+        total_seconds = time.perf_counter() - start
+        shared_seconds = context.shared_seconds - shared_before
+
+        results.append(
+            {
+                "ec_set_id": params.ec_set_id,
+                "category": params.category,
+                "items": items,
+                "timing": {
+                    "total_ms": total_seconds * 1000,
+                    "shared_ms": shared_seconds * 1000,
+                    "set_ms": (total_seconds - shared_seconds) * 1000,
+                },
+            }
+        )
+
+    return ORJSONResponse({"results": results, "total_ms": (time.perf_counter() - batch_start) * 1000})
 
 
 # エンドポイントの定義
@@ -630,17 +616,15 @@ def read_favorite_brand_preferences(user_id: int, db: Session = Depends(get_db))
     if not favorite_brands:
         raise HTTPException(status_code=404, detail="No favorite brands found for this user")
 
-    # 3. Surveyテーブルから条件に合致するデータを抽出
-    survey_query = (
-        select(Survey.item_id, func.avg(Survey.score).label('avg_score'))
-        .where(Survey.age_lower_limit <= age, Survey.age_upper_limit >= age, Survey.gender == gender, Survey.brand_id.in_(favorite_brands))
-        .group_by(Survey.item_id)
+    # 3. survey_vectorsから条件に合致するデータの項目ごとの平均を抽出
+    survey_query = select(*(func.avg(column) for column in SCORE_COLUMNS)).where(
+        SurveyVector.age_lower_limit <= age, SurveyVector.age_upper_limit >= age, SurveyVector.gender == gender, SurveyVector.brand_id.in_(favorite_brands)
     )
 
-    survey_results = db.execute(survey_query).fetchall()
+    avg_scores = db.execute(survey_query).one()
 
-    # 4. {キーをitem_id、バリューをscoreの平均値を四捨五入してint型に変換}の形に整理
-    preferences_dict = {item_id: round(avg_score) for item_id, avg_score in survey_results}
+    # 4. {キーをitem_id、バリューをscoreの平均値を四捨五入してint型に変換}の形に整理(データが無い項目は含めない)
+    preferences_dict = {item_id: round(avg_score) for item_id, avg_score in enumerate(avg_scores, start=1) if avg_score is not None}
 
     # 5. BrandPreferencesの形式で返す
     return BrandPreferences(preferences=preferences_dict)
@@ -23,6 +23,7 @@ class User(UserBase):
 class Photo(BaseModel):
     photo_id: int
     photo_data: str
+    photo_mime_type: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -33,6 +34,18 @@ class UserWithPhotos(BaseModel):
     photos: List[Photo]
 
 
+class GalleryPhoto(BaseModel):
+    photo_id: int
+    post_id: int
+    thumbnail_url: str
+    photo_url: str
+
+
+class PhotoGalleryPage(BaseModel):
+    photos: List[GalleryPhoto]
+    next_cursor: Optional[int] = None  # 次のページが無ければNone
+
+
 class ECSetItem(BaseModel):
     ec_set_id: int
     set_name: str
@@ -54,12 +67,37 @@ class RecommendResponseItem(BaseModel):
     price: int
     count: int
     picture: Optional[str] = None
+    picture_mime_type: Optional[str] = None
+
+
+class RecommendBatchRequest(BaseModel):
+    sets: List[RecommendQueryParams]
+
+
+# 各セットの所要時間(ms)。shared_msはそのセットの処理中に初めて計算された共通部分(ランキング)の時間
+class RecommendTiming(BaseModel):
+    total_ms: float
+    shared_ms: float
+    set_ms: float
+
+
+class RecommendBatchResultItem(BaseModel):
+    ec_set_id: int
+    category: str
+    items: List[RecommendResponseItem]
+    timing: RecommendTiming
+
+
+class RecommendBatchResponse(BaseModel):
+    results: List[RecommendBatchResultItem]
+    total_ms: float
 
 
 class Brand(BaseModel):
     brand_id: int
     brand_name: str
     brand_logo: Optional[str] = None
+    brand_logo_mime_type: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -160,6 +198,7 @@ class PurchaseItem(BaseModel):
     count: int
     ec_set_id: int
     picture: Optional[str] = None
+    picture_mime_type: Optional[str] = None
 
 
 class PurchaseSubSetItem(BaseModel):
@@ -213,3 +252,28 @@ class PurchaselogPage(BaseModel):
     page: int
     total_page: int
     purchaselog: List[Purchaselog]
+
+
+class AutocompleteBrand(BaseModel):
+    brand_id: int
+    brand_name: str
+    category: Optional[str] = None
+    popularity: int
+
+
+class SurveyPageBrand(BaseModel):
+    brand_id: int
+    brand_name: str
+    brand_logo: Optional[str] = None
+    brand_logo_mime_type: Optional[str] = None
+    average_scores: Dict[int, float]
+
+
+# アンケート画面に必要な情報(購入日・ユーザーの年齢と性別・項目・購入したブランドと平均スコア)をまとめたもの
+class SurveyPage(BaseModel):
+    purchase_id: int
+    purchase_date: date
+    survey_completion: bool
+    user: UserWithAgeGender
+    items: List[Item]
+    brands: List[SurveyPageBrand]
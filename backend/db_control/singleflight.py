@@ -0,0 +1,170 @@
+# 同じ内容の計算が同時に複数来たときに、1回だけ実行して結果を共有する(single-flight)
+# キャンペーンメールの直後などに同じ /recommend や /brand/{id}/average_scores がまとめて届くと、毎回同じ計算をしてしまうため
+# 最初のリクエスト(リーダー)だけが計算し、計算中に来た同じキーのリクエストはその結果(または例外)を待って受け取る
+# SINGLEFLIGHT_WAIT_SECONDSを過ぎてもリーダーの計算が終わらなければ、待つのをやめて自分で計算する(リーダーが詰まっても巻き込まれない)
+# リーダーの例外は、待っていたリクエストごとに複製して投げ直す(同じ例外オブジェクトを複数のスレッドで投げるとトレースバックが混ざるため)
+# 計算が終わったらキーは消えるので、結果をキャッシュするわけではない
+# 共有される結果は複数のリクエストから読まれるので、ORMオブジェクトではなくdictやlistを返す関数に使う
+import asyncio
+import os
+import threading
+
+from dotenv import load_dotenv
+from fastapi import APIRouter
+from starlette.concurrency import run_in_threadpool
+
+# 環境変数のロード
+load_dotenv()
+# リーダーの計算を待つ最大の秒数(過ぎたら自分で計算する)
+SINGLEFLIGHT_WAIT_SECONDS = float(os.getenv("SINGLEFLIGHT_WAIT_SECONDS", "10"))
+
+router = APIRouter()
+
+
+# 例外を複製できなかった場合に、代わりに投げる例外(元の例外は__cause__に入る)
+class SingleFlightError(Exception):
+    pass
+
+
+# 例外を同じ型・同じ属性で作り直す(__init__の引数が例外ごとに違うので、__init__は呼ばずにargsと属性を写す)
+def copy_error(error: BaseException):
+    try:
+        fresh = type(error).__new__(type(error), *error.args)
+        fresh.__dict__.update(error.__dict__)
+        return fresh
+    except Exception:
+        return SingleFlightError(f"shared call failed: {error!r}")
+
+
+class Call:
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = []  # 非同期で待っている(イベントループ, Future)。Futureは計算が終わった合図で、結果はcallから読む
+
+    # 待っていたリクエストに結果を返す(例外はリクエストごとに新しいものにし、リーダーの例外をfromでつないで投げる)
+    def outcome(self):
+        if self.error is None:
+            return self.result
+        raise copy_error(self.error) from self.error
+
+
+class SingleFlight:
+    def __init__(self, name: str, wait_seconds: float = SINGLEFLIGHT_WAIT_SECONDS):
+        self.name = name
+        self.wait_seconds = wait_seconds
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0  # 実際に計算した回数
+        self.coalesced = 0  # 他のリクエストの計算結果を受け取った回数
+        self.timed_out = 0  # 待ちきれずに自分で計算した回数
+
+    # 1.キーの計算が実行中なら(Call, False)、そうでなければ新しく登録して(Call, True)を返す
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = Call()
+            self._calls[key] = call
+            self.executions += 1
+            return call, True
+
+    # 2.リーダーとして計算し、待っているリクエストに結果を渡す
+    def _run(self, key, call: Call, func):
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+        finally:
+            # 完了の印はロックの中で付ける(do_asyncが待ち行列に加わるのと入れ違いにならないように)
+            with self._lock:
+                del self._calls[key]
+                call.event.set()
+                waiters = list(call.waiters)
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(_resolve, future)
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    # 3-1.スレッドプールで動くエンドポイント(def)用
+    def do(self, key, func):
+        call, leader = self._join(key)
+        if leader:
+            return self._run(key, call, func)
+
+        if not call.event.wait(self.wait_seconds):
+            self._count_timeout()
+            return func()
+        return call.outcome()
+
+    # 3-2.async defのエンドポイント用。計算(同期関数)はスレッドプールで実行し、待つ側はイベントループをふさがない
+    async def do_async(self, key, func):
+        call, leader = self._join(key)
+        if leader:
+            return await run_in_threadpool(self._run, key, call, func)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            finished = call.event.is_set()
+            if not finished:
+                call.waiters.append((loop, future))
+        if not finished:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.wait_seconds)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if (loop, future) in call.waiters:
+                        call.waiters.remove((loop, future))
+                self._count_timeout()
+                return await run_in_threadpool(func)
+        return call.outcome()
+
+    def _count_timeout(self):
+        with self._lock:
+            self.timed_out += 1
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        total = self.executions + self.coalesced
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "timed_out": self.timed_out,
+            "in_flight": in_flight,
+            "coalesced_ratio": self.coalesced / total if total else 0.0,
+        }
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+# 名前ごとのSingleFlightを返す(無ければ作る)
+def get_flight(name: str):
+    with _flights_lock:
+        flight = _flights.get(name)
+        if flight is None:
+            flight = _flights[name] = SingleFlight(name)
+        return flight
+
+
+# まとめられたリクエストの数などを返す
+@router.get("/singleflight/stats")
+def get_singleflight_stats():
+    with _flights_lock:
+        flights = list(_flights.values())
+    return {flight.name: flight.stats() for flight in flights}
@@ -0,0 +1,277 @@
+# リコメンドの入力データ(surveysのベクトル、brands・ec_brandsの列)とマスタをまとめたディスク上のスナップショット
+# 新しいインスタンスが起動したときに、DBへ問い合わせずにmmapするだけでリコメンドを始められるようにする
+# 起動時にはここからマスタのスナップショット(db_control/catalog.py)も作るので、マスタをDBから読み込まずに済む
+#
+# 形式(FORMAT_VERSION = 2): ディレクトリにNumPyの.npyファイル、catalog.json、manifest.jsonを置く
+#   manifest.json                  形式のバージョン、作成日時、作成時のDBのバージョン、カテゴリ名、配列の一覧(dtype・shape)
+#   surveys.<name>.npy             survey_matrix.ARRAY_NAMESの各配列(1つのsurvey_idにつき1行、スコアは8列)
+#   brands.brand_ids.npy           brand_id
+#   brands.category_codes.npy      categoryのmanifest["categories"]での位置(無い場合は-1)
+#   brands.manufacturer_ids.npy    manufacturer_id(無い場合は-1)
+#   ec_brands.ec_brand_ids.npy     ec_brand_id
+#   ec_brands.brand_ids.npy        brand_id(無い場合は-1)
+#   ec_brands.category_codes.npy   categoryの位置(無い場合は-1)
+#   ec_brands.prices.npy           price(無い場合は-1)
+#   catalog.json                   文字列の列(items、brandsの名前、ec_brandsの名前・説明、ec_sets)。名前などは上の配列と同じ並び
+# DBのバージョンはマスタのバージョン(catalog.get_catalog_version)とsurvey_vectorsのバージョン(data_versionsの1行)で、
+# どちらもsurveys全体を集計しない軽いクエリで取れる
+# DB側のバージョンがmanifestと異なる(スナップショットが古い)場合は使わず、これまで通りDBから読む
+# スナップショットはbackendディレクトリで以下のように作成する(デプロイ前やマスタ・surveysの更新後に実行する)
+#   python -m db_control.snapshot
+#   python -m db_control.snapshot --output /path/to/recommender_snapshot --db-url sqlite:///local.db
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from db_control.catalog import BrandRecord, CatalogSnapshot, ECBrandRecord, ECSetRecord, ItemRecord, get_catalog_version, install_catalog, load_catalog
+from db_control.connect import get_db
+from db_control.survey_matrix import ARRAY_NAMES, SurveyMatrix, build_arrays
+from db_control.survey_vectors import get_survey_vectors_version
+
+# 環境変数のロード
+load_dotenv()
+RECOMMENDER_SNAPSHOT_DIR = os.getenv("RECOMMENDER_SNAPSHOT_DIR", "recommender_snapshot")
+# DB側のバージョンと照合する間隔(秒)
+SNAPSHOT_CHECK_SECONDS = float(os.getenv("SNAPSHOT_CHECK_SECONDS", "30"))
+
+FORMAT_VERSION = 2
+
+router = APIRouter()
+
+
+class RecommenderSnapshot:
+    __slots__ = ("manifest", "surveys", "categories", "arrays", "strings", "loaded_seconds")
+
+    def __init__(self, manifest: dict, arrays: dict, strings: dict, loaded_seconds: float):
+        self.manifest = manifest
+        self.categories = manifest["categories"]
+        self.arrays = arrays
+        self.strings = strings
+        self.loaded_seconds = loaded_seconds
+        self.surveys = SurveyMatrix(f"snapshot-{manifest['created_ns']}", {name: arrays[f"surveys.{name}"] for name in ARRAY_NAMES}, loaded_seconds)
+
+    def category_code(self, category: str):
+        return self.categories.index(category) if category in self.categories else -1
+
+    # categoryに属するbrand_idの配列
+    def category_brand_ids(self, category: str):
+        code = self.category_code(category)
+        if code < 0:
+            return self.arrays["brands.brand_ids"][:0]
+        return self.arrays["brands.brand_ids"][self.arrays["brands.category_codes"] == code]
+
+    # 年齢・性別・categoryに当てはまるブランドの8次元ベクトル(brand_id順)
+    def survey_vectors_for(self, age: int, gender: int, category: str):
+        return self.surveys.vectors_for(age, gender, self.category_brand_ids(category))
+
+    # 配列とcatalog.jsonから、DBから読み込んだ場合と同じ内容のマスタのスナップショットを作る
+    def build_catalog(self):
+        arrays = self.arrays
+        strings = self.strings
+
+        def category(code):
+            return self.categories[code] if code >= 0 else None
+
+        def nullable(value):
+            return value if value >= 0 else None
+
+        items = [ItemRecord(*row) for row in strings["items"]]
+        brands = [
+            BrandRecord(brand_id, name, category(code), nullable(manufacturer_id))
+            for brand_id, name, code, manufacturer_id in zip(
+                arrays["brands.brand_ids"].tolist(), strings["brand_names"], arrays["brands.category_codes"].tolist(), arrays["brands.manufacturer_ids"].tolist()
+            )
+        ]
+        ec_brands = [
+            ECBrandRecord(ec_brand_id, nullable(brand_id), category(code), name, description, nullable(price))
+            for ec_brand_id, brand_id, code, name, description, price in zip(
+                arrays["ec_brands.ec_brand_ids"].tolist(),
+                arrays["ec_brands.brand_ids"].tolist(),
+                arrays["ec_brands.category_codes"].tolist(),
+                strings["ec_brand_names"],
+                strings["ec_brand_descriptions"],
+                arrays["ec_brands.prices"].tolist(),
+            )
+        ]
+        ec_sets = [ECSetRecord(*row) for row in strings["ec_sets"]]
+        return CatalogSnapshot(tuple(self.manifest["catalog_version"]), items, brands, ec_brands, ec_sets)
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+
+# 1.スナップショットの元になったDBのバージョン(マスタのバージョン + survey_vectorsのバージョン)
+def get_source_version(db: Session):
+    return list(get_catalog_version(db)) + [get_survey_vectors_version(db)]
+
+
+# 2.DBからスナップショットを作ってディレクトリに書き出す(書き終えてから一度に差し替える)
+def build_snapshot(db: Session, directory: str = RECOMMENDER_SNAPSHOT_DIR):
+    # マスタは読み込みと同じトランザクションで取ったバージョンを使う
+    catalog = load_catalog(db)
+    source_version = list(catalog.version) + [get_survey_vectors_version(db)]
+
+    brands = catalog.brands
+    ec_brands = catalog.ec_brands
+    categories = sorted({x.category for x in brands if x.category is not None} | {x.category for x in ec_brands if x.category is not None})
+    codes = {category: i for i, category in enumerate(categories)}
+
+    def nullable(value):
+        return -1 if value is None else value
+
+    arrays = {f"surveys.{name}": array for name, array in build_arrays(db).items()}
+    arrays["brands.brand_ids"] = np.array([x.brand_id for x in brands], dtype=np.int32)
+    arrays["brands.category_codes"] = np.array([codes.get(x.category, -1) for x in brands], dtype=np.int16)
+    arrays["brands.manufacturer_ids"] = np.array([nullable(x.manufacturer_id) for x in brands], dtype=np.int32)
+    arrays["ec_brands.ec_brand_ids"] = np.array([x.ec_brand_id for x in ec_brands], dtype=np.int32)
+    arrays["ec_brands.brand_ids"] = np.array([nullable(x.brand_id) for x in ec_brands], dtype=np.int32)
+    arrays["ec_brands.category_codes"] = np.array([codes.get(x.category, -1) for x in ec_brands], dtype=np.int16)
+    arrays["ec_brands.prices"] = np.array([nullable(x.price) for x in ec_brands], dtype=np.int32)
+    strings = {
+        "items": [[x.item_id, x.item_name] for x in catalog.items],
+        "brand_names": [x.brand_name for x in brands],
+        "ec_brand_names": [x.name for x in ec_brands],
+        "ec_brand_descriptions": [x.description for x in ec_brands],
+        "ec_sets": [[x.ec_set_id, x.category, x.set_name, x.set_description, x.algorithm_func] for x in catalog.ec_sets],
+    }
+
+    now = time.time_ns()
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created_at": datetime.fromtimestamp(now / 1e9).isoformat(),
+        "created_ns": now,
+        "source_version": source_version,
+        "catalog_version": list(catalog.version),
+        "categories": categories,
+        "arrays": {name: {"dtype": str(array.dtype), "shape": list(array.shape)} for name, array in arrays.items()},
+    }
+
+    directory = os.path.abspath(directory)
+    tmp_dir = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    with open(os.path.join(tmp_dir, "catalog.json"), "w") as f:
+        json.dump(strings, f, ensure_ascii=False)
+    # manifest.jsonは最後に書く(作成日時でディスク上の差し替えを検知するため)
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # 古いスナップショットをmmap中のプロセスがいても、ファイルを消すだけなら読み続けられる
+    old_dir = f"{directory}.old-{os.getpid()}"
+    if os.path.isdir(directory):
+        os.rename(directory, old_dir)
+    os.rename(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+# 3.スナップショットをmmapで開く(無い・形式が違う場合はNone)
+def load_snapshot(directory: str = RECOMMENDER_SNAPSHOT_DIR):
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != FORMAT_VERSION:
+            return None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in manifest["arrays"]}
+        with open(os.path.join(directory, "catalog.json")) as f:
+            strings = json.load(f)
+    except (OSError, ValueError, KeyError):
+        return None
+    return RecommenderSnapshot(manifest, arrays, strings, time.perf_counter() - start)
+
+
+_snapshot = None
+_fresh = False
+_last_checked = 0.0
+_lock = threading.Lock()
+
+
+# 起動時に呼んでmmapしておき、マスタのスナップショットもここから作っておく
+# (DBとの照合は最初のget_snapshot・get_catalogでバージョンを確認するだけで、古ければそれぞれDBから読み直す)
+def init_snapshot():
+    global _snapshot, _last_checked
+    with _lock:
+        _snapshot = load_snapshot()
+        _last_checked = 0.0
+    if _snapshot is not None:
+        install_catalog(_snapshot.build_catalog())
+    return _snapshot
+
+
+# 4.DB側と一致しているスナップショットを返す。無い・古い場合はNone(呼び出し側はDBから読む)
+# ディスク上のスナップショットが作り直されていれば、照合のタイミングで開き直す
+def get_snapshot(db: Session):
+    global _snapshot, _fresh, _last_checked
+    if time.monotonic() - _last_checked < SNAPSHOT_CHECK_SECONDS:
+        return _snapshot if _fresh else None
+
+    with _lock:
+        if time.monotonic() - _last_checked >= SNAPSHOT_CHECK_SECONDS:
+            snapshot = _snapshot
+            created_ns = _read_created_ns()
+            if snapshot is None or snapshot.manifest["created_ns"] != created_ns:
+                snapshot = load_snapshot() if created_ns is not None else None
+            _fresh = snapshot is not None and snapshot.manifest["source_version"] == get_source_version(db)
+            _snapshot = snapshot
+            _last_checked = time.monotonic()
+        return _snapshot if _fresh else None
+
+
+def _read_created_ns():
+    try:
+        with open(os.path.join(RECOMMENDER_SNAPSHOT_DIR, "manifest.json")) as f:
+            return json.load(f).get("created_ns")
+    except (OSError, ValueError):
+        return None
+
+
+# スナップショットの状態(DBと一致しているか・作成日時・サイズ・mmapにかかった時間)を返す
+@router.get("/snapshot/stats")
+def get_snapshot_stats(db: Session = Depends(get_db)):
+    fresh = get_snapshot(db) is not None
+    snapshot = _snapshot
+    if snapshot is None:
+        return {"directory": RECOMMENDER_SNAPSHOT_DIR, "loaded": False, "fresh": False}
+    return {
+        "directory": RECOMMENDER_SNAPSHOT_DIR,
+        "loaded": True,
+        "fresh": fresh,
+        "created_at": snapshot.manifest["created_at"],
+        "nbytes": snapshot.nbytes(),
+        "loaded_ms": snapshot.loaded_seconds * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the on-disk recommender input snapshot")
+    parser.add_argument("--output", default=RECOMMENDER_SNAPSHOT_DIR, help="snapshot directory")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    db = sessionmaker(bind=engine)()
+    try:
+        start = time.perf_counter()
+        manifest = build_snapshot(db, args.output)
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(args.output, name)) for name in os.listdir(args.output))
+        print(f"Wrote {len(manifest['arrays'])} arrays ({size / 1024:.0f} KiB) to {args.output} in {elapsed:.2f}s")
+    finally:
+        db.close()
@@ -0,0 +1,213 @@
+# リコメンドで使うsurveysのベクトル(1つのsurvey_idにつき8項目のスコア)を、ワーカープロセス間で共有するための配列
+# 配列はNumPyの.npyファイルとして共有ディレクトリ(既定は/dev/shm)に書き出し、各ワーカーはmmapで読むだけにする
+# こうするとワーカーが何個あっても物理メモリ上のデータは1つで済み、新しく起動したワーカーもDBを読まずにすぐ使える
+#
+# ディレクトリ構成(世代ごとにディレクトリを分け、CURRENTファイルの書き換えで一度に切り替える)
+#   {SURVEY_MATRIX_DIR}/CURRENT        現在の世代のディレクトリ名
+#   {SURVEY_MATRIX_DIR}/gen-<ns>/      survey_ids.npy, brand_ids.npy, genders.npy, age_lower.npy, age_upper.npy, scores.npy
+#   {SURVEY_MATRIX_DIR}/.lock          作り直しを1つのプロセスだけが行うためのロック
+# 作り直しはbackendディレクトリで以下のように実行する(アプリも古くなったら自動で作り直す)
+#   python -m db_control.survey_matrix
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from db_control.connect import get_db
+from db_control.mymodels import SurveyVector
+from db_control.survey_vectors import ITEM_COUNT, SCORE_COLUMNS, ensure_survey_vectors
+
+try:
+    import fcntl
+except ImportError:  # Windowsのローカル環境ではロックなしで作る
+    fcntl = None
+
+# 環境変数のロード
+load_dotenv()
+SURVEY_MATRIX_DIR = os.getenv("SURVEY_MATRIX_DIR") or os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "beerlog_survey_matrix")
+# CURRENTが切り替わっていないかを確認する間隔(秒)
+SURVEY_MATRIX_CHECK_SECONDS = float(os.getenv("SURVEY_MATRIX_CHECK_SECONDS", "30"))
+# この秒数より古い世代はDBから作り直す
+SURVEY_MATRIX_MAX_AGE_SECONDS = float(os.getenv("SURVEY_MATRIX_MAX_AGE_SECONDS", "3600"))
+
+ARRAY_NAMES = ("survey_ids", "brand_ids", "genders", "age_lower", "age_upper", "scores")
+
+router = APIRouter()
+
+
+class SurveyMatrix:
+    __slots__ = ("generation", "built_at", "loaded_seconds") + ARRAY_NAMES
+
+    def __init__(self, generation: str, arrays: dict, loaded_seconds: float):
+        self.generation = generation
+        self.built_at = int(generation.split("-", 1)[1]) / 1e9
+        self.loaded_seconds = loaded_seconds
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+    # 年齢・性別の条件に当てはまり、brand_idsに含まれるブランドの8次元ベクトルをbrand_id順に返す
+    # (DBから読んでいた頃と同じく、同じ項目に複数の行が当てはまる場合はsurvey_idが後ろの行の値を使う)
+    def vectors_for(self, age: int, gender: int, brand_ids):
+        mask = (self.genders == gender) & (self.age_lower < age) & (self.age_upper > age) & np.isin(self.brand_ids, np.fromiter(brand_ids, dtype=np.int32))
+        rows = np.flatnonzero(mask)
+        unique_brand_ids = np.unique(self.brand_ids[rows])
+
+        vectors = np.full((len(unique_brand_ids), ITEM_COUNT), np.nan)
+        positions = np.searchsorted(unique_brand_ids, self.brand_ids[rows])
+        for position, scores in zip(positions, self.scores[rows]):
+            present = ~np.isnan(scores)
+            vectors[position, present] = scores[present]
+        return unique_brand_ids, vectors
+
+    def age_seconds(self):
+        return time.time() - self.built_at
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAY_NAMES)
+
+
+# 1.DBのsurvey_vectors(1つのsurvey_idにつき1行、スコアが無い項目はNULL)をそのまま配列にする
+# リクエストの中で作り直すこともあるので、surveysとの突き合わせはしない(ORMの書き込みはsurvey_vectorsに反映済み。CLIでは先に突き合わせる)
+def build_arrays(db: Session):
+    query = select(SurveyVector.survey_id, SurveyVector.brand_id, SurveyVector.gender, SurveyVector.age_lower_limit, SurveyVector.age_upper_limit, *SCORE_COLUMNS).order_by(SurveyVector.survey_id)
+    rows = db.execute(query).all()
+
+    return {
+        "survey_ids": np.fromiter((row[0] for row in rows), dtype=np.int32, count=len(rows)),
+        "brand_ids": np.fromiter((row[1] for row in rows), dtype=np.int32, count=len(rows)),
+        "genders": np.fromiter((row[2] for row in rows), dtype=np.int16, count=len(rows)),
+        "age_lower": np.fromiter((row[3] for row in rows), dtype=np.int16, count=len(rows)),
+        "age_upper": np.fromiter((row[4] for row in rows), dtype=np.int16, count=len(rows)),
+        # NoneはNaNになる
+        "scores": np.array([row[5:] for row in rows], dtype=np.float64).reshape(len(rows), ITEM_COUNT),
+    }
+
+
+@contextmanager
+def build_lock():
+    os.makedirs(SURVEY_MATRIX_DIR, exist_ok=True)
+    with open(os.path.join(SURVEY_MATRIX_DIR, ".lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_current_generation():
+    try:
+        with open(os.path.join(SURVEY_MATRIX_DIR, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+# 2.新しい世代を書き出してCURRENTを切り替える(書き出し中の世代が読まれることはない)
+def publish(arrays: dict):
+    os.makedirs(SURVEY_MATRIX_DIR, exist_ok=True)
+    generation = f"gen-{time.time_ns()}"
+    tmp_dir = os.path.join(SURVEY_MATRIX_DIR, f".{generation}.tmp")
+    os.makedirs(tmp_dir)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), arrays[name])
+    os.rename(tmp_dir, os.path.join(SURVEY_MATRIX_DIR, generation))
+
+    tmp_current = os.path.join(SURVEY_MATRIX_DIR, f".CURRENT.{os.getpid()}")
+    with open(tmp_current, "w") as f:
+        f.write(generation)
+    os.replace(tmp_current, os.path.join(SURVEY_MATRIX_DIR, "CURRENT"))
+
+    # 切り替え直後に古い世代を開こうとしているワーカーがいるかもしれないので、1つ前の世代は残しておく
+    # (mmap済みのファイルは削除しても読み続けられる)
+    generations = sorted(name for name in os.listdir(SURVEY_MATRIX_DIR) if name.startswith("gen-"))
+    for name in generations[:-2]:
+        shutil.rmtree(os.path.join(SURVEY_MATRIX_DIR, name), ignore_errors=True)
+    return generation
+
+
+# 3.世代のファイルをmmapで開く
+def map_generation(generation: str):
+    start = time.perf_counter()
+    directory = os.path.join(SURVEY_MATRIX_DIR, generation)
+    arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ARRAY_NAMES}
+    return SurveyMatrix(generation, arrays, time.perf_counter() - start)
+
+
+def is_stale(generation: str | None):
+    return generation is None or time.time() - int(generation.split("-", 1)[1]) / 1e9 > SURVEY_MATRIX_MAX_AGE_SECONDS
+
+
+# 4.DBから作り直して公開する。他のプロセスが作り直している間は待ち、その結果を使う
+def rebuild(db: Session, force: bool = False):
+    with build_lock():
+        generation = read_current_generation()
+        if force or is_stale(generation):
+            generation = publish(build_arrays(db))
+    return generation
+
+
+_matrix = None
+_last_checked = 0.0
+_lock = threading.Lock()
+
+
+# 5.現在の世代の配列を返す
+# 一定間隔でCURRENTを確認し、切り替わっていればmmapし直す。世代が無いか古すぎる場合は作り直す
+def get_survey_matrix(db: Session):
+    global _matrix, _last_checked
+    matrix = _matrix
+    if matrix is not None and time.monotonic() - _last_checked < SURVEY_MATRIX_CHECK_SECONDS:
+        return matrix
+
+    with _lock:
+        if _matrix is not None and time.monotonic() - _last_checked < SURVEY_MATRIX_CHECK_SECONDS:
+            return _matrix
+
+        generation = read_current_generation()
+        if is_stale(generation):
+            generation = rebuild(db)
+        if _matrix is None or _matrix.generation != generation:
+            _matrix = map_generation(generation)
+        _last_checked = time.monotonic()
+        return _matrix
+
+
+# 共有している配列の状態(世代・作成からの経過時間・サイズ・mmapにかかった時間)を返す
+@router.get("/survey_matrix/stats")
+def get_survey_matrix_stats(db: Session = Depends(get_db)):
+    matrix = get_survey_matrix(db)
+    return {
+        "directory": SURVEY_MATRIX_DIR,
+        "generation": matrix.generation,
+        "age_seconds": matrix.age_seconds(),
+        "rows": len(matrix.survey_ids),
+        "nbytes": matrix.nbytes(),
+        "loaded_ms": matrix.loaded_seconds * 1000,
+        "pid": os.getpid(),
+    }
+
+
+if __name__ == "__main__":
+    from db_control.connect import SessionLocal
+
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        # ORMを通さずに書き換えたsurveysがあれば、先にsurvey_vectorsへ反映しておく
+        count = ensure_survey_vectors(db)
+        if count is not None:
+            print(f"survey_vectors: rebuilt {count} rows")
+        generation = rebuild(db, force=True)
+        print(f"Published {generation} to {SURVEY_MATRIX_DIR} in {time.perf_counter() - start:.2f}s")
+    finally:
+        db.close()
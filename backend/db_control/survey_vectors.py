@@ -0,0 +1,158 @@
+# surveys(1つのsurvey_idにつき8項目の8行)を、survey_vectors(1つのsurvey_idにつき1行、8項目のスコアを列に持つ)へまとめ直す
+# surveysが正で、survey_vectorsはそこから作る
+# ORMでsurveysの行を追加・変更・削除すると、同じトランザクションの中で該当するsurvey_idの行を作り直す
+# ORMを通さずにsurveysを書き換えた場合に備えて、survey_idごとに内容を突き合わせて一致を確認する(合計値などでは変更を見落とすため)
+# 突き合わせはsurveys全体を読むので、リクエストの中では行わない(下のCLI、load_dummy_data、survey_matrixのCLIで行う)
+# survey_vectorsの行を作り直すたびに、同じトランザクションでdata_versionsのname="survey_vectors"の行を1増やす
+# (スナップショットなどsurvey_vectorsから作ったものは、surveys全体を集計せずにこのバージョンで古くなったかを確認できる)
+# backendディレクトリで以下のように実行する(テーブルが無ければ作成する)
+#   python -m db_control.survey_vectors
+#   python -m db_control.survey_vectors --db-url sqlite:///local.db --check   (一致していなければ終了コード1で終わる)
+import argparse
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, delete, event, func, inspect, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from db_control.mymodels import DataVersion, Survey, SurveyVector
+
+ITEM_COUNT = 8
+SCORE_COLUMNS = [getattr(SurveyVector, f"score{i}") for i in range(1, ITEM_COUNT + 1)]
+VERSION_NAME = "survey_vectors"
+
+
+# 1.surveysの行(survey_idの順、item_idは1~8)をsurvey_idごとに1行のdictにまとめる(無い項目はNone)
+def pivot_survey_rows(rows):
+    vectors = {}
+    for survey_id, brand_id, gender, age_lower, age_upper, item_id, score in rows:
+        if not 1 <= item_id <= ITEM_COUNT:
+            continue
+        if survey_id not in vectors:
+            vectors[survey_id] = {"survey_id": survey_id, "brand_id": brand_id, "age_lower_limit": age_lower, "age_upper_limit": age_upper, "gender": gender}
+            vectors[survey_id].update({column.key: None for column in SCORE_COLUMNS})
+        vectors[survey_id][f"score{item_id}"] = score
+    return list(vectors.values())
+
+
+def survey_query():
+    query = select(Survey.survey_id, Survey.brand_id, Survey.gender, Survey.age_lower_limit, Survey.age_upper_limit, Survey.item_id, Survey.score)
+    return query.where(Survey.item_id.between(1, ITEM_COUNT)).order_by(Survey.survey_id, Survey.item_id)
+
+
+# 2.surveysから作るべき行と今のsurvey_vectorsの行をsurvey_idごとに突き合わせ、一致しないsurvey_idの集合を返す
+def find_stale_survey_ids(db: Session):
+    expected = {row["survey_id"]: row for row in pivot_survey_rows(db.execute(survey_query()).all())}
+    current = {row["survey_id"]: dict(row) for row in db.execute(select(SurveyVector.__table__)).mappings()}
+    return {survey_id for survey_id in expected.keys() | current.keys() if expected.get(survey_id) != current.get(survey_id)}
+
+
+def is_up_to_date(db: Session):
+    return not find_stale_survey_ids(db)
+
+
+# 2-1.survey_vectorsのバージョン(行を作り直すたびに1増える。一度も作り直していなければ0)
+def get_survey_vectors_version(db: Session):
+    return db.execute(select(DataVersion.version).where(DataVersion.name == VERSION_NAME)).scalar() or 0
+
+
+# 2-2.survey_vectorsのバージョンを1増やす(コミットは呼び出し側で行う)
+def bump_survey_vectors_version(db: Session):
+    now = datetime.now()
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        stmt = mysql_insert(DataVersion).values(name=VERSION_NAME, version=1, updated_at=now)
+        db.execute(stmt.on_duplicate_key_update(version=DataVersion.version + 1, updated_at=now))
+    elif dialect == "sqlite":
+        # ローカル検証用のSQLite
+        stmt = sqlite_insert(DataVersion).values(name=VERSION_NAME, version=1, updated_at=now)
+        db.execute(stmt.on_conflict_do_update(index_elements=["name"], set_={"version": DataVersion.version + 1, "updated_at": now}))
+    else:
+        version = db.get(DataVersion, VERSION_NAME)
+        if version is None:
+            db.add(DataVersion(name=VERSION_NAME, version=1, updated_at=now))
+        else:
+            version.version += 1
+            version.updated_at = now
+
+
+# 3.survey_vectorsを空にしてsurveysから作り直す(コミットは呼び出し側で行う)。作った行数を返す
+def refresh_survey_vectors(db: Session):
+    rows = pivot_survey_rows(db.execute(survey_query()).all())
+    db.execute(delete(SurveyVector))
+    if rows:
+        db.execute(SurveyVector.__table__.insert(), rows)
+    bump_survey_vectors_version(db)
+    return len(rows)
+
+
+# 3-1.指定したsurvey_idの行だけをsurveysから作り直す(コミットは呼び出し側で行う)
+def sync_survey_vectors(db: Session, survey_ids):
+    survey_ids = sorted(set(survey_ids))
+    if not survey_ids:
+        return 0
+    rows = pivot_survey_rows(db.execute(survey_query().where(Survey.survey_id.in_(survey_ids))).all())
+    db.execute(delete(SurveyVector).where(SurveyVector.survey_id.in_(survey_ids)))
+    if rows:
+        db.execute(SurveyVector.__table__.insert(), rows)
+    bump_survey_vectors_version(db)
+    return len(rows)
+
+
+# 4.一致していなければ作り直してコミットする。作り直した場合は行数、一致していた場合はNoneを返す
+def ensure_survey_vectors(db: Session):
+    stale_survey_ids = find_stale_survey_ids(db)
+    if not stale_survey_ids:
+        return None
+    count = sync_survey_vectors(db, stale_survey_ids)
+    db.commit()
+    return count
+
+
+# 5.ORMでsurveysの行を書き換えたら、flushの後に同じトランザクションの中でsurvey_vectorsの該当する行を作り直す
+@event.listens_for(Session, "before_flush")
+def _collect_changed_surveys(session, flush_context, instances):
+    changed = session.info.setdefault("changed_survey_ids", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Survey):
+            changed.add(obj.survey_id)
+            # survey_idを変えた場合は、元のsurvey_idの行も作り直す
+            changed.update(value for value in inspect(obj).attrs.survey_id.history.deleted if value is not None)
+
+
+@event.listens_for(Session, "after_flush_postexec")
+def _sync_changed_surveys(session, flush_context):
+    changed = session.info.pop("changed_survey_ids", None)
+    if changed:
+        sync_survey_vectors(session, changed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the wide survey_vectors table from surveys")
+    parser.add_argument("--db-url", help="database URL (defaults to the app's connection in connect.py)")
+    parser.add_argument("--check", action="store_true", help="only check that survey_vectors matches surveys")
+    args = parser.parse_args()
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+    else:
+        from db_control.connect import engine
+
+    SurveyVector.__table__.create(engine, checkfirst=True)
+    DataVersion.__table__.create(engine, checkfirst=True)
+    with Session(engine) as db:
+        stale_survey_ids = find_stale_survey_ids(db)
+        if args.check:
+            if stale_survey_ids:
+                print(f"survey_vectors is out of date for {len(stale_survey_ids)} survey_ids (e.g. {sorted(stale_survey_ids)[:10]})")
+                sys.exit(1)
+            print("survey_vectors is up to date")
+        else:
+            start = time.perf_counter()
+            count = refresh_survey_vectors(db)
+            db.commit()
+            survey_rows = db.execute(select(func.count()).select_from(Survey)).scalar()
+            print(f"Rebuilt {count} rows from {survey_rows} surveys rows in {time.perf_counter() - start:.2f}s ({survey_rows / max(count, 1):.1f}x fewer rows)")
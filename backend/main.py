@@ -1,13 +1,27 @@
 from fastapi import FastAPI, Depends, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
-from db_control import crud, connect, schemas
+from db_control import crud, connect, schemas, images
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from db_control.mymodels import Item, Brand, Preference, Favorite, SurveyRawData, User, PurchaseDetail, EC_Brand, Purchase
 from db_control.token import router as token_router
 from db_control.recommend import router as recommend_router
 from db_control.purchase import router as purchase_router
+from db_control.catalog import router as catalog_router, get_catalog
+from db_control.photos import router as photos_router
+from db_control.export import router as export_router
+from db_control.singleflight import router as singleflight_router, get_flight
+from db_control.survey_matrix import router as survey_matrix_router
+from db_control.snapshot import router as snapshot_router, init_snapshot
+from db_control.jobs import router as jobs_router, job_queue
+from db_control.profiling import router as profiling_router, ProfilingMiddleware
+from db_control.autocomplete import router as autocomplete_router
+from db_control.average_scores import get_average_scores, submit_average_scores_refresh
 import base64
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
 from typing import List, Dict, Optional
 from datetime import datetime, date
 
@@ -19,11 +33,34 @@ load_dotenv()  # デプロイ時に残しておいても問題ないらしい（
 FRONTEND_SERVER_URL = os.getenv("FRONTEND_SERVER_URL")
 FRONTEND_SERVER_URL2 = os.getenv("FRONTEND_SERVER_URL2")
 
-app = FastAPI()
+
+# 起動時の処理: リコメンド用のスナップショット(あれば)を先にmmapしておき、後処理のジョブのワーカーを起動する
+# 終了時は残っているジョブを実行し終えてから止める
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_snapshot()
+    job_queue.start()
+    yield
+    left = await run_in_threadpool(job_queue.drain)
+    if left:
+        print(f"Shutting down with {left} unfinished jobs")
+
+
+# レスポンスは標準のjsonではなくorjsonでシリアライズする(ルーター配下のエンドポイントも含む)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.include_router(token_router)  # ログイン関係
 app.include_router(recommend_router)  # リコメンド関係
 app.include_router(purchase_router)  # 購入関係
+app.include_router(catalog_router)  # マスタのスナップショット関係
+app.include_router(photos_router)  # 投稿写真のギャラリー関係
+app.include_router(export_router)  # 分析用データの書き出し
+app.include_router(singleflight_router)  # 同時リクエストのまとめ(single-flight)の状況
+app.include_router(survey_matrix_router)  # ワーカー間で共有するsurveysの配列の状況
+app.include_router(snapshot_router)  # リコメンド用スナップショットの状況
+app.include_router(jobs_router)  # 後処理のジョブキューの状況
+app.include_router(profiling_router)  # リクエストのプロファイル結果
+app.include_router(autocomplete_router)  # ブランド名の入力補完
 
 # CORS設定
 origins = [
@@ -39,6 +76,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# X-Profile-Tokenが付いたリクエスト(またはPROFILING_SAMPLE_RATEで選ばれたリクエスト)をプロファイルする
+app.add_middleware(ProfilingMiddleware)
+
+# /brand/{brand_id}/average_scores の同時リクエストをまとめる
+average_scores_flight = get_flight("average_scores")
 
 
 def calculate_age(birthdate: date) -> int:
@@ -55,16 +97,21 @@ def read_user(user_id: int, db: Session = Depends(connect.get_db)):
     return {"user_name": user.user_name, "age": age, "gender": user.gender}
 
 
-@app.get("/user_with_photos", response_model=schemas.UserWithPhotos)
+# 写真が多いユーザーではレスポンスが大きくなるので、新しい画面では /users/{user_id}/photos (ページ単位) を使う
+@app.get("/user_with_photos", response_model=schemas.UserWithPhotos, deprecated=True)
 def read_user_with_photos(user_id: int, db: Session = Depends(connect.get_db)):
     user = crud.get_user(db, user_id=user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     user.user_picture = base64.b64encode(user.user_picture).decode('utf-8') if user.user_picture else ""
 
-    photos = crud.get_user_photos(db, user_id=user_id)
-    for photo in photos:
-        photo.photo_data = base64.b64encode(photo.photo_data).decode('utf-8')
+    # 写真は一覧表示用の縮小版(なければ元画像)を返す
+    photo_ids = crud.get_user_photo_ids(db, user_id=user_id)
+    pictures = images.get_list_pictures_base64(db, "photo", photo_ids, width=images.PHOTO_THUMBNAIL_WIDTH)
+    photos = []
+    for photo_id in photo_ids:
+        photo_data, photo_mime_type = pictures.get(photo_id, ("", None))
+        photos.append({"photo_id": photo_id, "photo_data": photo_data, "photo_mime_type": photo_mime_type})
 
     return {"user": user, "photos": photos}
 
@@ -87,48 +134,58 @@ def add_favorite(favorite: schemas.FavoriteCreate, db: Session = Depends(connect
     if not brand:
         raise HTTPException(status_code=404, detail="Brand not found")
 
-    # user_id と brand_id の組み合わせがすでに存在するか確認
-    existing_favorite = db.query(Favorite).filter(Favorite.user_id == favorite.user_id, Favorite.brand_id == brand.brand_id).first()
-
-    if existing_favorite:
-        raise HTTPException(status_code=400, detail="Favorite already exists for this user")
-
     # 新しいお気に入りを作成
+    # user_id と brand_id の組み合わせの重複はユニークインデックス(uq_favorites_user_id_brand_id)で弾く
     new_favorite = Favorite(user_id=favorite.user_id, brand_id=brand.brand_id)
     db.add(new_favorite)
-    db.commit()
-    db.refresh(new_favorite)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # 外部キー違反(存在しないユーザー)などは重複と区別する
+        existing = db.query(Favorite.favorite_id).filter(Favorite.user_id == favorite.user_id, Favorite.brand_id == brand.brand_id).first()
+        if existing:
+            raise HTTPException(status_code=400, detail="Favorite already exists for this user")
+        if not db.query(User.user_id).filter(User.user_id == favorite.user_id).first():
+            raise HTTPException(status_code=404, detail="User not found")
+        raise
 
     return brand
 
 
 @app.post("/update_preferences")
 def update_preferences(request: schemas.UpdatePreferencesRequest, db: Session = Depends(connect.get_db)):
-    for item_id, score in request.preferences.items():
-        crud.update_user_preference(db, user_id=request.user_id, item_id=item_id, score=score)
+    # 全項目を1回のクエリ・1回のトランザクションで保存する(好みのバージョンも同時に上がる)
+    crud.bulk_upsert_user_preferences(db, user_id=request.user_id, preferences=request.preferences)
     return {"message": "Preferences updated successfully"}
 
 
 @app.get("/search_brands", response_model=List[schemas.Brand])
 def search_brands(search_term: str, db: Session = Depends(connect.get_db)):
-    brands = crud.search_brands(db, search_term=search_term)
+    brands = get_catalog(db).search_brands(search_term)
     if not brands:
         raise HTTPException(status_code=404, detail="Brands not found")
     return brands
 
 
 @app.get("/user_favorites", response_model=List[schemas.Brand])
-def read_user_favorites(user_id: int = Query(...), db: Session = Depends(connect.get_db)):
-    favorites = crud.get_user_favorites(db, user_id=user_id)
+def read_user_favorites(
+    user_id: int = Query(...),
+    limit: Optional[int] = Query(None, ge=1, le=100),  # 指定しなければ全件
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(connect.get_db),
+):
+    favorites = crud.get_user_favorites(db, user_id=user_id, limit=limit, offset=offset)
     if not favorites:
         raise HTTPException(status_code=404, detail="Favorites not found")
 
+    # ロゴは一覧表示用の縮小版(なければ元画像)をまとめて取得し、Base64エンコードしてMIMEタイプと一緒に返す。ロゴが無いブランドはNone
+    pictures = images.get_list_pictures_base64(db, "brand", [favorite["brand_id"] for favorite in favorites])
     for favorite in favorites:
-        brand = db.query(Brand).filter(Brand.brand_id == favorite.brand_id).first()
-        if brand and brand.brand_picture:
-            favorite.brand_logo = base64.b64encode(brand.brand_picture).decode('utf-8')  # BLOBデータをBase64エンコード
+        favorite["brand_logo"], favorite["brand_logo_mime_type"] = pictures.get(favorite["brand_id"], (None, None))
 
-    return favorites
+    # 中身はschemas.Brandと同じ形のdictなので、再検証せずにそのまま返す
+    return ORJSONResponse(favorites)
 
 
 @app.delete("/delete_favorite")
@@ -141,20 +198,26 @@ def delete_favorite(user_id: int = Query(...), brand_id: int = Query(...), db: S
     return {"message": "Favorite deleted successfully"}
 
 
+# 購入したブランドのbrand_id(brand_id順)。EC_BrandとBrandはマスタのスナップショットから引く
+def get_purchase_brand_ids(purchase_id: int, catalog, db: Session):
+    ec_brand_ids = db.query(PurchaseDetail.ec_brand_id).filter(PurchaseDetail.purchase_id == purchase_id).all()
+    brand_ids = set()
+    for (ec_brand_id,) in ec_brand_ids:
+        ec_brand = catalog.ec_brands_by_id.get(ec_brand_id)
+        if ec_brand and ec_brand.brand_id in catalog.brands_by_id:
+            brand_ids.add(ec_brand.brand_id)
+    return sorted(brand_ids), len(ec_brand_ids)
+
+
 # New Endpoint to get brand information by purchase_id
 @app.get("/purchase/{purchase_id}/brands", response_model=List[schemas.Brand])
 def get_brands_by_purchase_id(purchase_id: int, db: Session = Depends(connect.get_db)):
-    purchase_details = db.query(PurchaseDetail).filter(PurchaseDetail.purchase_id == purchase_id).all()
-    if not purchase_details:
+    catalog = get_catalog(db)
+    brand_ids, detail_count = get_purchase_brand_ids(purchase_id, catalog, db)
+    if not detail_count:
         raise HTTPException(status_code=404, detail="Purchase details not found")
 
-    brand_ids = set()
-    for detail in purchase_details:
-        ec_brand = db.query(EC_Brand).filter(EC_Brand.ec_brand_id == detail.ec_brand_id).first()
-        if ec_brand:
-            brand_ids.add(ec_brand.brand_id)
-
-    brands = db.query(Brand).filter(Brand.brand_id.in_(brand_ids)).all()
+    brands = [catalog.brands_by_id[brand_id] for brand_id in brand_ids]
     if not brands:
         raise HTTPException(status_code=404, detail="Brands not found")
 
@@ -170,6 +233,50 @@ def get_purchase_date(purchase_id: int, db: Session = Depends(connect.get_db)):
     return {"purchase_date": purchase.date_time.date()}
 
 
+# アンケート画面に必要な情報を1回で返す
+# (これまでは /purchase/{id}/brands, /purchase/{id}/date, /items, /user/{id} と、ブランドごとの /brand/{id}/average_scores を順に呼んでいた)
+@app.get("/purchase/{purchase_id}/survey_page", response_model=schemas.SurveyPage)
+def get_survey_page(purchase_id: int, db: Session = Depends(connect.get_db)):
+    # 1.購入と購入したユーザー(1回のクエリ)
+    row = (
+        db.query(Purchase.date_time, Purchase.survey_completion, User.user_name, User.birthdate, User.gender)
+        .join(User, Purchase.user_id == User.user_id)
+        .filter(Purchase.purchase_id == purchase_id)
+        .first()
+    )
+    if row is None:
+        raise HTTPException(status_code=404, detail="Purchase not found")
+
+    # 2.購入したブランド(明細は1回のクエリ、EC_Brand・Brand・itemsはマスタのスナップショットから)
+    catalog = get_catalog(db)
+    brand_ids, _ = get_purchase_brand_ids(purchase_id, catalog, db)
+
+    # 3.平均スコア(集計済みのbrand_average_scoresを1回のクエリで読む。無いブランドの分はまとめて1回のクエリで集計する)
+    scores = get_average_scores(db, brand_ids)
+
+    # 4.ロゴ(一覧表示用の縮小版、なければ元画像)をまとめて取得する。ロゴが無いブランドはNone
+    pictures = images.get_list_pictures_base64(db, "brand", brand_ids)
+    brands = []
+    for brand_id in brand_ids:
+        brand_logo, brand_logo_mime_type = pictures.get(brand_id, (None, None))
+        brands.append({
+            "brand_id": brand_id,
+            "brand_name": catalog.brands_by_id[brand_id].brand_name,
+            "brand_logo": brand_logo,
+            "brand_logo_mime_type": brand_logo_mime_type,
+            "average_scores": scores[brand_id],
+        })
+
+    return {
+        "purchase_id": purchase_id,
+        "purchase_date": row.date_time.date(),
+        "survey_completion": bool(row.survey_completion),
+        "user": {"user_name": row.user_name, "age": calculate_age(row.birthdate), "gender": row.gender},
+        "items": catalog.items,
+        "brands": brands,
+    }
+
+
 # New Survey Endpoint
 @app.post("/survey/{purchase_id}")
 async def submit_survey(purchase_id: int, survey: schemas.SurveySubmission, db: Session = Depends(connect.get_db)):
@@ -201,13 +308,15 @@ async def submit_survey(purchase_id: int, survey: schemas.SurveySubmission, db:
         db.rollback()
         print(f"Error saving survey data: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error saving survey data: {str(e)}")
+    # ブランドの平均スコアは応答を返した後にジョブで集計し直す
+    submit_average_scores_refresh([survey.brand_id], db)
     return {"message": "Survey submitted successfully"}
 
 
 # New Endpoint to get item information
 @app.get("/items", response_model=List[schemas.Item])
 async def get_items(db: Session = Depends(connect.get_db)):
-    items = db.query(Item).all()
+    items = get_catalog(db).items
     if not items:
         raise HTTPException(status_code=404, detail="Items not found")
     return items
@@ -216,8 +325,8 @@ async def get_items(db: Session = Depends(connect.get_db)):
 # New Endpoint to get average scores for a brand
 @app.get("/brand/{brand_id}/average_scores", response_model=Dict[int, float])
 async def get_brand_average_scores(brand_id: int, db: Session = Depends(connect.get_db)):
-    average_scores = db.query(SurveyRawData.item_id, func.avg(SurveyRawData.score).label('average_score')).filter(SurveyRawData.brand_id == brand_id).group_by(SurveyRawData.item_id).all()
-    return {item_id: avg_score for item_id, avg_score in average_scores}
+    # 同じブランドへのリクエストが同時に来た場合は、1回だけ読んで結果を共有する(読み込みはスレッドプールで行う)
+    return await average_scores_flight.do_async(brand_id, lambda: get_average_scores(db, [brand_id])[brand_id])
 
 
 @app.get("/brands/{brand_id}/logo")
@@ -236,4 +345,7 @@ def complete_survey(purchase_id: int, db: Session = Depends(connect.get_db)):
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error completing survey: {str(e)}")
+    # 回答が出そろったので、購入したブランドの平均スコアは応答を返した後にジョブで集計し直す
+    brand_ids, _ = get_purchase_brand_ids(purchase_id, get_catalog(db), db)
+    submit_average_scores_refresh(brand_ids, db)
     return {"message": "Survey completed"}
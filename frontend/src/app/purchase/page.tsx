@@ -396,7 +396,7 @@ export default function Home() {
               {selectedSetDetails.map((item) => (
                 <div key={item.ec_brand_id} className="mb-4 flex items-center">
                   {item.picture ? (
-                    <img src={`data:image/png;base64,${item.picture}`} alt={item.name} className="w-28 h-28 object-cover rounded-full border-2 border-amber-600 mr-4" />
+                    <img src={`data:${item.picture_mime_type ?? "image/png"};base64,${item.picture}`} alt={item.name} className="w-28 h-28 object-cover rounded-full border-2 border-amber-600 mr-4" />
                   ) : (
                     <span className="w-10 h-10 rounded-full border-2 border-amber-600 mr-4 flex items-center justify-center">なし</span>
                   )}
@@ -456,7 +456,7 @@ export default function Home() {
                   {item.national_set.details.map((detail, detailIndex) => (
                     <div key={`national-${detailIndex}`} className="mb-4 flex items-center">
                       {detail.picture ? (
-                        <img src={`data:image/png;base64,${detail.picture}`} alt={detail.name} className="w-28 h-28 object-cover rounded-full border-2 border-amber-600 mr-4" />
+                        <img src={`data:${detail.picture_mime_type ?? "image/png"};base64,${detail.picture}`} alt={detail.name} className="w-28 h-28 object-cover rounded-full border-2 border-amber-600 mr-4" />
                       ) : (
                         <span className="w-28 h-28 rounded-full border-2 border-amber-600 mr-4 flex items-center justify-center">なし</span>
                       )}
@@ -480,7 +480,7 @@ export default function Home() {
                   {item.craft_set.details.map((detail, detailIndex) => (
                     <div key={`craft-${detailIndex}`} className="mb-4 flex items-center">
                       {detail.picture ? (
-                        <img src={`data:image/png;base64,${detail.picture}`} alt={detail.name} className="w-28 h-28 object-cover rounded-full border-2 border-amber-600 mr-4" />
+                        <img src={`data:${detail.picture_mime_type ?? "image/png"};base64,${detail.picture}`} alt={detail.name} className="w-28 h-28 object-cover rounded-full border-2 border-amber-600 mr-4" />
                       ) : (
                         <span className="w-28 h-28 rounded-full border-2 border-amber-600 mr-4 flex items-center justify-center">なし</span>
                       )}
@@ -157,7 +157,7 @@ export default function PurchaselogPageComponent() {
                               <tr key={i}>
                                 <td className="border px-4 py-2 flex items-center">
                                   {detail.picture ? (
-                                    <img src={`data:image/png;base64,${detail.picture}`} alt={detail.name} className="w-10 h-10 object-cover rounded-full border-2 border-amber-600 mr-4" />
+                                    <img src={`data:${detail.picture_mime_type ?? "image/png"};base64,${detail.picture}`} alt={detail.name} className="w-10 h-10 object-cover rounded-full border-2 border-amber-600 mr-4" />
                                   ) : (
                                     <span className="w-10 h-10 rounded-full border-2 border-amber-600 mr-4 flex items-center justify-center">なし</span>
                                   )}
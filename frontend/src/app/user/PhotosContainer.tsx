@@ -3,6 +3,7 @@ import React from 'react';
 interface Photo {
   photo_id: number;
   photo_data: string;
+  photo_mime_type?: string; // 写真の形式(縮小版はimage/webp)
 }
 
 interface PhotosContainerProps {
@@ -17,7 +18,7 @@ const PhotosContainer: React.FC<PhotosContainerProps> = ({ photos }) => {
         {photos.map(photo => (
           <div key={photo.photo_id} className="relative group">
             <img
-              src={`data:image/jpeg;base64,${photo.photo_data}`}
+              src={`data:${photo.photo_mime_type ?? "image/jpeg"};base64,${photo.photo_data}`}
               alt={`Post ${photo.photo_id}`}
               className="w-full h-64 object-cover rounded-2xl transition-transform duration-300 ease-in-out transform group-hover:scale-105"
             />
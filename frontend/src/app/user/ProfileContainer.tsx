@@ -221,7 +221,7 @@ const ProfileContainer: React.FC<ProfileContainerProps> = ({ user }) => {
                 {favorites.map((favorite) => (
                   <div key={favorite.brand_id} className="flex items-center justify-between w-full mb-2">
                     <div className="flex items-center pr-5">
-                      <img src={`data:image/png;base64,${favorite.brand_logo}`} alt={favorite.brand_name} className="w-10 h-10 object-cover rounded-full border-2 border-amber-600 mr-4" />
+                      <img src={`data:${favorite.brand_logo_mime_type ?? "image/png"};base64,${favorite.brand_logo}`} alt={favorite.brand_name} className="w-10 h-10 object-cover rounded-full border-2 border-amber-600 mr-4" />
                       <p>{favorite.brand_name}</p>
                     </div>
                     <button onClick={() => handleFavoriteDelete(favorite.brand_id)} className="text-red-500">
@@ -252,7 +252,7 @@ const ProfileContainer: React.FC<ProfileContainerProps> = ({ user }) => {
                             className="cursor-pointer p-2 hover:bg-amber-100 flex items-center"
                           >
                             <img
-                              src={`data:image/png;base64,${result.brand_logo}`}
+                              src={`data:${result.brand_logo_mime_type ?? "image/png"};base64,${result.brand_logo}`}
                               alt={result.brand_name}
                               className="w-6 h-6 object-cover rounded-full border-2 border-amber-600 mr-2"
                             />
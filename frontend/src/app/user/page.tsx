@@ -16,6 +16,7 @@ interface User {
 interface Photo {
   photo_id: number;
   photo_data: string;
+  photo_mime_type?: string; // 写真の形式(縮小版はimage/webp)
 }
 
 interface UserWithPhotos {
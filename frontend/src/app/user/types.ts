@@ -9,6 +9,7 @@ export interface Brand {
   brand_id: number;
   brand_name: string;
   brand_logo: string;
+  brand_logo_mime_type?: string; // ロゴの形式(縮小版はimage/webp)
 }
 
 export interface Item {
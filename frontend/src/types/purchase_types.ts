@@ -21,6 +21,7 @@ export interface RecommendResponseItem {
   category: string; // 追加
   ec_set_id: number; // 追加
   picture?: string; // OptionalとしてBase64エンコードされた画像データを追加
+  picture_mime_type?: string; // 画像の形式(縮小版はimage/webp)
 }
 
 export interface NationalCraftOption {
@@ -47,6 +48,7 @@ export interface PurchaseItem {
   ec_brand_id: number;
   category: string;
   picture?: string; // OptionalとしてBase64エンコードされた画像データを追加
+  picture_mime_type?: string; // 画像の形式(縮小版はimage/webp)
   name: string;
   price: number;
   count: number;